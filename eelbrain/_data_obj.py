@@ -22,9 +22,11 @@ managed by
 
 from __future__ import division
 
-from collections import OrderedDict, defaultdict
+import atexit
+from collections import OrderedDict
 from copy import deepcopy
 from fnmatch import fnmatchcase
+from functools import partial
 import itertools
 from itertools import chain, izip
 from keyword import iskeyword
@@ -34,7 +36,9 @@ import operator
 import os
 import re
 import string
+import tempfile
 from warnings import warn
+import weakref
 
 import mne
 from mne import Evoked as _mne_Evoked
@@ -48,7 +52,8 @@ from scipy.spatial.distance import cdist, pdist, squareform
 from . import fmtxt
 from . import _colorspaces as cs
 from ._utils import ui, LazyProperty, natsorted
-from ._utils.numpy_utils import slice_to_arange, full_slice
+from ._utils.numpy_utils import (slice_to_arange, full_slice, is_mapped,
+                                  memmap_file)
 
 
 preferences = dict(fullrepr=False,  # whether to display full arrays/dicts in __repr__ methods
@@ -61,6 +66,11 @@ preferences = dict(fullrepr=False,  # whether to display full arrays/dicts in __
                    int_fmt='%s',
                    factor_repr_use_labels=True,
                    short_repr=True,  # "A % B" vs "Interaction(A, B)"
+                   # bytes per chunk for operations on memory mapped NDVars
+                   memmap_chunk_size=2**27,
+                   # directory for temporary files of memory mapped NDVars
+                   # (None to use tempfile.gettempdir())
+                   memmap_temp_dir=None,
                    )
 
 
@@ -668,6 +678,179 @@ def align1(d, idx, d_idx='index', out='data'):
         ValueError("Invalid value for out parameter: %r" % out)
 
 
+def _optimize_index(index, n):
+    """Convert an array of increasing indices to a slice if possible
+
+    Parameters
+    ----------
+    index : array of int
+        Sorted indices.
+    n : int
+        Length of the indexed object.
+    """
+    d_values = np.unique(np.diff(index))
+    if len(d_values) == 1 and d_values[0] > 0 and index[0] >= 0:
+        start = index.min() or None
+        step = d_values[0]
+        stop = index.max() + 1
+        if stop > n - step:
+            stop = None
+        if step == 1:
+            step = None
+        index = slice(start, stop, step)
+    return index
+
+
+def _cell_groups(X):
+    "Cell groups of X, cached for Factor and Interaction"
+    if isinstance(X, _Effect):
+        return X._get_cell_groups()
+    return _CellGroups(X)
+
+
+def _cell_codes(X):
+    """Integer code for each case in X, indexing ``X.cells``
+
+    Cases that do not belong to any cell receive the code ``len(X.cells)``.
+    """
+    if isfactor(X):
+        if not X._labels:
+            return np.zeros(len(X), np.intp)
+        lut = np.empty(max(X._labels) + 1, np.intp)
+        lut[X._labels.keys()] = np.arange(len(X._labels))
+        return lut[X.x]
+    elif isinteraction(X) and all(isfactor(f) for f in X.base):
+        codes = np.zeros(len(X), np.intp)
+        for f in X.base:
+            codes *= len(f.cells)
+            codes += _cell_codes(f)
+        return codes
+    else:
+        cells = X.cells
+        codes = np.empty(len(X), np.intp)
+        codes.fill(len(cells))
+        for i, cell in enumerate(cells):
+            codes[X == cell] = i
+        return codes
+
+
+class _CellGroups(object):
+    """Cases of a categorial model grouped by cell
+
+    Cases are sorted by cell once, so that data in each cell can be accessed
+    as a contiguous segment and reduced in a single pass (see
+    :meth:`.aggregate`).
+
+    Parameters
+    ----------
+    X : categorial
+        Model defining the cells.
+
+    Attributes
+    ----------
+    cells : tuple
+        All cells in ``X`` (including empty cells).
+    counts : array of int
+        Number of cases in each cell.
+    index : array of int
+        Index that sorts the cases of ``X`` by cell (preserving the order of
+        cases within each cell).
+    starts : array of int
+        For each cell, the position of its first case in ``index``.
+    """
+    def __init__(self, X):
+        cells = X.cells
+        n_cells = len(cells)
+        codes = _cell_codes(X)
+        counts = np.bincount(codes, minlength=n_cells + 1)[:n_cells]
+        index = np.argsort(codes, kind='mergesort')
+        self.cells = cells
+        self.counts = counts
+        self.index = index[:counts.sum()]
+        self.starts = np.cumsum(counts) - counts
+        self.n_cases = len(X)
+        self._cell_i = dict(izip(cells, xrange(n_cells)))
+
+    def cell_index(self, i):
+        "Case index for cell number ``i`` (array of increasing int)"
+        start = self.starts[i]
+        return self.index[start:start + self.counts[i]]
+
+    def index_for(self, cell):
+        "Case index for ``cell`` (empty if ``cell`` is not in ``X.cells``)"
+        i = self._cell_i.get(cell)
+        if i is None:
+            return self.index[:0]
+        return self.cell_index(i)
+
+    def mask_for(self, cell):
+        "Boolean index for ``cell``"
+        out = np.zeros(self.n_cases, bool)
+        out[self.index_for(cell)] = True
+        return out
+
+    def cell_index_opt(self, i):
+        "Case index for cell number ``i`` (a slice if possible)"
+        return _optimize_index(self.cell_index(i), self.n_cases)
+
+    def nonempty(self):
+        "Indices of the cells that contain cases"
+        return np.flatnonzero(self.counts)
+
+    def aggregate(self, x, func=np.mean, axis=True):
+        """Summarize the cases of ``x`` in each non-empty cell
+
+        Parameters
+        ----------
+        x : array
+            Data with cases on the first axis.
+        func : callable
+            Function to summarize the data in each cell. For multidimensional
+            data, ``numpy.mean`` and ``numpy.sum`` are computed as segment
+            reductions over the sorted data; otherwise ``func`` is called with
+            the data of each cell.
+        axis : bool
+            Call ``func`` with ``axis=0`` (for functions that reduce a
+            multidimensional array; default True).
+
+        Returns
+        -------
+        x_agg : array
+            Array with one summary for each non-empty cell along the first
+            axis.
+        """
+        nonempty = self.nonempty()
+        if is_mapped(x):
+            # read one cell at a time
+            if axis:
+                return np.array([func(x[self.cell_index(i)], axis=0) for i in
+                                 nonempty])
+            else:
+                return np.array([func(x[self.cell_index(i)]) for i in
+                                 nonempty])
+        starts = self.starts[nonempty]
+        counts = self.counts[nonempty]
+        x = x[self.index]
+        if len(starts) and x.ndim > 1 and (func is np.mean or func is np.sum):
+            # 1-d data are reduced per segment below, because numpy uses
+            # pairwise summation for them whereas reduceat adds sequentially
+            if func is np.mean and x.dtype.kind in 'biu':
+                dtype = np.float64
+            elif x.dtype.kind == 'b':
+                dtype = int
+            else:
+                dtype = None
+            out = np.add.reduceat(x, starts, 0, dtype)
+            if func is np.mean:
+                out /= counts.reshape((-1,) + (1,) * (out.ndim - 1))
+            return out
+        elif axis:
+            return np.array([func(x[i:i + n], axis=0) for i, n in
+                             izip(starts, counts)])
+        else:
+            return np.array([func(x[i:i + n]) for i, n in izip(starts, counts)])
+
+
 class Celltable(object):
     """Divide Y into cells defined by X.
 
@@ -825,8 +1008,9 @@ class Celltable(object):
         self.cells = X.cells
         self.n_cells = len(self.cells)
         self.groups = {}
-        for cell in X.cells:
-            idx = X.index_opt(cell)
+        cell_groups = _cell_groups(X)
+        for i, cell in enumerate(X.cells):
+            idx = cell_groups.cell_index_opt(i)
             self.data_indexes[cell] = idx
             self.data[cell] = Y[idx]
             if match:
@@ -1080,8 +1264,18 @@ def combine(items, name=None, check_dims=True):
             x = np.hstack(f.x for f in items)
             return Factor(x, name, random, labels=labels)
         else:
-            x = sum((i.as_labels() for i in items), [])
-            return Factor(x, name, random)
+            # merge label tables and recode each item
+            codes = {}  # {label -> code}
+            xs = []
+            for f in items:
+                if f._labels:
+                    code_map = np.empty(max(f._labels) + 1, np.uint32)
+                    for code, label in f._labels.iteritems():
+                        code_map[code] = codes.setdefault(label, len(codes))
+                    xs.append(code_map[f.x])
+            x = np.hstack(xs) if xs else np.empty(0, np.uint32)
+            labels = {code: label for label, code in codes.iteritems()}
+            return Factor(x, name, random, labels=labels)
     elif stype == 'ndvar':
         v_have_case = [v.has_case for v in items]
         if all(v_have_case):
@@ -1548,16 +1742,11 @@ class Var(object):
             err = "Length mismatch: %i (Var) != %i (X)" % (len(self), len(X))
             raise ValueError(err)
 
-        x = []
-        for cell in X.cells:
-            x_cell = self.x[X == cell]
-            if len(x_cell) > 0:
-                x.append(func(x_cell))
+        x = _cell_groups(X).aggregate(self.x, func, False)
 
         if name is True:
             name = self.name
 
-        x = np.array(x)
         return Var(x, name, info=self.info.copy())
 
     @property
@@ -1746,6 +1935,8 @@ class Var(object):
 
 
 class _Effect(object):
+    _cell_groups = None  # cache for _get_cell_groups()
+
     # numeric ---
     def __add__(self, other):
         return Model(self) + other
@@ -1809,6 +2000,36 @@ class _Effect(object):
             counts[value] += 1
         return Var(enum, name)
 
+    def _get_cell_groups(self):
+        "Cached :class:`_CellGroups` (reset when values change)"
+        if self._cell_groups is None:
+            groups = _CellGroups(self)
+            groups.index.flags.writeable = False
+            self._cell_groups = groups
+        return self._cell_groups
+
+    def index_map(self):
+        """Map each cell to the indices of its cases
+
+        The map is computed once and cached until the values are modified,
+        so that repeated cell lookups only cost the size of the cell.
+
+        Returns
+        -------
+        index_map : OrderedDict
+            ``{cell: index}`` map for all cells (in the order of ``.cells``),
+            where ``index`` is a read-only array of increasing indices.
+
+        Examples
+        --------
+        >>> f = Factor('abcabcabc')
+        >>> f.index_map()
+        OrderedDict([('a', array([0, 3, 6])), ('b', array([1, 4, 7])), ('c', array([2, 5, 8]))])
+        """
+        groups = self._get_cell_groups()
+        return OrderedDict((cell, groups.cell_index(i)) for i, cell in
+                           enumerate(groups.cells))
+
     def index(self, cell):
         """``e.index(cell)`` returns an array of indices where e equals cell
 
@@ -1823,7 +2044,7 @@ class _Effect(object):
         >>> f
         Factor(['a', 'new_b', 'c', 'a', 'new_b', 'c', 'a', 'new_b', 'c'])
         """
-        return np.flatnonzero(self == cell)
+        return self._get_cell_groups().index_for(cell).copy()
 
     def index_opt(self, cell):
         """Find an optimized index for a given cell.
@@ -1834,18 +2055,8 @@ class _Effect(object):
             If possible, a ``slice`` object is returned. Otherwise, an array
             of indices (as with ``e.index(cell)``).
         """
-        index = np.flatnonzero(self == cell)
-        d_values = np.unique(np.diff(index))
-        if len(d_values) == 1:
-            start = index.min() or None
-            step = d_values[0]
-            stop = index.max() + 1
-            if stop > len(self) - step:
-                stop = None
-            if step == 1:
-                step = None
-            index = slice(start, stop, step)
-        return index
+        return _optimize_index(self._get_cell_groups().index_for(cell),
+                               len(self))
 
     def sort_idx(self, descending=False, order=None):
         """Create an index that could be used to sort this data_object.
@@ -1973,21 +2184,41 @@ class Factor(_Effect):
             values = [pair[1] for pair in labels]
 
         # convert x to codes
-        highest_code = -1
-        codes = {}  # {label -> code}
-        x_ = np.empty(n_cases, dtype=np.uint32)
-        for i, value in enumerate(x):
-            if value in labels_dict:
-                label = labels_dict[value]
-            elif isinstance(value, unicode):
-                label = value
-            else:
-                label = str(value)
+        if isvar(x):
+            x = x.x
+        if isinstance(x, np.ndarray) and x.ndim == 1 and x.dtype.kind in 'biufSU':
+            # find labels for unique values only
+            unique, first, inverse = np.unique(x, True, True)
+            value_labels = [labels_dict[v] if v in labels_dict else
+                            v if isinstance(v, unicode) else str(v)
+                            for v in unique]
+            # assign codes in the order in which labels first occur
+            label_first = {}
+            for label, i in izip(value_labels, first):
+                if i < label_first.get(label, n_cases):
+                    label_first[label] = i
+            labels_ = sorted(label_first, key=label_first.__getitem__)
+            codes = dict(izip(labels_, xrange(len(labels_))))
+            value_codes = np.array([codes[label] for label in value_labels],
+                                   np.uint32)
+            x_ = value_codes[inverse]
+            highest_code = len(codes) - 1
+        else:
+            highest_code = -1
+            codes = {}  # {label -> code}
+            x_ = np.empty(n_cases, dtype=np.uint32)
+            for i, value in enumerate(x):
+                if value in labels_dict:
+                    label = labels_dict[value]
+                elif isinstance(value, unicode):
+                    label = value
+                else:
+                    label = str(value)
 
-            if label in codes:
-                x_[i] = codes[label]
-            else:  # new code
-                x_[i] = codes[label] = highest_code = highest_code + 1
+                if label in codes:
+                    x_[i] = codes[label]
+                else:  # new code
+                    x_[i] = codes[label] = highest_code = highest_code + 1
 
         if highest_code >= 2**32:
             raise RuntimeError("Too many categories in this Factor")
@@ -2014,6 +2245,7 @@ class Factor(_Effect):
         self.x = x = state['x']
         self.name = state['name']
         self.random = state['random']
+        self._cell_groups = None
         if 'ordered_labels' in state:
             # 0.13:  ordered_labels replaced labels
             self._labels = state['ordered_labels']
@@ -2095,6 +2327,7 @@ class Factor(_Effect):
 
         # assign
         self.x[index] = code
+        self._cell_groups = None
 
         # obliterate redundant labels
         codes_in_use = set(np.unique(self.x))
@@ -2131,6 +2364,8 @@ class Factor(_Effect):
 
     # numeric ---
     def __eq__(self, other):
+        if self._cell_groups is not None and isinstance(other, basestring):
+            return self._cell_groups.mask_for(other)
         return self.x == self._encode(other)
 
     def __ne__(self, other):
@@ -2183,6 +2418,7 @@ class Factor(_Effect):
                     raise ValueError("Too many categories in this Factor.")
                 self._labels[code] = Y
                 self._codes[Y] = code
+                self._cell_groups = None
                 return code
             else:
                 return 65535  # code for values not present in the Factor
@@ -2277,21 +2513,25 @@ class Factor(_Effect):
             err = "Length mismatch: %i (Var) != %i (X)" % (len(self), len(X))
             raise ValueError(err)
 
-        x = []
-        for cell in X.cells:
-            idx = (X == cell)
-            if np.sum(idx):
-                x_i = np.unique(self.x[idx])
-                if len(x_i) > 1:
-                    labels = tuple(self._labels[code] for code in x_i)
-                    err = ("Can not determine aggregated value for Factor %r "
-                           "in cell %r because the cell contains multiple "
-                           "values %r. Set drop_bad=True in order to ignore "
-                           "this inconsistency and drop the Factor."
-                           % (self.name, cell, labels))
-                    raise ValueError(err)
-                else:
-                    x.append(x_i[0])
+        groups = _cell_groups(X)
+        nonempty = groups.nonempty()
+        if len(nonempty):
+            x_sorted = self.x[groups.index]
+            starts = groups.starts[nonempty]
+            x = np.minimum.reduceat(x_sorted, starts)
+            bad = np.flatnonzero(x != np.maximum.reduceat(x_sorted, starts))
+            if len(bad):
+                i = nonempty[bad[0]]
+                x_i = np.unique(self.x[groups.cell_index(i)])
+                labels = tuple(self._labels[code] for code in x_i)
+                err = ("Can not determine aggregated value for Factor %r "
+                       "in cell %r because the cell contains multiple "
+                       "values %r. Set drop_bad=True in order to ignore "
+                       "this inconsistency and drop the Factor."
+                       % (self.name, groups.cells[i], labels))
+                raise ValueError(err)
+        else:
+            x = []
 
         if name is True:
             name = self.name
@@ -2486,6 +2726,7 @@ class Factor(_Effect):
 
         self._labels = new_labels
         self._codes = {l: c for c, l in new_labels.iteritems()}
+        self._cell_groups = None
 
     def startswith(self, substr):
         """Create an index that is true for all cases whose name starts with
@@ -2540,6 +2781,126 @@ class Factor(_Effect):
         return Factor(self.x, name, self.random, repeats, labels=self._labels)
 
 
+# temporary files for results of operations on memory mapped NDVars
+# {path: weak reference to the array}
+_memmap_temp_files = {}
+
+
+def _remove_memmap_temp_file(path, ref=None):
+    _memmap_temp_files.pop(path, None)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+@atexit.register
+def _remove_memmap_temp_files():
+    for path in _memmap_temp_files.keys():
+        _remove_memmap_temp_file(path)
+
+
+def _temp_memmap(shape, dtype):
+    """Memory mapped array in a temporary file
+
+    The file is created in ``preferences['memmap_temp_dir']`` and removed when
+    the array (including all views on it) is garbage collected, or at the end
+    of the Python session.
+    """
+    fd, path = tempfile.mkstemp('.dat', 'eelbrain-',
+                                preferences['memmap_temp_dir'])
+    os.close(fd)
+    x = np.memmap(path, dtype, 'w+', 0, shape)
+    # views keep x alive through their base attribute
+    _memmap_temp_files[path] = weakref.ref(
+        x, partial(_remove_memmap_temp_file, path))
+    return x
+
+
+def _case_chunks(x, n=None):
+    """Slices dividing cases into chunks of about ``memmap_chunk_size`` bytes
+
+    Parameters
+    ----------
+    x : array
+        Data with cases on the first axis (determines the chunk size).
+    n : int
+        Number of cases (default ``len(x)``).
+    """
+    if n is None:
+        n = len(x)
+    case_size = x[0].nbytes if len(x) else x.itemsize
+    step = max(1, preferences['memmap_chunk_size'] // max(case_size, 1))
+    return [slice(start, start + step) for start in xrange(0, n, step)]
+
+
+def _map_case_chunks(func, n, x):
+    """Compute data in chunks of cases and store it in a temporary file
+
+    Parameters
+    ----------
+    func : callable
+        Function returning the output for a slice of cases (``func(s)``).
+    n : int
+        Number of cases in the output.
+    x : np.memmap
+        Memory mapped input data (determines the chunk size).
+
+    Returns
+    -------
+    out : np.memmap
+        Output data.
+    """
+    out = None
+    for s in _case_chunks(x, n):
+        x_chunk = func(s)
+        if out is None:
+            out = _temp_memmap((n,) + x_chunk.shape[1:], x_chunk.dtype)
+        out[s] = x_chunk
+    if out is None:
+        return func(slice(0, 0))
+    out.flush()
+    return out
+
+
+def _op(op, x, y=None):
+    """``op(x, y)`` (or ``op(x)``), in chunks of cases for memory mapped data
+
+    Cases are assumed to be on the first axis. If ``x`` or ``y`` are memory
+    mapped, the result is stored in a temporary file.
+    """
+    if y is None:
+        if not is_mapped(x):
+            return op(x)
+        return _map_case_chunks(lambda s: op(x[s]), len(x), x)
+    elif not (is_mapped(x) or is_mapped(y)):
+        return op(x, y)
+
+    shape = np.broadcast(x, y).shape
+    n = shape[0]
+    x_split = np.ndim(x) == len(shape) and np.shape(x)[0] == n
+    y_split = np.ndim(y) == len(shape) and np.shape(y)[0] == n
+    return _map_case_chunks(lambda s: op(x[s] if x_split else x,
+                                         y[s] if y_split else y),
+                            n, x if is_mapped(x) else y)
+
+
+# reductions that give the same result for a tuple of axes as for collapsing
+# one axis after the other
+_TUPLE_AXIS_FUNCS = (np.mean, np.sum, np.prod, np.max, np.min, np.amax, np.amin,
+                     np.any, np.all)
+
+
+def _collapse(x, func, axes):
+    "Apply func over axes in turn (all at once if the result is the same)"
+    if len(axes) == 1:
+        return func(x, axis=axes[0])
+    elif any(func is f for f in _TUPLE_AXIS_FUNCS):
+        return func(x, axis=axes)
+    for axis in reversed(axes):
+        x = func(x, axis=axis)
+    return x
+
 
 class NDVar(object):
     """Container for n-dimensional data.
@@ -2565,6 +2926,15 @@ class NDVar(object):
     copy of ``info`` is stored. Make sure the relevant objects
     are not modified externally later.
 
+    ``x`` can be a :class:`numpy.memmap` for data that does not fit into
+    memory (see also :meth:`.as_memmap`). Arithmetic, :meth:`.sub`,
+    :meth:`.summary` and :meth:`.aggregate` then process the data in chunks
+    of cases, and results with a case dimension are stored in temporary files
+    (in ``preferences['memmap_temp_dir']``, by default the system's temporary
+    directory) that are removed when the result is garbage collected. When
+    pickled, an NDVar backed by a memory mapped file only stores the location
+    of its data.
+
 
     Examples
     --------
@@ -2583,7 +2953,8 @@ class NDVar(object):
         # check data shape
         dims = tuple(dims)
         ndim = len(dims)
-        x = np.asarray(x)
+        if not isinstance(x, np.memmap):
+            x = np.asarray(x)
         if ndim != x.ndim:
             err = ("Unequal number of dimensions (data: %i, dims: %i)" %
                    (x.ndim, ndim))
@@ -2627,7 +2998,12 @@ class NDVar(object):
         if self.has_case:
             self.dimnames = ('case',) + self.dimnames
 
-        self.x = x = state['x']
+        if 'x_file' in state:
+            filename, offset, dtype, shape, mode = state['x_file']
+            x = np.memmap(filename, dtype, mode, offset, shape)
+        else:
+            x = state['x']
+        self.x = x
         self.name = state['name']
         if 'info' in state:
             self.info = state['info']
@@ -2649,9 +3025,16 @@ class NDVar(object):
 
     def __getstate__(self):
         state = {'dims': self.dims,
-                 'x': self.x,
                  'name': self.name,
                  'info': self.info}
+        location = memmap_file(self.x)
+        if location is None or location[0] in _memmap_temp_files:
+            state['x'] = np.asarray(self.x)
+        else:
+            filename, offset = location
+            mode = 'r+' if self.x.mode == 'w+' else self.x.mode
+            state['x_file'] = (filename, offset, self.x.dtype.str,
+                               self.x.shape, mode)
         return state
 
     @property
@@ -2660,7 +3043,7 @@ class NDVar(object):
 
     # numeric ---
     def __neg__(self):
-        x = -self.x
+        x = _op(operator.neg, self.x)
         info = self.info.copy()
         return NDVar(x, self.dims, info, self.name)
 
@@ -2672,32 +3055,32 @@ class NDVar(object):
 
     def __lt__(self, other):
         y = self._ialign(other)
-        x = self.x < y
+        x = _op(operator.lt, self.x, y)
         return NDVar(x, self.dims, self.info.copy(), self.name)
 
     def __le__(self, other):
         y = self._ialign(other)
-        x = self.x <= y
+        x = _op(operator.le, self.x, y)
         return NDVar(x, self.dims, self.info.copy(), self.name)
 
     def __eq__(self, other):
         y = self._ialign(other)
-        x = self.x == y
+        x = _op(operator.eq, self.x, y)
         return NDVar(x, self.dims, self.info.copy(), self.name)
 
     def __ne__(self, other):
         y = self._ialign(other)
-        x = self.x != y
+        x = _op(operator.ne, self.x, y)
         return NDVar(x, self.dims, self.info.copy(), self.name)
 
     def __gt__(self, other):
         y = self._ialign(other)
-        x = self.x > y
+        x = _op(operator.gt, self.x, y)
         return NDVar(x, self.dims, self.info.copy(), self.name)
 
     def __ge__(self, other):
         y = self._ialign(other)
-        x = self.x >= y
+        x = _op(operator.ge, self.x, y)
         return NDVar(x, self.dims, self.info.copy(), self.name)
 
     def _align(self, other):
@@ -2784,10 +3167,10 @@ class NDVar(object):
     def __add__(self, other):
         if isnumeric(other):
             dims, x_self, x_other = self._align(other)
-            x = x_self + x_other
+            x = _op(operator.add, x_self, x_other)
             name = '%s+%s' % (self.name, other.name)
         elif np.isscalar(other):
-            x = self.x + other
+            x = _op(operator.add, self.x, other)
             dims = self.dims
             name = '%s+%s' % (self.name, str(other))
         else:
@@ -2802,10 +3185,10 @@ class NDVar(object):
     def __div__(self, other):
         if isnumeric(other):
             dims, x_self, x_other = self._align(other)
-            x = x_self / x_other
+            x = _op(operator.truediv, x_self, x_other)
             name = '%s/%s' % (self.name, other.name)
         elif np.isscalar(other):
-            x = self.x / other
+            x = _op(operator.truediv, self.x, other)
             dims = self.dims
             name = '%s/%s' % (self.name, str(other))
         else:
@@ -2816,10 +3199,10 @@ class NDVar(object):
     def __mul__(self, other):
         if isnumeric(other):
             dims, x_self, x_other = self._align(other)
-            x = x_self * x_other
+            x = _op(operator.mul, x_self, x_other)
             name = '%s*%s' % (self.name, other.name)
         elif np.isscalar(other):
-            x = self.x * other
+            x = _op(operator.mul, self.x, other)
             dims = self.dims
             name = '%s*%s' % (self.name, str(other))
         else:
@@ -2830,10 +3213,10 @@ class NDVar(object):
     def __sub__(self, other):
         if isnumeric(other):
             dims, x_self, x_other = self._align(other)
-            x = x_self - x_other
+            x = _op(operator.sub, x_self, x_other)
             name = '%s-%s' % (self.name, other.name)
         elif np.isscalar(other):
-            x = self.x - other
+            x = _op(operator.sub, self.x, other)
             dims = self.dims
             name = '%s-%s' % (self.name, str(other))
         else:
@@ -2846,7 +3229,7 @@ class NDVar(object):
         return self
 
     def __rsub__(self, other):
-        x = other - self.x
+        x = _op(operator.sub, other, self.x)
         info = self.info.copy()
         return NDVar(x, self.dims, info, self.name)
 
@@ -2978,12 +3361,7 @@ class NDVar(object):
             err = "Length mismatch: %i (Var) != %i (X)" % (len(self), len(X))
             raise ValueError(err)
 
-        x = []
-        for cell in X.cells:
-            idx = (X == cell)
-            if np.sum(idx):
-                x_cell = self.x[idx]
-                x.append(func(x_cell, axis=0))
+        x = _cell_groups(X).aggregate(self.x, func)
 
         # update info for summary
         info = self.info.copy()
@@ -2993,7 +3371,6 @@ class NDVar(object):
         if name is True:
             name = self.name
 
-        x = np.array(x)
         out = NDVar(x, self.dims, info, name)
         return out
 
@@ -3049,6 +3426,32 @@ class NDVar(object):
         else:
             return NDVar(x, dims, self.info.copy(), name)
 
+    def as_memmap(self, path, name=True):
+        """Copy the data to a memory mapped file
+
+        Parameters
+        ----------
+        path : str
+            File in which to store the data (an existing file is overwritten).
+        name : None | True | str
+            Name of the output NDVar, ``True`` to keep the current name
+            (default ``True``).
+
+        Returns
+        -------
+        ndvar : NDVar
+            NDVar whose data is a :class:`numpy.memmap` of ``path``. Pickling
+            the NDVar only stores the location of the data, which needs to
+            remain at ``path``.
+        """
+        x = np.memmap(path, self.x.dtype, 'w+', 0, self.x.shape)
+        for s in _case_chunks(self.x):
+            x[s] = self.x[s]
+        x.flush()
+        if name is True:
+            name = self.name
+        return NDVar(x, self.dims, self.info.copy(), name)
+
     def bin(self, tstep, tstart=None, tstop=None, func=None):
         """Bin the data along the time axis
 
@@ -3138,9 +3541,10 @@ class NDVar(object):
 
         Notes
         -----
-        The info dictionary is still a shallow copy.
+        The info dictionary is still a shallow copy. Memory mapped data is
+        copied to a temporary file.
         """
-        x = self.x.copy()
+        x = _op(np.array, self.x)
         info = self.info.copy()
         if name is True:
             name = self.name
@@ -3552,30 +3956,34 @@ class NDVar(object):
         if len(dims) + len(regions) == 0:
             dims = ('case',)
 
-        if regions:
-            dims = list(dims)
-            dims.extend(dim for dim in regions if not np.isscalar(regions[dim]))
-            data = self.sub(**regions)
-            return data.summary(*dims, func=func, name=name)
+        # select the regions without an intermediate NDVar
+        index, sub_dims, info = self._sub_index(regions)
+        x = self._get_index(index)
+        dims = list(dims)
+        dims.extend(dim for dim in regions if not np.isscalar(regions[dim]))
+        if not dims:
+            dims = ['case']
+        dim_names = [dim if isinstance(dim, basestring) else dim.name for dim
+                     in sub_dims]
+        axes = tuple(sorted(dim_names.index(dim) for dim in set(dims)))
+
+        dims = [dim for i, dim in enumerate(sub_dims) if i not in axes]
+        if is_mapped(x) and sub_dims[0] == 'case' and 0 not in axes:
+            x = _map_case_chunks(lambda s: _collapse(x[s], func, axes), len(x),
+                                 x)
         else:
-            x = self.x
-            axes = [self._dim_2_ax[dim] for dim in np.unique(dims)]
-            dims = list(self.dims)
-            for axis in sorted(axes, reverse=True):
-                x = func(x, axis=axis)
-                dims.pop(axis)
-
-            # update info for summary
-            info = self.info.copy()
-            if 'summary_info' in info:
-                info.update(info.pop('summary_info'))
-
-            if len(dims) == 0:
-                return x
-            elif dims == ['case']:
-                return Var(x, name, info=info)
-            else:
-                return NDVar(x, dims, info, name)
+            x = _collapse(x, func, axes)
+
+        # update info for summary
+        if 'summary_info' in info:
+            info.update(info.pop('summary_info'))
+
+        if len(dims) == 0:
+            return x
+        elif dims == ['case']:
+            return Var(x, name, info=info)
+        else:
+            return NDVar(x, dims, info, name)
 
     def sub(self, **kwargs):
         """Retrieve a slice through the NDVar.
@@ -3596,8 +4004,56 @@ class NDVar(object):
 
         The name of the new NDVar can be set with a ``name`` parameter. The
         default is the name of the current NDVar.
+
+        Selections that can be expressed as slices (including regularly spaced
+        index arrays) return an NDVar whose data is a view on the data of the
+        current NDVar. Set ``copy=True`` to make sure the new NDVar owns its
+        data.
         """
         var_name = kwargs.pop('name', self.name)
+        copy = kwargs.pop('copy', False)
+        index, dims, info = self._sub_index(kwargs)
+        x = self._get_index(index)
+        if copy and np.may_share_memory(x, self.x):
+            x = _op(np.array, x)
+        return NDVar(x, dims, info, var_name)
+
+    def _get_index(self, index):
+        """``self.x[index]``
+
+        A case index array on memory mapped data is applied in chunks of cases
+        (provided all other indexes are slices or scalars).
+        """
+        case_index = index[0]
+        if (self.has_case and isinstance(case_index, np.ndarray) and
+                is_mapped(self.x) and
+                not any(isinstance(idx, np.ndarray) for idx in index[1:])):
+            if case_index.dtype.kind == 'b':
+                case_index = np.flatnonzero(case_index)
+            index = (full_slice,) + index[1:]
+            return _map_case_chunks(lambda s: self.x[case_index[s]][index],
+                                    len(case_index), self.x)
+        return self.x[index]
+
+    def _sub_index(self, kwargs):
+        """Index, dimensions and info for a sub-NDVar
+
+        Parameters
+        ----------
+        kwargs : dict
+            ``{dim_name: index}`` dictionary (see :meth:`.sub`).
+
+        Returns
+        -------
+        index : tuple
+            Index into ``self.x``. Array indexes on single dimensions are
+            converted to slices whenever possible, so that indexing returns a
+            view.
+        dims : tuple
+            Dimensions of the indexed data.
+        info : dict
+            Info dictionary of the indexed data.
+        """
         info = self.info.copy()
         dims = list(self.dims)
         n_axes = len(dims)
@@ -3621,7 +4077,21 @@ class NDVar(object):
             if isinstance(idx, (list, tuple)):
                 idx = np.array(idx)
 
-            index[dimax] = idx
+            if isinstance(idx, np.ndarray) and idx.ndim == 1:
+                if idx.dtype.kind == 'b':
+                    idx_x = _optimize_index(np.flatnonzero(idx),
+                                            self.x.shape[dimax])
+                elif idx.dtype.kind in 'iu':
+                    idx_x = _optimize_index(idx, self.x.shape[dimax])
+                else:
+                    idx_x = idx
+
+                if isinstance(idx_x, slice):
+                    index[dimax] = idx_x
+                else:
+                    index[dimax] = idx
+            else:
+                index[dimax] = idx
 
             # find corresponding dim
             if np.isscalar(idx):
@@ -3639,7 +4109,7 @@ class NDVar(object):
                 idx = index[i]
                 if ndim_increment and isinstance(idx, (slice, np.ndarray)):
                     if isinstance(idx, slice):
-                        idx = slice_to_arange(idx, len(dims[i]))
+                        idx = slice_to_arange(idx, self.x.shape[i])
                     elif idx.dtype.kind == 'b':
                         idx = np.flatnonzero(idx)
                     index[i] = idx[(full_slice,) + (None,) * ndim_increment]
@@ -3647,9 +4117,8 @@ class NDVar(object):
                 if isinstance(idx, np.ndarray):
                     ndim_increment += 1
 
-        # create NDVar
         dims = tuple(dim for dim in dims if dim is not None)
-        return NDVar(self.x[tuple(index)], dims, info, var_name)
+        return tuple(index), dims, info
 
     def subdata(self, **kwargs):
         "Deprecated. Use .sub() method (with identical functionality)."
@@ -4503,9 +4972,9 @@ class Dataset(OrderedDict):
 
         ds = Dataset(name=name.format(name=self.name), info=self.info)
 
+        groups = _cell_groups(X)
         if count:
-            x = filter(None, (np.sum(X == cell) for cell in X.cells))
-            ds[count] = Var(x)
+            ds[count] = Var(groups.counts[groups.nonempty()])
 
         for k, v in self.iteritems():
             if k in drop:
@@ -4516,11 +4985,8 @@ class Dataset(OrderedDict):
                 else:
                     from mne import Epochs
                     if isinstance(v, Epochs):
-                        evokeds = []
-                        for cell in X.cells:
-                            idx = (X == cell)
-                            if idx.sum():
-                                evokeds.append(v[idx].average())
+                        evokeds = [v[groups.cell_index(i)].average() for i
+                                   in groups.nonempty()]
                         ds[k] = evokeds
                     else:
                         err = ("Unsupported value type: %s" % type(v))
@@ -4560,11 +5026,11 @@ class Dataset(OrderedDict):
         """
         X = ascategorial(X, ds=self)
         self._check_n_cases(X, empty_ok=False)
-        indexes = np.array([X == cell for cell in X.cells])
-        n = indexes.sum(1).min()
-        for index in indexes:
-            np.logical_and(index, index.cumsum() <= n, index)
-        index = indexes.any(0)
+        groups = _cell_groups(X)
+        n = groups.counts.min()
+        index = np.concatenate([groups.cell_index(i)[:n] for i in
+                                xrange(len(groups.cells))])
+        index.sort()
         return self[index]
 
     def index(self, name='index', start=0):
@@ -5054,6 +5520,7 @@ class Interaction(_Effect):
         self.cell_header = tuple(f.name for f in factors)
 
         self.beta_labels = ['?'] * self.df  # TODO:
+        self._cell_groups = None
 
     def __repr__(self):
         names = [UNNAMED if f.name is None else f.name for f in self.base]
@@ -5090,6 +5557,8 @@ class Interaction(_Effect):
             x = np.vstack((b == bo for b, bo in izip(self.base, other.base)))
             return np.all(x, 0)
         elif isinstance(other, tuple) and len(other) == len(self.base):
+            if all(isfactor(f) for f in self.base):
+                return self._get_cell_groups().mask_for(other)
             x = np.vstack(factor == level for factor, level in izip(self.base, other))
             return np.all(x, 0)
         else:
@@ -5688,28 +6157,96 @@ def find_time_point(times, time, rnd='closest'):
     return i, time
 
 
-def _subgraph_edges(connectivity, int_index):
-    "Extract connectivity for a subset of a graph"
-    if connectivity is None:
-        return None
+class Adjacency(object):
+    """Graph of neighboring elements along a non-adjacent dimension
 
-    idx = np.logical_and(np.in1d(connectivity[:, 0], int_index),
-                         np.in1d(connectivity[:, 1], int_index))
-    if np.any(idx):
-        new_c = connectivity[idx]
+    Parameters
+    ----------
+    edges : array of int (n_edges, 2)
+        Edges of the graph, each listed once (e.g., as sorted ``[src, dst]``
+        pairs with ``src < dst``).
+    n_vertices : int
+        Number of vertices.
 
-        # remap to new vertex indices
-        if np.any(np.diff(int_index) < 1):  # non-monotonic index
-            argsort = np.argsort(int_index)
-            flat_conn_ = np.digitize(new_c.ravel(), int_index[argsort], True)
-            flat_conn = argsort[flat_conn_]
-        else:
-            flat_conn = np.digitize(new_c.ravel(), int_index, True)
+    Attributes
+    ----------
+    edges : array of uint32 (n_edges, 2)
+        Edges of the graph.
+    indptr, indices : array of int
+        Neighbors in compressed sparse row format: the neighbors of vertex
+        ``i`` are ``indices[indptr[i]:indptr[i + 1]]``.
+    degree : array of int
+        Number of neighbors of each vertex.
+    """
+    def __init__(self, edges, n_vertices):
+        edges = np.asarray(edges, np.uint32).reshape((-1, 2))
+        # list each edge in both directions, but self-loops only once
+        reverse = edges[edges[:, 0] != edges[:, 1]]
+        src = np.concatenate((edges[:, 0], reverse[:, 1])).astype(np.intp)
+        dst = np.concatenate((edges[:, 1], reverse[:, 0])).astype(np.intp)
+        index = np.argsort(src, kind='mergesort')
+        self.edges = edges
+        self.n_vertices = n_vertices
+        self.indptr = np.searchsorted(src[index], np.arange(n_vertices + 1))
+        self.indices = dst[index]
+        self.degree = np.diff(self.indptr)
 
-        return flat_conn.reshape(new_c.shape).astype(np.uint32)
-    else:
+    def __repr__(self):
+        return "<Adjacency: %i vertices, %i edges>" % (self.n_vertices,
+                                                       len(self.edges))
+
+    def __eq__(self, other):
+        return (isinstance(other, Adjacency) and
+                self.n_vertices == other.n_vertices and
+                np.array_equal(self.edges, other.edges))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def neighbors(self, i):
+        "Neighbors of vertex ``i``"
+        return self.indices[self.indptr[i]:self.indptr[i + 1]]
+
+    def subgraph(self, int_index):
+        """Graph for a subset of the vertices
+
+        Parameters
+        ----------
+        int_index : array of int
+            Vertices to keep; vertex ``int_index[i]`` becomes vertex ``i``.
+        """
+        edges = _subgraph_edges(self.edges, int_index, self.n_vertices)
+        return Adjacency(edges, len(int_index))
+
+    def disconnect(self, labels):
+        """Graph without edges between vertices with different labels
+
+        Parameters
+        ----------
+        labels : array_like (n_vertices,)
+            Label for each vertex (e.g., a parcellation).
+        """
+        labels = np.asarray(labels)
+        index = labels[self.edges[:, 0]] == labels[self.edges[:, 1]]
+        return Adjacency(self.edges[index], self.n_vertices)
+
+
+def _subgraph_edges(connectivity, int_index, n_vertices=None):
+    "Extract connectivity for a subset of a graph"
+    if connectivity is None:
+        return None
+    elif len(connectivity) == 0 or len(int_index) == 0:
         return np.empty((0, 2), dtype=np.uint32)
 
+    # new index for each old vertex (-1 for removed vertices)
+    if n_vertices is None:
+        n_vertices = max(connectivity.max(), int_index.max()) + 1
+    new_index = np.empty(n_vertices, np.intp)
+    new_index.fill(-1)
+    new_index[int_index] = np.arange(len(int_index))
+    new_c = new_index[connectivity]
+    return new_c[np.all(new_c >= 0, 1)].astype(np.uint32)
+
 
 class Dimension(object):
     """
@@ -5743,6 +6280,19 @@ class Dimension(object):
         """
         raise NotImplementedError
 
+    def _adjacency(self, disconnect_parc=False):
+        """Graph of neighboring elements for non-adjacent dimensions
+
+        Returns
+        -------
+        adjacency : None | Adjacency
+            None for adjacent dimensions (neighbors are the preceding and
+            following elements).
+        """
+        if self.adjacent:
+            return None
+        raise NotImplementedError
+
     def _diminfo(self):
         "Return a str describing the dimension in on line (79 chars)"
         return str(self.name)
@@ -6068,6 +6618,7 @@ class Sensor(Dimension):
         self.sysname = sysname
         self.default_proj2d = proj2d
         self._connectivity = connectivity
+        self._adjacency_cache = None
 
         # 'z root' transformation fails with 32-bit floats
         self.locs = locs = np.asarray(locs, dtype=np.float64)
@@ -6136,8 +6687,12 @@ class Sensor(Dimension):
             locs = self.locs[index]
             names = self.names[index]
             # TODO: groups
+            if self._connectivity is None:
+                connectivity = None
+            else:
+                connectivity = self._adjacency().subgraph(int_index).edges
             return Sensor(locs, names, None, self.sysname, self.default_proj2d,
-                          _subgraph_edges(self._connectivity, int_index))
+                          connectivity)
 
     def _cluster_properties(self, x):
         """Find cluster properties for this dimension
@@ -6179,6 +6734,12 @@ class Sensor(Dimension):
         else:
             return int(name)
 
+    def _adjacency(self, disconnect_parc=False):
+        "Sensor connectivity as :class:`Adjacency` (cached)"
+        if self._adjacency_cache is None:
+            self._adjacency_cache = Adjacency(self.connectivity(), len(self))
+        return self._adjacency_cache
+
     def connectivity(self):
         """Retrieve the sensor connectivity
 
@@ -6562,6 +7123,7 @@ class Sensor(Dimension):
                         pairs.add((v, k))
 
         self._connectivity = np.array(sorted(pairs), np.uint32)
+        self._adjacency_cache = None
 
     def set_sensor_positions(self, pos, names=None):
         """Set the sensor positions
@@ -6733,6 +7295,7 @@ class SourceSpace(Dimension):
         self.grade = grade
         self.subjects_dir = subjects_dir
         self._connectivity = connectivity
+        self._adjacency_cache = {}
         self._n_vert = sum(len(v) for v in vertno)
         if kind == 'ico':
             self.lh_vertno = vertno[0]
@@ -6786,8 +7349,12 @@ class SourceSpace(Dimension):
         else:
             parc = self.parc[index]
 
+        if self._connectivity is None:
+            connectivity = None
+        else:
+            connectivity = self._adjacency().subgraph(int_index).edges
         dim = SourceSpace(vertno, self.subject, self.src, self.subjects_dir,
-                          parc, _subgraph_edges(self._connectivity, int_index))
+                          parc, connectivity)
         return dim
 
     def _cluster_properties(self, x):
@@ -6866,6 +7433,27 @@ class SourceSpace(Dimension):
         connetivity : array of int, (n_pairs, 2)
             array of sorted [src, dst] pairs, with all src < dts.
         """
+        return self._adjacency(disconnect_parc).edges
+
+    def _adjacency(self, disconnect_parc=False):
+        """Source space connectivity as :class:`Adjacency` (cached)
+
+        Parameters
+        ----------
+        disconnect_parc : bool
+            Reduce connectivity to label-internal connections.
+        """
+        if disconnect_parc in self._adjacency_cache:
+            return self._adjacency_cache[disconnect_parc]
+        elif disconnect_parc:
+            parc = self.parc
+            if parc is None:
+                raise RuntimeError("SourceSpace has no parcellation (use "
+                                   ".set_parc())")
+            adjacency = self._adjacency().disconnect(parc.x)
+            self._adjacency_cache[disconnect_parc] = adjacency
+            return adjacency
+
         if self._connectivity is None:
             if any(x is None for x in (self.src, self.subject, self.subjects_dir)):
                 err = ("In order for a SourceSpace dimension to provide "
@@ -6887,18 +7475,10 @@ class SourceSpace(Dimension):
             if connectivity.max() >= len(self):
                 raise RuntimeError("SourceSpace connectivity failed")
             self._connectivity = connectivity
-        else:
-            connectivity = self._connectivity
 
-        if disconnect_parc:
-            parc = self.parc
-            if parc is None:
-                raise RuntimeError("SourceSpace has no parcellation (use "
-                                   ".set_parc())")
-            idx = np.array([parc[s] == parc[d] for s, d in connectivity])
-            connectivity = connectivity[idx]
-
-        return connectivity
+        adjacency = Adjacency(self._connectivity, len(self))
+        self._adjacency_cache[disconnect_parc] = adjacency
+        return adjacency
 
     def circular_index(self, seeds, extent=0.05, name="globe"):
         """Returns an index into all vertices within extent of seed
@@ -7097,6 +7677,7 @@ class SourceSpace(Dimension):
             raise ValueError("Parc needs to be string, got %s" % repr(parc))
 
         self.parc = parc_
+        self._adjacency_cache.pop(True, None)
 
 
 _uts_tol = 0.000001  # tolerance for deciding if time values are equal
@@ -7434,19 +8015,14 @@ def corr(x, dim='sensor', obs='time', name=None):
         Dimension over which to correlate neighbors.
     """
     dim_obj = x.get_dim(dim)
-
-    # find neighbors
-    neighbors = defaultdict(list)
-    for a, b in dim_obj.connectivity():
-        neighbors[a].append(b)
-        neighbors[b].append(a)
+    adjacency = dim_obj._adjacency()
 
     # for each point, find the average correlation with its neighbors
     data = x.get_data((dim, obs))
     cc = np.corrcoef(data)
-    y = np.empty(len(dim_obj))
-    for i in xrange(len(dim_obj)):
-        y[i] = np.mean(cc[i, neighbors[i]])
+    rows = np.repeat(np.arange(len(dim_obj)), adjacency.degree)
+    y = np.bincount(rows, cc[rows, adjacency.indices], len(dim_obj))
+    y /= adjacency.degree
 
     info = cs.set_info_cs(x.info, cs.stat_info('r'))
     return NDVar(y, (dim_obj,), info, name)
@@ -40,6 +40,10 @@ from . import test
 # (0) Use scipy.linalg.lstsq
 # (1) Use lstsq after Fox (2008) with caching of the model transformation
 _lm_lsq = 0  # for the LM class
+# Implementation of balanced ND-ANOVA maps: 'gemm' (all tests at once through
+# matrix products) or 'kernel' (opt.anova_fmaps/anova_full_fmaps, one test at
+# a time)
+_nd_anova_backend = 'gemm'
 
 
 
@@ -363,21 +367,21 @@ class LM(object):
         return self.Y.x - Y_est
 
 
-def _nd_anova(x):
+def _nd_anova(x, backend=None):
     "Create an appropriate anova mapper"
     x = asmodel(x)
     if hasemptycells(x):
         raise NotImplementedError("Model has empty cells")
     elif x.df_error == 0:
-        return _FullNDANOVA(x)
+        return _FullNDANOVA(x, backend)
     elif hasrandom(x):
         err = ("Models containing random effects need to be fully "
                "specified.")
         raise NotImplementedError(err)
     elif isbalanced(x):
-        return _BalancedFixedNDANOVA(x)
+        return _BalancedFixedNDANOVA(x, backend)
     else:
-        return _IncrementalNDANOVA(x)
+        return _IncrementalNDANOVA(x, backend)
 
 
 class _NDANOVA(object):
@@ -392,6 +396,8 @@ class _NDANOVA(object):
         self.dfs_nom = [e.df for e in effects]
         self.dfs_denom = dfs_denom
         self._flat_f_map = None
+        self._y = None
+        self._y_ss = None
 
     def __repr__(self):
         return '%s(%s)' % (self.__class__.__name__, self.x.name)
@@ -438,6 +444,17 @@ class _NDANOVA(object):
     def _map(self, y, flat_f_map, perm):
         raise NotImplementedError
 
+    def _ss(self, y, perm):
+        """Sum of squares of y
+
+        Permutations are applied to the model, so for permuted maps of the
+        same y the value from the previous call is reused.
+        """
+        if perm is None or y is not self._y:
+            self._y_ss = np.einsum('ij,ij->j', y, y, dtype=np.float64)
+            self._y = y
+        return self._y_ss
+
     def p_maps(self, f_maps):
         """Convert F-maps for uncorrected p-maps
 
@@ -478,15 +495,36 @@ class _NDANOVA(object):
 
 
 class _BalancedNDANOVA(_NDANOVA):
-    "For balanced but not fully specified models"
-    def __init__(self, x,  effects, dfs_denom):
+    """For balanced models
+
+    With the ``'gemm'`` backend, the betas for all tests are computed as one
+    matrix product. Since permuting the model only permutes the rows of
+    ``x.full``, the cross-products ``x.full.T * x.full`` that determine the
+    sum of squares of each effect and of the whole model are permutation
+    invariant, and so is ``sum(y ** 2)``.
+    """
+    def __init__(self, x,  effects, dfs_denom, backend=None):
         _NDANOVA.__init__(self, x, effects, dfs_denom)
 
+        if backend is None:
+            backend = _nd_anova_backend
+        elif backend not in ('gemm', 'kernel'):
+            raise ValueError("backend=%s" % repr(backend))
+        self._backend = backend
         self._effect_to_beta = x._effect_to_beta
         self._x_full_perm = None
         self._xsinv_perm = None
 
+        if backend == 'gemm':
+            self._xtx = x.full.T.dot(x.full)
+            self._effect_xtx = [self._xtx[i:i + df, i:i + df] for i, df in
+                                self._effect_to_beta]
+
     def _map(self, y, flat_f_map, perm):
+        if self._backend == 'gemm':
+            self._map_gemm(y, flat_f_map, perm)
+            return
+
         x = self.x
         if perm is None:
             x_full = x.full
@@ -506,13 +544,35 @@ class _BalancedNDANOVA(_NDANOVA):
     def _map_balanced(self, y, flat_f_map, x_full, xsinv):
         raise NotImplementedError
 
+    def _map_gemm(self, y, flat_f_map, perm):
+        if perm is None:
+            xsinv = self.x.xsinv
+        else:
+            if self._xsinv_perm is None:
+                self._xsinv_perm = np.empty_like(self.x.xsinv)
+            xsinv = self.x.xsinv.take(perm, 1, self._xsinv_perm)
+        if y.dtype == np.float32:
+            xsinv = xsinv.astype(np.float32)
+
+        betas = np.dot(xsinv, y)
+        ms = np.empty((len(self._effect_to_beta), y.shape[1]))
+        for i, ((i_beta, df), xtx) in enumerate(izip(self._effect_to_beta,
+                                                     self._effect_xtx)):
+            b = betas[i_beta:i_beta + df]
+            ms[i] = np.einsum('ij,ij->j', np.dot(xtx, b), b)
+            ms[i] /= df
+        self._f_maps(y, perm, betas, ms, flat_f_map)
+
+    def _f_maps(self, y, perm, betas, ms, flat_f_map):
+        raise NotImplementedError
+
 
 class _BalancedFixedNDANOVA(_BalancedNDANOVA):
     "For balanced but not fully specified models"
-    def __init__(self, x):
+    def __init__(self, x, backend=None):
         effects = x.effects
         dfs_denom = (x.df_error,) * len(effects)
-        _BalancedNDANOVA.__init__(self, x, effects, dfs_denom)
+        _BalancedNDANOVA.__init__(self, x, effects, dfs_denom, backend)
 
         self.df_error = x.df_error
 
@@ -520,12 +580,19 @@ class _BalancedFixedNDANOVA(_BalancedNDANOVA):
         anova_fmaps(y, x_full, xsinv, flat_f_map, self._effect_to_beta,
                     self.df_error)
 
+    def _f_maps(self, y, perm, betas, ms, flat_f_map):
+        # residual SS = SS(y) - SS(model)
+        ss_model = np.einsum('ij,ij->j', np.dot(self._xtx, betas), betas)
+        ms_res = self._ss(y, perm) - ss_model
+        ms_res /= self.df_error
+        np.divide(ms, ms_res, flat_f_map)
+
 
 class _FullNDANOVA(_BalancedNDANOVA):
     """for balanced models.
     E(MS) for F statistic after Hopkins (1976)
     """
-    def __init__(self, x):
+    def __init__(self, x, backend=None):
         """
         Object for efficiently fitting a model to multiple dependent variables.
 
@@ -533,26 +600,41 @@ class _FullNDANOVA(_BalancedNDANOVA):
         ----------
         x : Model
             Model which will be fitted to the data.
-        y_shape : None | tuple
-            Data shape (if known) will allow preallocation of containers for
-            intermediate results.
+        backend : None | 'gemm' | 'kernel'
+            Implementation (default is the module-level setting).
         """
         e_ms = hopkins_ems(x)
         df_den = {e: sum(e_.df for e_ in e_ms[e]) for e in x.effects}
         effects = tuple(e for e in x.effects if df_den[e])
         dfs_denom = [df_den[e] for e in effects]
-        _BalancedNDANOVA.__init__(self, x, effects, dfs_denom)
+        _BalancedNDANOVA.__init__(self, x, effects, dfs_denom, backend)
 
         self.e_ms = e_ms
-        self._e_ms_array = _hopkins_ems_array(x)
+        self._e_ms_array = e_ms_array = _hopkins_ems_array(x)
+        # sum the MS of the E(MS) components for the effects that are tested
+        denom = e_ms_array > 0
+        self._ms_denom = denom[denom.any(1)].astype(np.float64)
+        self._tested = np.flatnonzero(denom.any(1))
 
     def _map_balanced(self, y, flat_f_map, x_full, xsinv):
         anova_full_fmaps(y, x_full, xsinv, flat_f_map, self._effect_to_beta,
                          self._e_ms_array)
 
+    def _f_maps(self, y, perm, betas, ms, flat_f_map):
+        ms_denom = np.dot(self._ms_denom, ms)
+        np.divide(ms[self._tested], ms_denom, flat_f_map)
+
 
 class _IncrementalNDANOVA(_NDANOVA):
-    def __init__(self, x):
+    """For unbalanced models (incremental model comparisons)
+
+    With the ``'gemm'`` backend, each nested model is represented by an
+    orthonormal basis of its column space expressed in an orthonormal basis
+    ``q`` of the full model (all nested models span subspaces of the full
+    model). The model SS of all nested models then follow from a single
+    projection ``q.T * y``, and permutations only permute the rows of ``q``.
+    """
+    def __init__(self, x, backend=None):
         if hasrandom(x):
             raise NotImplementedError("Models containing random effects")
         comparisons, models, skipped = _incremental_comparisons(x)
@@ -560,6 +642,25 @@ class _IncrementalNDANOVA(_NDANOVA):
         dfs_denom = (x.df_error,) * len(effects)
         _NDANOVA.__init__(self, x, effects, dfs_denom)
 
+        if backend is None:
+            backend = _nd_anova_backend
+        elif backend not in ('gemm', 'kernel'):
+            raise ValueError("backend=%s" % repr(backend))
+        self._backend = backend
+        if backend == 'gemm':
+            q = np.linalg.qr(x.full)[0]
+            self._q = q
+            self._q_perm = None
+            self._bases = {}
+            for i, model in models.iteritems():
+                if i == 0:
+                    continue
+                elif model is None:
+                    x_i = np.ones((len(x), 1))
+                else:
+                    x_i = model.full
+                self._bases[i] = np.dot(np.linalg.qr(x_i)[0].T, q)
+
         self._comparisons = comparisons
         self._models = models
         self._skipped = skipped
@@ -587,6 +688,10 @@ class _IncrementalNDANOVA(_NDANOVA):
         return f_map
 
     def _map(self, y, flat_f_map, perm):
+        if self._backend == 'gemm':
+            self._map_gemm(y, flat_f_map, perm)
+            return
+
         if self._SS_diff is None:
             shape = y.shape[1]
             SS_diff = MS_diff = np.empty(shape)
@@ -634,6 +739,31 @@ class _IncrementalNDANOVA(_NDANOVA):
             np.divide(SS_diff, e.df, MS_diff)
             np.divide(MS_diff, MS_e, flat_f_map[i])
 
+    def _map_gemm(self, y, flat_f_map, perm):
+        if perm is None:
+            q = self._q
+        else:
+            if self._q_perm is None:
+                self._q_perm = np.empty_like(self._q)
+            q = self._q.take(perm, 0, self._q_perm)
+        if y.dtype == np.float32:
+            q = q.astype(np.float32)
+
+        # model SS of each nested model
+        u = np.dot(q.T, y)
+        ss_model = {0: np.einsum('ij,ij->j', u, u, dtype=np.float64)}
+        for i, basis in self._bases.iteritems():
+            v = np.dot(basis, u)
+            ss_model[i] = np.einsum('ij,ij->j', v, v, dtype=np.float64)
+
+        # incremental comparisons
+        ms_e = self._ss(y, perm) - ss_model[0]
+        ms_e /= self.x.df_error
+        for i, (e, i1, i0) in enumerate(self._comparisons):
+            ms_diff = ss_model[i1] - ss_model[i0]
+            ms_diff /= e.df
+            np.divide(ms_diff, ms_e, flat_f_map[i])
+
 
 def _incremental_comparisons(x):
     """
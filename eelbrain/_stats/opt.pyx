@@ -3,6 +3,7 @@
 
 cimport cython
 from cython.view cimport array as cvarray
+from libc.math cimport pow, sqrt
 from libc.stdlib cimport malloc, free
 import numpy as np
 cimport numpy as np
@@ -103,6 +104,425 @@ def merge_labels(unsigned int [:,:] cmap, int n_labels_in,
     return out
 
 
+cdef inline Py_ssize_t _find_root(Py_ssize_t* parent, Py_ssize_t i) nogil:
+    # find the root of i, halving the path on the way
+    while parent[i] != i:
+        parent[i] = parent[parent[i]]
+        i = parent[i]
+    return i
+
+
+cdef inline void _join(Py_ssize_t* parent, Py_ssize_t i, Py_ssize_t j) nogil:
+    # join the trees of i and j; the lowest index becomes the root
+    i = _find_root(parent, i)
+    j = _find_root(parent, j)
+    if i < j:
+        parent[j] = i
+    elif j < i:
+        parent[i] = j
+
+
+@cython.cdivision(True)
+def label_clusters(np.uint8_t[:] bin_map, tuple shape, unsigned int [:,:] edges,
+                   NP_UINT32[:] cmap, Py_ssize_t offset=0,
+                   double[:] values=None, criteria_axes=()):
+    """Label clusters in a single sweep over a flattened binary map
+
+    Parameters
+    ----------
+    bin_map : array of uint8, ndim=1
+        Binary map, flattened in C order.
+    shape : tuple of int
+        Shape of the binary map.
+    edges : None | array of int (n_edges, 2)
+        Edges of the connectivity graph along the first axis. If None, the
+        first axis is treated as a line graph like all other axes.
+    cmap : array of uint32, ndim=1
+        Flat array in which to label the clusters. Clusters are numbered
+        consecutively starting from ``offset + 1`` in the order of their first
+        element; elements outside of clusters are not modified.
+    offset : int
+        Offset for the cluster labels.
+    values : None | array of float, ndim=1
+        Values to sum within each cluster (default is to count elements).
+    criteria_axes : sequence of int
+        Axes along which to determine the extent of each cluster.
+
+    Returns
+    -------
+    n_clusters : int
+        Number of clusters.
+    sums : array of float (n_clusters,)
+        Sum of ``values`` (or number of elements) in each cluster.
+    extents : array of int (n_criteria, n_clusters)
+        Number of indexes along each of ``criteria_axes`` that each cluster
+        covers.
+    origins : array of int (n_clusters,)
+        Flat index of the first element of each cluster.
+    """
+    cdef Py_ssize_t n = bin_map.shape[0]
+    cdef Py_ssize_t ndim = len(shape)
+    cdef Py_ssize_t n_crit = len(criteria_axes)
+    cdef Py_ssize_t i, j, k, c, ax, coord, src, dst, root
+    cdef Py_ssize_t n_slice, n_edges, first_ax
+    cdef Py_ssize_t n_set = 0
+    cdef Py_ssize_t n_clusters = 0
+    cdef bint has_values = values is not None
+    cdef Py_ssize_t [:] dims = np.array(shape, np.intp)
+    cdef Py_ssize_t [:] strides = np.empty(ndim, np.intp)
+    cdef Py_ssize_t [:] crit = np.array(criteria_axes, np.intp)
+
+    if edges is None:
+        first_ax = 0
+        n_edges = 0
+    else:
+        first_ax = 1
+        n_edges = edges.shape[0]
+
+    strides[ndim - 1] = 1
+    for ax in range(ndim - 1, 0, -1):
+        strides[ax - 1] = strides[ax] * dims[ax]
+    n_slice = strides[0]
+
+    cdef Py_ssize_t* parent = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * n)
+
+    # join each element with its predecessors along the line-graph axes
+    with nogil:
+        for i in range(n):
+            if not bin_map[i]:
+                continue
+            n_set += 1
+            parent[i] = i
+            for ax in range(first_ax, ndim):
+                coord = (i / strides[ax]) % dims[ax]
+                if coord > 0 and bin_map[i - strides[ax]]:
+                    _join(parent, i, i - strides[ax])
+
+        # join elements connected through the graph on the first axis
+        for k in range(n_edges):
+            src = edges[k, 0] * n_slice
+            dst = edges[k, 1] * n_slice
+            for j in range(n_slice):
+                if bin_map[src + j] and bin_map[dst + j]:
+                    _join(parent, src + j, dst + j)
+
+    # label clusters and collect their properties
+    sums_a = np.zeros(n_set)
+    origins_a = np.empty(n_set, np.intp)
+    lo_a = np.empty((n_crit, n_set), np.intp)
+    hi_a = np.empty((n_crit, n_set), np.intp)
+    cdef double [:] sums = sums_a
+    cdef Py_ssize_t [:] origins = origins_a
+    cdef Py_ssize_t [:,:] lo = lo_a
+    cdef Py_ssize_t [:,:] hi = hi_a
+
+    with nogil:
+        for i in range(n):
+            if not bin_map[i]:
+                continue
+            root = _find_root(parent, i)
+            if root == i:
+                k = n_clusters
+                n_clusters += 1
+                cmap[i] = offset + n_clusters
+                origins[k] = i
+                for c in range(n_crit):
+                    coord = (i / strides[crit[c]]) % dims[crit[c]]
+                    if crit[c] == 0:
+                        # first axis is outermost: count distinct indexes
+                        lo[c, k] = coord
+                        hi[c, k] = 1
+                    else:
+                        # projection on a line-graph axis is contiguous
+                        lo[c, k] = coord
+                        hi[c, k] = coord
+            else:
+                cmap[i] = cmap[root]
+                k = <Py_ssize_t> cmap[root] - offset - 1
+                for c in range(n_crit):
+                    coord = (i / strides[crit[c]]) % dims[crit[c]]
+                    if crit[c] == 0:
+                        if lo[c, k] != coord:
+                            lo[c, k] = coord
+                            hi[c, k] += 1
+                    elif coord < lo[c, k]:
+                        lo[c, k] = coord
+                    elif coord > hi[c, k]:
+                        hi[c, k] = coord
+
+            if has_values:
+                sums[k] += values[i]
+            else:
+                sums[k] += 1
+
+    free(parent)
+
+    extents = np.empty((n_crit, n_clusters), np.intp)
+    for c in range(n_crit):
+        if crit[c] == 0:
+            extents[c] = hi_a[c, :n_clusters]
+        else:
+            extents[c] = hi_a[c, :n_clusters] - lo_a[c, :n_clusters] + 1
+    return n_clusters, sums_a[:n_clusters], extents, origins_a[:n_clusters]
+
+
+cdef inline Py_ssize_t _find_root_offset(Py_ssize_t* parent, double* offset,
+                                         Py_ssize_t i) nogil:
+    # find the root of i and compress the path, keeping each node's value
+    # (the sum of offsets up to the root) constant
+    cdef Py_ssize_t root = i
+    cdef Py_ssize_t next_i
+    cdef double total = 0
+    cdef double old
+    while parent[root] != root:
+        total += offset[root]
+        root = parent[root]
+    while i != root:
+        next_i = parent[i]
+        old = offset[i]
+        offset[i] = total
+        parent[i] = root
+        total -= old
+        i = next_i
+    return root
+
+
+cdef inline void _tfce_flush(Py_ssize_t* size, Py_ssize_t* start, double* offset,
+                             double* cum_weight, double e, Py_ssize_t root,
+                             Py_ssize_t k) nogil:
+    # add the enhancement for heights start[root]...k-1 to a cluster
+    offset[root] += pow(size[root], e) * (cum_weight[k] - cum_weight[start[root]])
+    start[root] = k
+
+
+cdef inline Py_ssize_t _tfce_join(Py_ssize_t* parent, Py_ssize_t* size,
+                                  Py_ssize_t* start, double* offset,
+                                  double* cum_weight, double e, Py_ssize_t root,
+                                  Py_ssize_t j, Py_ssize_t k) nogil:
+    # join the cluster of root with the cluster of element j (if j is active)
+    cdef Py_ssize_t root_j, tmp
+    if parent[j] < 0:
+        return root
+    root_j = _find_root_offset(parent, offset, j)
+    if root_j == root:
+        return root
+    _tfce_flush(size, start, offset, cum_weight, e, root, k)
+    _tfce_flush(size, start, offset, cum_weight, e, root_j, k)
+    if size[root] < size[root_j]:
+        tmp = root
+        root = root_j
+        root_j = tmp
+    parent[root_j] = root
+    offset[root_j] -= offset[root]
+    size[root] += size[root_j]
+    return root
+
+
+@cython.cdivision(True)
+def tfce_increment(double[:] values, Py_ssize_t[:] order, double[:] heights,
+                   double[:] weights, double e, tuple shape,
+                   Py_ssize_t[:] indptr, Py_ssize_t[:] indices, double[:] out):
+    """Threshold-free cluster enhancement with incremental cluster merging
+
+    Elements are added in order of descending value while the threshold is
+    lowered through ``heights``; clusters only ever merge, so each element
+    and each merge is processed exactly once.
+
+    Parameters
+    ----------
+    values : array of float, ndim=1
+        Flattened (C order) statistical map.
+    order : array of int
+        Flat indexes of all elements with ``values >= heights[-1]``, sorted by
+        descending value.
+    heights : array of float
+        Thresholds in descending order.
+    weights : array of float
+        Height weight for each threshold (``heights ** h``).
+    e : float
+        Cluster extent exponent.
+    shape : tuple of int
+        Shape of the map.
+    indptr, indices : None | array of int
+        Neighbors along the first axis in compressed sparse row format. If
+        None, the first axis is treated as a line graph like all other axes.
+    out : array of float, ndim=1
+        Flat output array; only the elements in ``order`` are assigned.
+    """
+    cdef Py_ssize_t n = values.shape[0]
+    cdef Py_ssize_t n_order = order.shape[0]
+    cdef Py_ssize_t n_heights = heights.shape[0]
+    cdef Py_ssize_t ndim = len(shape)
+    cdef Py_ssize_t i, j, k, t, ax, coord, root, vertex
+    cdef Py_ssize_t n_slice, first_ax
+    cdef Py_ssize_t i_order = 0
+    cdef bint has_graph = indptr is not None
+    cdef Py_ssize_t [:] dims = np.array(shape, np.intp)
+    cdef Py_ssize_t [:] strides = np.empty(ndim, np.intp)
+
+    first_ax = 1 if has_graph else 0
+    strides[ndim - 1] = 1
+    for ax in range(ndim - 1, 0, -1):
+        strides[ax - 1] = strides[ax] * dims[ax]
+    n_slice = strides[0]
+
+    cdef Py_ssize_t* parent = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * n)
+    cdef Py_ssize_t* size = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * n)
+    cdef Py_ssize_t* start = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * n)
+    cdef double* offset = <double*> malloc(sizeof(double) * n)
+    cdef double* cum_weight = <double*> malloc(sizeof(double) * (n_heights + 1))
+
+    with nogil:
+        for i in range(n):
+            parent[i] = -1
+        cum_weight[0] = 0
+        for k in range(n_heights):
+            cum_weight[k + 1] = cum_weight[k] + weights[k]
+
+        for k in range(n_heights):
+            while i_order < n_order and values[order[i_order]] >= heights[k]:
+                i = order[i_order]
+                i_order += 1
+                parent[i] = i
+                size[i] = 1
+                start[i] = k
+                offset[i] = 0
+                root = i
+                for ax in range(first_ax, ndim):
+                    coord = (i / strides[ax]) % dims[ax]
+                    if coord > 0:
+                        root = _tfce_join(parent, size, start, offset,
+                                          cum_weight, e, root,
+                                          i - strides[ax], k)
+                    if coord < dims[ax] - 1:
+                        root = _tfce_join(parent, size, start, offset,
+                                          cum_weight, e, root,
+                                          i + strides[ax], k)
+                if has_graph:
+                    vertex = i / n_slice
+                    j = i - vertex * n_slice
+                    for t in range(indptr[vertex], indptr[vertex + 1]):
+                        root = _tfce_join(parent, size, start, offset,
+                                          cum_weight, e, root,
+                                          indices[t] * n_slice + j, k)
+
+        # add remaining enhancement down to the lowest height
+        for t in range(i_order):
+            i = order[t]
+            if parent[i] == i:
+                _tfce_flush(size, start, offset, cum_weight, e, i, n_heights)
+
+        for t in range(i_order):
+            i = order[t]
+            root = _find_root_offset(parent, offset, i)
+            if root == i:
+                out[i] = offset[i]
+            else:
+                out[i] = offset[i] + offset[root]
+
+    free(parent)
+    free(size)
+    free(start)
+    free(offset)
+    free(cum_weight)
+
+
+cdef inline Py_ssize_t _graph_neighbors(
+        Py_ssize_t i, Py_ssize_t ndim, Py_ssize_t first_ax,
+        Py_ssize_t[:] dims, Py_ssize_t[:] strides, Py_ssize_t n_slice,
+        Py_ssize_t[:] indptr, Py_ssize_t[:] indices,
+        Py_ssize_t* out) nogil:
+    # write the neighbors of element i to out and return their number
+    cdef Py_ssize_t ax, coord, t, vertex, j
+    cdef Py_ssize_t n = 0
+    for ax in range(first_ax, ndim):
+        coord = (i / strides[ax]) % dims[ax]
+        if coord > 0:
+            out[n] = i - strides[ax]
+            n += 1
+        if coord < dims[ax] - 1:
+            out[n] = i + strides[ax]
+            n += 1
+    if first_ax:
+        vertex = i / n_slice
+        j = i - vertex * n_slice
+        for t in range(indptr[vertex], indptr[vertex + 1]):
+            out[n] = indices[t] * n_slice + j
+            n += 1
+    return n
+
+
+@cython.cdivision(True)
+def find_peaks(double[:] values, tuple shape, Py_ssize_t[:] indptr,
+               Py_ssize_t[:] indices, np.uint8_t[:] out):
+    """Find local maxima, including plateaus
+
+    An element is a peak if no element of its plateau (the connected elements
+    with the same value) has a neighbor with a larger value. Elements outside
+    the map are treated as lower than all elements.
+
+    Parameters
+    ----------
+    values : array of float, ndim=1
+        Flattened (C order) map.
+    shape : tuple of int
+        Shape of the map.
+    indptr, indices : None | array of int
+        Neighbors along the first axis in compressed sparse row format. If
+        None, the first axis is treated as a line graph like all other axes.
+    out : array of uint8, ndim=1
+        Flat output array (1 for peaks, 0 elsewhere).
+    """
+    cdef Py_ssize_t n = values.shape[0]
+    cdef Py_ssize_t ndim = len(shape)
+    cdef Py_ssize_t i, j, k, ax, n_slice, first_ax, n_neighbors
+    cdef Py_ssize_t n_stack = 0
+    cdef Py_ssize_t max_neighbors = 2 * ndim
+    cdef bint has_graph = indptr is not None
+    cdef Py_ssize_t [:] dims = np.array(shape, np.intp)
+    cdef Py_ssize_t [:] strides = np.empty(ndim, np.intp)
+
+    first_ax = 1 if has_graph else 0
+    strides[ndim - 1] = 1
+    for ax in range(ndim - 1, 0, -1):
+        strides[ax - 1] = strides[ax] * dims[ax]
+    n_slice = strides[0]
+    if has_graph and indptr.shape[0] > 1:
+        max_neighbors += np.max(np.diff(indptr))
+
+    cdef Py_ssize_t* stack = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * n)
+    cdef Py_ssize_t* neighbors = <Py_ssize_t*> malloc(sizeof(Py_ssize_t) * max_neighbors)
+
+    with nogil:
+        # elements with a larger neighbor
+        for i in range(n):
+            out[i] = 1
+            n_neighbors = _graph_neighbors(i, ndim, first_ax, dims, strides,
+                                           n_slice, indptr, indices, neighbors)
+            for k in range(n_neighbors):
+                if values[neighbors[k]] > values[i]:
+                    out[i] = 0
+                    stack[n_stack] = i
+                    n_stack += 1
+                    break
+
+        # extend to the rest of their plateaus
+        while n_stack > 0:
+            n_stack -= 1
+            i = stack[n_stack]
+            n_neighbors = _graph_neighbors(i, ndim, first_ax, dims, strides,
+                                           n_slice, indptr, indices, neighbors)
+            for k in range(n_neighbors):
+                j = neighbors[k]
+                if out[j] and values[j] == values[i]:
+                    out[j] = 0
+                    stack[n_stack] = j
+                    n_stack += 1
+
+    free(stack)
+    free(neighbors)
+
+
 def anova_full_fmaps(scalar[:, :] y, double[:, :] x, double[:, :] xsinv,
                      double[:, :] f_map, np.int16_t[:, :] effects, 
                      np.int8_t[:, :] e_ms):
@@ -477,6 +897,57 @@ def lm_t(scalar[:,:] y, double[:,:] x, double[:,:] xsinv, double[:] a, double[:,
     free(betas)
 
 
+def t_ind_perm_block(scalar[:,:] y, double[:,:] out, perms, unsigned int n1,
+                     double[:] sum_y, double[:] sum_sq):
+    """T-values for independent samples t-test for a block of permutations
+
+    Parameters
+    ----------
+    y : array (n_cases, n_tests)
+        Dependent Measurement.
+    out : array (n_perm, n_tests)
+        Container for output.
+    perms : array of int (n_perm, n_cases)
+        Permutation of the cases for each permutation; case ``i`` is in the
+        first group if ``perm[i] < n1``.
+    n1 : int
+        Number of cases in the first group.
+    sum_y : array (n_tests,)
+        Sum of ``y`` over cases.
+    sum_sq : array (n_tests,)
+        Sum of squares of ``y`` (see :func:`sum_square`).
+
+    Notes
+    -----
+    Total sum and sum of squares do not depend on group membership. The sums
+    over the first group for all permutations are computed with a single
+    matrix product, and everything else follows from them (with equal
+    variance assumption).
+    """
+    cdef unsigned long i
+    cdef unsigned int i_perm
+    cdef double s1, s0, ss
+
+    cdef unsigned long n_tests = y.shape[1]
+    cdef unsigned int n_cases = y.shape[0]
+    cdef unsigned int n_perm = out.shape[0]
+    cdef unsigned int n2 = n_cases - n1
+    cdef double var_scale = (1. / n1 + 1. / n2) / (n_cases - 2)
+
+    y_ = np.asarray(y)
+    group_ = np.less(perms, n1).astype(y_.dtype)
+    cdef scalar[:,:] sums = np.dot(group_, y_)
+
+    for i_perm in range(n_perm):
+        for i in range(n_tests):
+            s1 = sums[i_perm, i]
+            s0 = sum_y[i] - s1
+            ss = sum_sq[i] - s1 ** 2 / n1 - s0 ** 2 / n2
+            if ss < 0:
+                ss = 0
+            out[i_perm, i] = (s1 / n1 - s0 / n2) / sqrt(ss * var_scale)
+
+
 def t_1samp(scalar[:,:] y, double[:] out):
     """T-values for 1-sample t-test
 
@@ -545,3 +1016,134 @@ def t_1samp_perm(scalar[:,:] y, double[:] out, np.int8_t[:] sign):
         denom /= div
         denom **= 0.5
         out[i] = mean / denom
+
+
+cdef void _t_1samp_signed(scalar[:,:] y, np.int8_t[:,:] signs,
+                          unsigned int i_perm, double[:] sums, double[:] mean,
+                          double[:] ss, double[:,:] out):
+    """T-values for one sign flip permutation, given the sums
+
+    The variance is computed around the mean, in the same order of operations
+    as :func:`t_1samp_perm`, so that the results are identical.
+    """
+    cdef unsigned long i
+    cdef unsigned int case
+    cdef double sign
+
+    cdef unsigned long n_tests = y.shape[1]
+    cdef unsigned int n_cases = y.shape[0]
+    cdef double div = (n_cases - 1) * n_cases
+
+    for i in range(n_tests):
+        mean[i] = sums[i] / n_cases
+        ss[i] = 0
+    for case in range(n_cases):
+        sign = signs[i_perm, case]
+        for i in range(n_tests):
+            ss[i] += (y[case, i] * sign - mean[i]) ** 2
+    for i in range(n_tests):
+        out[i_perm, i] = mean[i] / (ss[i] / div) ** 0.5
+
+
+cdef void _signed_sums(scalar[:,:] y, np.int8_t[:,:] signs, unsigned int i_perm,
+                       double[:] sums):
+    "Sums over cases for one sign flip permutation (in the order of cases)"
+    cdef unsigned long i
+    cdef unsigned int case
+    cdef double sign
+
+    cdef unsigned long n_tests = y.shape[1]
+    cdef unsigned int n_cases = y.shape[0]
+
+    for i in range(n_tests):
+        sums[i] = 0
+    for case in range(n_cases):
+        sign = signs[i_perm, case]
+        for i in range(n_tests):
+            sums[i] += y[case, i] * sign
+
+
+def t_1samp_perm_block(scalar[:,:] y, double[:,:] out, np.int8_t[:,:] signs):
+    """T-values for 1-sample t-test for a block of sign flip permutations
+
+    Parameters
+    ----------
+    y : array (n_cases, n_tests)
+        Dependent Measurement.
+    out : array (n_perm, n_tests)
+        Container for output.
+    signs : array of int8 (n_perm, n_cases)
+        Sign vector for each permutation.
+
+    Notes
+    -----
+    The results are identical to :func:`t_1samp_perm` for each sign vector
+    (not just equal within rounding error), so that the permutation that flips
+    all signs reproduces the original t-values exactly (with the opposite
+    sign).
+    """
+    cdef unsigned int i_perm
+
+    cdef unsigned long n_tests = y.shape[1]
+    cdef unsigned int n_perm = signs.shape[0]
+    cdef double[:] sums = np.empty(n_tests)
+    cdef double[:] mean = np.empty(n_tests)
+    cdef double[:] ss = np.empty(n_tests)
+
+    for i_perm in range(n_perm):
+        _signed_sums(y, signs, i_perm, sums)
+        _t_1samp_signed(y, signs, i_perm, sums, mean, ss, out)
+
+
+def t_1samp_perm_gray(scalar[:,:] y, double[:,:] out, np.int8_t[:,:] signs):
+    """T-values for 1-sample t-test for a block of Gray code sign flips
+
+    Parameters
+    ----------
+    y : array (n_cases, n_tests)
+        Dependent Measurement.
+    out : array (n_perm, n_tests)
+        Container for output.
+    signs : array of int8 (n_perm, n_cases)
+        Sign vector for each permutation. Successive sign vectors have to
+        differ in exactly one case (e.g., from exhaustive
+        :func:`permute_sign_flip_blocks`).
+
+    Notes
+    -----
+    Only the sums for the first permutation are computed from all cases.
+    Each following sum is derived from the previous one by flipping the sign
+    of the one case that changed, i.e., by adding ``2 * sign * y[case]``.
+    The exception is the permutation that flips all signs: it mirrors the
+    original data, and its sums are computed from all cases as in
+    :func:`t_1samp_perm`, so that its t-values tie exactly with the original
+    t-values. The variance is computed around the mean.
+    """
+    cdef unsigned long i
+    cdef unsigned int i_perm, case, n_flipped
+    cdef double sign
+
+    cdef unsigned long n_tests = y.shape[1]
+    cdef unsigned int n_cases = y.shape[0]
+    cdef unsigned int n_perm = signs.shape[0]
+    cdef double[:] sums = np.empty(n_tests)
+    cdef double[:] mean = np.empty(n_tests)
+    cdef double[:] ss = np.empty(n_tests)
+
+    for i_perm in range(n_perm):
+        n_flipped = 0
+        for case in range(n_cases):
+            if signs[i_perm, case] < 0:
+                n_flipped += 1
+
+        if i_perm == 0 or n_flipped == n_cases:
+            _signed_sums(y, signs, i_perm, sums)
+        else:
+            for case in range(n_cases):
+                if signs[i_perm, case] != signs[i_perm - 1, case]:
+                    break
+            sign = 2 * signs[i_perm, case]
+            for i in range(n_tests):
+                sums[i] += sign * y[case, i]
+
+        _t_1samp_signed(y, signs, i_perm, sums, mean, ss, out)
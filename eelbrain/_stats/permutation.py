@@ -1,6 +1,4 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
-import random
-
 import numpy as np
 
 from .._data_obj import isvar, isndvar
@@ -8,6 +6,9 @@ from .._data_obj import isvar, isndvar
 
 _YIELD_ORIGINAL = 0
 # for testing purposes, yield original order instead of permutations
+_SIGN_BLOCK_SIZE = 1024
+# number of sign flip vectors generated at once (changing it changes the
+# random sequence)
 
 
 def _resample_params(N, samples):
@@ -97,7 +98,7 @@ def permute_order(n, samples=10000, replacement=False, unit=None, seed=0):
         else:
             idx_orig = np.arange(n)
             idx_perm = np.arange(n)
-            unit_idxs = [np.nonzero(unit == cell)[0] for cell in unit.cells]
+            unit_idxs = unit.index_map().values()
             for _ in xrange(samples):
                 for idx_ in unit_idxs:
                     v = idx_orig[idx_]
@@ -117,8 +118,8 @@ def permute_sign_flip(n, samples=10000, seed=0):
         Number of samples to yield. If < 0, all possible permutations are
         performed.
     seed : None | int
-        Seed the random state of the randomization module (:mod:`random`) to
-        make replication possible. None to skip seeding (default 0).
+        Seed for the random state to make replication possible. None to use
+        an unpredictable seed (default 0).
 
     Returns
     -------
@@ -126,32 +127,208 @@ def permute_sign_flip(n, samples=10000, seed=0):
         Iterate over sign flip permutations (``sign`` is the same object but
         its content modified in every iteration).
 
+    See Also
+    --------
+    permute_sign_flip_blocks : the same sequence in blocks
+    """
+    sign = np.empty(int(n), np.int8)
+    for block in permute_sign_flip_blocks(n, samples, seed):
+        for row in block:
+            sign[:] = row
+            yield sign
+
+
+def permute_sign_flip_blocks(n, samples=10000, seed=0):
+    """Iterate over blocks of sign flip permutations
+
+    Parameters
+    ----------
+    n : int
+        Number of cases.
+    samples : int
+        Number of samples to yield. If < 0, all possible permutations are
+        performed.
+    seed : None | int
+        Seed for the random state to make replication possible. None to use
+        an unpredictable seed (default 0).
+
+    Returns
+    -------
+    iterator over signs : array of int8 (n_perm, n)
+        Blocks of sign vectors, one permutation per row (blocks can have
+        different lengths).
+
     Notes
     -----
-    Sign flip of each element is encoded in successive bits. These bits are
-    recoded as integer.
+    All permutations (``samples < 0``) are enumerated in Gray code order,
+    so that successive sign vectors differ in exactly one case.
+
+    Random sign vectors are drawn in batches of fixed size from
+    :class:`numpy.random.RandomState` (``numpy.random.Generator`` is not
+    available in the supported numpy versions). Vectors without sign flip
+    and vectors that were already drawn are skipped based on their packed
+    bits. The sequence thus does not depend on ``samples``, i.e., the first
+    ``k`` samples are the same regardless of ``samples``, which allows
+    extending a permutation distribution with additional samples.
     """
     n = int(n)
-    if seed is not None:
-        random.seed(seed)
-
-    # determine possible number of permutations
-    n_perm = 2 ** n
+    samples = int(samples)
+    n_perm = 2 ** n - 1
     if samples < 0:
-        # do all permutations
-        sample_sequences = xrange(1, n_perm)
-    else:
-        # random resampling
-        sample_sequences = random.sample(xrange(1, n_perm), samples)
-
-    sign = np.empty(n, np.int8)
-    mult = 2 ** np.arange(n, dtype=np.int64)
-    buffer_ = np.empty(n, dtype=np.int64)
-    choice = np.array([1, -1], np.int8)
-    for i in sample_sequences:
-        np.floor_divide(i, mult, buffer_, dtype=np.int64)
-        buffer_ %= 2
-        yield np.choose(buffer_, choice, sign)
+        return _gray_code_signs(n, n_perm)
+    elif samples > n_perm:
+        raise ValueError("samples=%i: only %i sign flip permutations exist for "
+                         "n=%i" % (samples, n_perm, n))
+    return _random_signs(n, samples, seed)
+
+
+def _signs(bits):
+    "Convert bits (1 = flip) to sign vectors"
+    return 1 - 2 * bits.astype(np.int8)
+
+
+def _gray_code_signs(n, n_perm, block_size=_SIGN_BLOCK_SIZE):
+    powers = np.arange(n, dtype=np.int64)
+    for start in xrange(1, n_perm + 1, block_size):
+        i = np.arange(start, min(start + block_size, n_perm + 1),
+                      dtype=np.int64)
+        gray = i ^ (i >> 1)
+        yield _signs((gray[:, np.newaxis] >> powers) & 1)
+
+
+def _random_signs(n, samples, seed, block_size=_SIGN_BLOCK_SIZE):
+    random_state = np.random.RandomState(seed)
+    key_dtype = np.dtype((np.void, (n + 7) // 8))
+    drawn = np.empty(0, key_dtype)  # sorted keys of all sign vectors so far
+    while samples > 0:
+        bits = random_state.randint(0, 2, (block_size, n), np.uint8)
+        keys = np.packbits(bits, 1).view(key_dtype).ravel()
+        # first occurrence within the block, not all 0
+        keep = np.zeros(block_size, bool)
+        keep[np.unique(keys, return_index=True)[1]] = True
+        keep &= bits.any(1)
+        # not drawn in a previous block
+        if len(drawn):
+            index = np.searchsorted(drawn, keys)
+            index[index == len(drawn)] = 0
+            keep &= drawn[index] != keys
+        index = np.flatnonzero(keep)[:samples]
+        if len(index) == 0:
+            continue
+        drawn = np.sort(np.concatenate((drawn, keys[index])))
+        samples -= len(index)
+        yield _signs(bits[index])
+
+
+# Identifiers of the sequences produced by the permutation functions. They are
+# stored with permutation distributions, so that a distribution is only
+# extended with samples from the same sequence; change the identifier whenever
+# the sequence of a function changes.
+_SEQUENCES = {permute_order: 'permute_order 1',
+              permute_sign_flip: 'permute_sign_flip 2',
+              permute_sign_flip_blocks: 'permute_sign_flip 2'}
+
+
+def _permutation_sequence(permutations):
+    """Identifier of the sequence of permutations from a permutation function
+
+    Parameters
+    ----------
+    permutations : callable
+        Permutation function, or :func:`functools.partial` of one.
+
+    Returns
+    -------
+    sequence : None | str
+        Identifier of the sequence (None for unknown functions).
+    """
+    func = getattr(permutations, 'func', permutations)
+    return _SEQUENCES.get(func)
+
+def permutation_blocks(iterator, block_size):
+    """Group permutations into blocks
+
+    Parameters
+    ----------
+    iterator : iterator over array
+        Permutation iterator (e.g., from :func:`permute_order` or
+        :func:`permute_sign_flip`).
+    block_size : int
+        Maximum number of permutations per block (the last block can be
+        smaller).
+
+    Returns
+    -------
+    iterator over perms : array
+        Blocks of permutations, with one permutation per row.
+    """
+    block = []
+    for perm in iterator:
+        block.append(perm.copy())
+        if len(block) == block_size:
+            yield np.array(block)
+            block = []
+    if block:
+        yield np.array(block)
+
+
+class PermutationStream(object):
+    """Access a seeded permutation sequence by sample index
+
+    Parameters
+    ----------
+    permutations : callable
+        Function that creates a new iterator over the permutation sequence
+        (e.g., ``functools.partial(permute_sign_flip, n, samples)``). Every
+        iterator needs to produce the same sequence. Iterators can yield
+        single permutations or blocks of permutations (2d arrays with one
+        permutation per row, e.g., from :func:`permute_sign_flip_blocks`).
+
+    Notes
+    -----
+    Consecutive calls with increasing indexes continue the same iterator, so
+    that the sequence is only generated once. Going back to an earlier index
+    restarts the sequence.
+    """
+    def __init__(self, permutations):
+        self._permutations = permutations
+        self._blocks = None
+        self._pending = None
+        self._i = 0
+
+    def block(self, start, stop):
+        """Permutations ``start`` to ``stop`` as array (one per row)"""
+        if self._blocks is None or start < self._i:
+            self._blocks = _iter_blocks(self._permutations())
+            self._pending = None
+            self._i = 0
+        n_skip = start - self._i
+        n = stop - self._i
+        out = []
+        while n > 0:
+            if self._pending is None or len(self._pending) == 0:
+                self._pending = next(self._blocks)
+            rows = self._pending[:n]
+            self._pending = self._pending[len(rows):]
+            n -= len(rows)
+            if n_skip >= len(rows):
+                n_skip -= len(rows)
+            else:
+                out.append(rows[n_skip:])
+                n_skip = 0
+        self._i = stop
+        if len(out) == 1:
+            return out[0]
+        return np.concatenate(out) if out else np.array(out)
+
+
+def _iter_blocks(iterator):
+    "Iterate over blocks (copies) of a permutation iterator"
+    for perm in iterator:
+        if perm.ndim == 2:
+            yield perm
+        else:
+            yield perm[np.newaxis].copy()
 
 
 def resample(Y, samples=10000, replacement=False, unit=None, seed=0):
@@ -120,6 +120,33 @@ def corr(y, x, out=None, perm=None):
     return out
 
 
+class CorrPerm(object):
+    """Correlation with a permuted covariate for blocks of permutations
+
+    Call with ``(y, out, perms)``, where ``y`` is the standardized data
+    (n_cases, n_tests; z-scores with ``ddof=1``), ``out`` the output
+    container (n_perm, n_tests) and ``perms`` the case permutations (n_perm,
+    n_cases) to compute :func:`corr` with ``x[perm]`` for each permutation.
+    The correlations for a block of permutations are computed with a single
+    matrix product.
+    """
+    def __init__(self, x):
+        x = np.asarray(x, np.float64)
+        sd = x.std(ddof=1)
+        if sd:
+            self.z_x = (x - x.mean()) / (sd * (len(x) - 1))
+        else:
+            self.z_x = np.zeros(len(x))
+
+    def __call__(self, y, out, perms):
+        z_x = self.z_x[perms]
+        if y.dtype == out.dtype:
+            np.dot(z_x, y, out)
+        else:
+            out[:] = np.dot(z_x.astype(y.dtype), y)
+        return out
+
+
 def lm_t(y, x):
     """Calculate t-values for regression coefficients
 
@@ -277,6 +304,31 @@ def t_1samp(y, out=None):
     return out
 
 
+class T1SampPerm(object):
+    """1-sample t-test for blocks of sign flip permutations
+
+    Call with ``(y, out, signs)``, where ``y`` is the data (n_cases,
+    n_tests), ``out`` the output container (n_perm, n_tests) and ``signs``
+    an int8 array with one sign vector per row (n_perm, n_cases).
+    """
+    def __call__(self, y, out, signs):
+        opt.t_1samp_perm_block(y, out, signs)
+        return out
+
+
+class T1SampGrayPerm(T1SampPerm):
+    """1-sample t-test for blocks of sign flips in Gray code order
+
+    Like :class:`T1SampPerm`, but successive sign vectors in each block have
+    to differ in exactly one case, as in exhaustive enumeration with
+    :func:`~.permutation.permute_sign_flip_blocks`. The sums for each
+    permutation are updated from the previous one.
+    """
+    def __call__(self, y, out, signs):
+        opt.t_1samp_perm_gray(y, out, signs)
+        return out
+
+
 def t_ind(x, n1, n2, equal_var=True, out=None, perm=None):
     "Based on scipy.stats.ttest_ind"
     if out is None:
@@ -308,6 +360,34 @@ def t_ind(x, n1, n2, equal_var=True, out=None, perm=None):
     return t
 
 
+class TIndPerm(object):
+    """Independent samples t-test for blocks of permuted group membership
+
+    Call with ``(y, out, perms)``, where ``y`` is the data (n_cases,
+    n_tests), ``out`` the output container (n_perm, n_tests) and ``perms``
+    the case permutations (n_perm, n_cases) to compute :func:`t_ind` (with
+    equal variance) for each permutation. Sum and sum of squares of ``y`` are
+    computed on the first call and recycled as long as the same ``y`` is
+    used.
+    """
+    def __init__(self, n1, n2):
+        self.n1 = n1
+        self.n2 = n2
+        self._y = None
+        self._sum_y = None
+        self._sum_sq = None
+
+    def __call__(self, y, out, perms):
+        if y is not self._y:
+            self._sum_y = y.sum(0, np.float64)
+            self._sum_sq = np.empty(y.shape[1])
+            opt.sum_square(y, self._sum_sq)
+            self._y = y
+        opt.t_ind_perm_block(y, out, perms, self.n1, self._sum_y,
+                             self._sum_sq)
+        return out
+
+
 def ftest_f(p, df_num, df_den):
     "F values for given probabilities."
     p = np.asanyarray(p)
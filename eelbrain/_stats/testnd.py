@@ -22,15 +22,21 @@ n_samples : None | int
 '''
 from __future__ import division
 
+import cPickle
+from copy import copy
 from datetime import datetime, timedelta
-from itertools import chain, izip
+from functools import partial
+from itertools import chain, islice, izip
 from math import ceil
-from multiprocessing import Process, cpu_count
+from multiprocessing import Process, Queue, cpu_count
+from multiprocessing.pool import ThreadPool
 from multiprocessing.queues import SimpleQueue
-from multiprocessing.sharedctypes import RawArray
 import operator
+import os
 import re
 import socket
+import tempfile
+import traceback
 from time import time as current_time
 
 import numpy as np
@@ -41,13 +47,14 @@ from .. import fmtxt
 from .. import _colorspaces as _cs
 from .._data_obj import (ascategorial, asmodel, asndvar, asvar, assub, Dataset,
                          NDVar, Var, Celltable, cellname, combine, Categorial,
-                         UTS)
+                         UTS, Adjacency, _map_case_chunks)
 from .._utils import logger, LazyProperty
-from .._utils.numpy_utils import full_slice
+from .._utils.numpy_utils import full_slice, is_mapped, memmap_file
 from . import opt, stats
 from .glm import _nd_anova
-from .opt import merge_labels
-from .permutation import _resample_params, permute_order, permute_sign_flip
+from .permutation import (_permutation_sequence, _resample_params,
+                          permute_order, permute_sign_flip_blocks,
+                          PermutationStream)
 from .t_contrast import TContrastRel
 from .test import star_factor
 
@@ -56,6 +63,25 @@ __test__ = False
 
 # toggle multiprocessing for _ClusterDist
 MULTIPROCESSING = 1
+# maximum number of permutations that are processed as one block
+PERM_BLOCK_SIZE = 64
+# maximum size of the statistical map buffer for one block (bytes)
+PERM_BLOCK_MEMORY = 2 ** 26
+# store the permutations with the distribution (_ClusterDist.permutations)
+RECORD_PERMUTATIONS = False
+# minimum interval between saving checkpoints of the distribution (seconds)
+CHECKPOINT_INTERVAL = 300
+# TFCE implementation: 'incremental' (merge clusters while lowering the
+# threshold) or 'label' (label clusters separately at each height)
+TFCE_BACKEND = 'incremental'
+# number of threads for processing a single statistical map outside of worker
+# processes, e.g. the original map (None to use one thread per CPU)
+N_THREADS = None
+# dtype of the data in permutation tests (np.float32 to save memory; the
+# statistical maps and distributions are always float64)
+PERM_DTYPE = np.float64
+# directory for memory mapped files shared with worker processes
+_SHARED_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else None
 
 
 class _Result(object):
@@ -131,6 +157,52 @@ class _Result(object):
     def _iter_cdists(self):
         yield (None, self._cdist)
 
+    def _write_checkpoint(self, path):
+        """Save the permutation distribution as checkpoint
+
+        Running the same test with more samples and ``checkpoint=path`` then
+        only computes the additional samples.
+        """
+        dists = [cdist for _, cdist in self._iter_cdists()]
+        if any(cdist is None for cdist in dists):
+            raise RuntimeError("Test has no permutation distribution")
+        elif any(cdist.sequence is None for cdist in dists):
+            raise RuntimeError("The permutation sequence of the test is not "
+                               "known (the test was computed with an earlier "
+                               "version), so it can not be extended")
+        checkpoint = _Checkpoint(path, dists, False)
+        checkpoint.done[:] = True
+        checkpoint.save(dists)
+
+    def _can_extend(self, samples, dtype=None):
+        """Whether the same test with more samples can use the distribution
+
+        Parameters
+        ----------
+        samples : int
+            ``samples`` parameter of the test with more samples.
+        dtype : None | np.float32 | np.float64
+            ``dtype`` parameter of the test with more samples.
+
+        Returns
+        -------
+        can_extend : bool
+            Whether the distribution is based on the same permutation sequence
+            and dtype as the test with ``samples`` (i.e., whether
+            :meth:`_write_checkpoint` provides a valid checkpoint).
+        """
+        dtype = np.dtype(PERM_DTYPE if dtype is None else dtype)
+        exhaustive = self._exhaustive(samples)
+        for _, cdist in self._iter_cdists():
+            if (cdist is None or cdist.sequence is None or
+                    cdist.exhaustive != exhaustive or cdist.dtype != dtype):
+                return False
+        return True
+
+    def _exhaustive(self, samples):
+        "Whether the test with ``samples`` enumerates all permutations"
+        return False
+
     @property
     def _first_cdist(self):
         return self._cdist
@@ -295,6 +367,20 @@ class t_contrast_rel(_Result):
         Minimum duration for clusters (in seconds).
     minsource : int
         Minimum number of sources per cluster.
+    checkpoint : None | str
+        Path of a file in which to periodically save the partial permutation
+        distribution. Samples contained in an existing file are not computed
+        again, so that an interrupted test can be resumed.
+    shard : None | tuple of int
+        ``(i, n)`` to only compute shard ``i`` out of ``n`` of the permutation
+        distribution, and save it to ``checkpoint`` (see
+        :func:`merge_shards`). Samples from other shards are NaN in the
+        result, which does not provide p-values.
+    dtype : None | np.float32 | np.float64
+        Precision of the data for computing permutations (default
+        ``PERM_DTYPE``, i.e. np.float64). Use np.float32 to halve the memory
+        needed for large datasets. Statistical maps and distributions are
+        always float64.
 
     Notes
     -----
@@ -327,7 +413,7 @@ class t_contrast_rel(_Result):
     def __init__(self, Y, X, contrast, match=None, sub=None, ds=None, tail=0,
                  samples=None, pmin=None, tmin=None, tfce=False, tstart=None,
                  tstop=None, dist_dim=(), parc=(), dist_tstep=None,
-                 **criteria):
+                 checkpoint=None, shard=None, dtype=None, **criteria):
         ct = Celltable(Y, X, match, sub, ds=ds, coercion=asndvar)
 
         # setup contrast
@@ -356,11 +442,13 @@ class t_contrast_rel(_Result):
 
             cdist = _ClusterDist(ct.Y, samples, threshold, tail, 't',
                                  "t-contrast", tstart, tstop, criteria,
-                                 dist_dim, parc, dist_tstep)
+                                 dist_dim, parc, dist_tstep, dtype)
             cdist.add_original(tmap)
             if cdist.do_permutation:
-                iterator = permute_order(len(ct.Y), samples, unit=ct.match)
-                run_permutation(t_contrast, cdist, iterator)
+                permutations = partial(permute_order, len(ct.Y), samples,
+                                       unit=ct.match)
+                run_permutation(t_contrast, cdist, permutations, False,
+                                checkpoint, shard)
 
         # store attributes
         _Result.__init__(self, ct.Y, ct.match, sub, samples, tfce, pmin, cdist,
@@ -419,6 +507,20 @@ class corr(_Result):
         Minimum duration for clusters (in seconds).
     minsource : int
         Minimum number of sources per cluster.
+    checkpoint : None | str
+        Path of a file in which to periodically save the partial permutation
+        distribution. Samples contained in an existing file are not computed
+        again, so that an interrupted test can be resumed.
+    shard : None | tuple of int
+        ``(i, n)`` to only compute shard ``i`` out of ``n`` of the permutation
+        distribution, and save it to ``checkpoint`` (see
+        :func:`merge_shards`). Samples from other shards are NaN in the
+        result, which does not provide p-values.
+    dtype : None | np.float32 | np.float64
+        Precision of the data for computing permutations (default
+        ``PERM_DTYPE``, i.e. np.float64). Use np.float32 to halve the memory
+        needed for large datasets. Statistical maps and distributions are
+        always float64.
 
     Attributes
     ----------
@@ -430,7 +532,7 @@ class corr(_Result):
     def __init__(self, Y, X, norm=None, sub=None, ds=None, samples=None,
                  pmin=None, rmin=None, tfce=False, tstart=None, tstop=None,
                  match=None, dist_dim=(), parc=(), dist_tstep=None,
-                 **criteria):
+                 checkpoint=None, shard=None, dtype=None, **criteria):
         sub = assub(sub, ds)
         Y = asndvar(Y, sub=sub, ds=ds)
         if not Y.has_case:
@@ -454,9 +556,12 @@ class corr(_Result):
                 idx = (norm == cell)
                 Y.x[idx] = scipy.stats.zscore(Y.x[idx], None)
 
-        # subtract the mean from Y and X so that this can be omitted during
-        # permutation
+        # standardize Y and subtract the mean from X so that this can be
+        # omitted during permutation
         Y -= Y.summary('case')
+        sd = Y.x.std(0, ddof=1)
+        sd[sd == 0] = 1
+        Y.x /= sd
         X = X - X.mean()
         x = X.x
 
@@ -485,13 +590,13 @@ class corr(_Result):
             info = _cs.stat_info('r', threshold)
 
             cdist = _ClusterDist(Y, samples, threshold, 0, 'r', name, tstart,
-                                 tstop, criteria, dist_dim, parc, dist_tstep)
+                                 tstop, criteria, dist_dim, parc, dist_tstep,
+                                 dtype)
             cdist.add_original(rmap)
             if cdist.do_permutation:
-                def test_func(y, out, perm):
-                    return stats.corr(y, x, out, perm)
-                iterator = permute_order(n, samples, unit=match)
-                run_permutation(test_func, cdist, iterator)
+                permutations = partial(permute_order, n, samples, unit=match)
+                run_permutation(stats.CorrPerm(x), cdist, permutations, True,
+                                checkpoint, shard)
 
         # compile results
         dims = Y.dims[1:]
@@ -572,6 +677,20 @@ class ttest_1samp(_Result):
         Minimum duration for clusters (in seconds).
     minsource : int
         Minimum number of sources per cluster.
+    checkpoint : None | str
+        Path of a file in which to periodically save the partial permutation
+        distribution. Samples contained in an existing file are not computed
+        again, so that an interrupted test can be resumed.
+    shard : None | tuple of int
+        ``(i, n)`` to only compute shard ``i`` out of ``n`` of the permutation
+        distribution, and save it to ``checkpoint`` (see
+        :func:`merge_shards`). Samples from other shards are NaN in the
+        result, which does not provide p-values.
+    dtype : None | np.float32 | np.float64
+        Precision of the data for computing permutations (default
+        ``PERM_DTYPE``, i.e. np.float64). Use np.float32 to halve the memory
+        needed for large datasets. Statistical maps and distributions are
+        always float64.
 
     Attributes
     ----------
@@ -585,7 +704,7 @@ class ttest_1samp(_Result):
     def __init__(self, Y, popmean=0, match=None, sub=None, ds=None, tail=0,
                  samples=None, pmin=None, tmin=None, tfce=False, tstart=None,
                  tstop=None, dist_dim=(), parc=(), dist_tstep=None,
-                 **criteria):
+                 checkpoint=None, shard=None, dtype=None, **criteria):
         ct = Celltable(Y, match=match, sub=sub, ds=ds, coercion=asndvar)
 
         n = len(ct.Y)
@@ -623,11 +742,13 @@ class ttest_1samp(_Result):
             n_samples, samples = _resample_params(len(y_perm), samples)
             cdist = _ClusterDist(y_perm, n_samples, threshold, tail, 't',
                                  '1-Sample t-Test', tstart, tstop, criteria,
-                                 dist_dim, parc, dist_tstep)
+                                 dist_dim, parc, dist_tstep, dtype,
+                                 samples < 0)
             cdist.add_original(tmap)
             if cdist.do_permutation:
-                iterator = permute_sign_flip(n, samples)
-                run_permutation(opt.t_1samp_perm, cdist, iterator)
+                permutations = partial(permute_sign_flip_blocks, n, samples)
+                run_permutation(_t_1samp_perm_func(samples), cdist,
+                                permutations, True, checkpoint, shard)
 
         # NDVar map of t-values
         dims = ct.Y.dims[1:]
@@ -680,6 +801,9 @@ class ttest_1samp(_Result):
             args.append("tail=%i" % self.tail)
         return args
 
+    def _exhaustive(self, samples):
+        return _resample_params(self.n, samples)[1] < 0
+
 
 class ttest_ind(_Result):
     """Element-wise independent samples t-test
@@ -721,6 +845,20 @@ class ttest_ind(_Result):
         Minimum duration for clusters (in seconds).
     minsource : int
         Minimum number of sources per cluster.
+    checkpoint : None | str
+        Path of a file in which to periodically save the partial permutation
+        distribution. Samples contained in an existing file are not computed
+        again, so that an interrupted test can be resumed.
+    shard : None | tuple of int
+        ``(i, n)`` to only compute shard ``i`` out of ``n`` of the permutation
+        distribution, and save it to ``checkpoint`` (see
+        :func:`merge_shards`). Samples from other shards are NaN in the
+        result, which does not provide p-values.
+    dtype : None | np.float32 | np.float64
+        Precision of the data for computing permutations (default
+        ``PERM_DTYPE``, i.e. np.float64). Use np.float32 to halve the memory
+        needed for large datasets. Statistical maps and distributions are
+        always float64.
 
     Attributes
     ----------
@@ -735,7 +873,8 @@ class ttest_ind(_Result):
     def __init__(self, Y, X, c1=None, c0=None, match=None, sub=None, ds=None,
                  tail=0, samples=None, pmin=None, tmin=None, tfce=False,
                  tstart=None, tstop=None, dist_dim=(), parc=(),
-                 dist_tstep=None, **criteria):
+                 dist_tstep=None, checkpoint=None, shard=None, dtype=None,
+                 **criteria):
         ct = Celltable(Y, X, match, sub, cat=(c1, c0), ds=ds, coercion=asndvar)
         c1, c0 = ct.cat
 
@@ -763,13 +902,12 @@ class ttest_ind(_Result):
 
             cdist = _ClusterDist(ct.Y, samples, threshold, tail, 't',
                                  'Independent Samples t-Test', tstart, tstop,
-                                 criteria, dist_dim, parc, dist_tstep)
+                                 criteria, dist_dim, parc, dist_tstep, dtype)
             cdist.add_original(tmap)
             if cdist.do_permutation:
-                def test_func(y, out, perm):
-                    return stats.t_ind(y, n1, n0, True, out, perm)
-                iterator = permute_order(n, samples)
-                run_permutation(test_func, cdist, iterator)
+                permutations = partial(permute_order, n, samples)
+                run_permutation(stats.TIndPerm(n1, n0), cdist, permutations,
+                                True, checkpoint, shard)
 
         dims = ct.Y.dims[1:]
 
@@ -887,6 +1025,20 @@ class ttest_rel(_Result):
         Minimum duration for clusters (in seconds).
     minsource : int
         Minimum number of sources per cluster.
+    checkpoint : None | str
+        Path of a file in which to periodically save the partial permutation
+        distribution. Samples contained in an existing file are not computed
+        again, so that an interrupted test can be resumed.
+    shard : None | tuple of int
+        ``(i, n)`` to only compute shard ``i`` out of ``n`` of the permutation
+        distribution, and save it to ``checkpoint`` (see
+        :func:`merge_shards`). Samples from other shards are NaN in the
+        result, which does not provide p-values.
+    dtype : None | np.float32 | np.float64
+        Precision of the data for computing permutations (default
+        ``PERM_DTYPE``, i.e. np.float64). Use np.float32 to halve the memory
+        needed for large datasets. Statistical maps and distributions are
+        always float64.
 
     Attributes
     ----------
@@ -906,7 +1058,8 @@ class ttest_rel(_Result):
     def __init__(self, Y, X, c1=None, c0=None, match=None, sub=None, ds=None,
                  tail=0, samples=None, pmin=None, tmin=None, tfce=False,
                  tstart=None, tstop=None, dist_dim=(), parc=(),
-                 dist_tstep=None, **criteria):
+                 dist_tstep=None, checkpoint=None, shard=None, dtype=None,
+                 **criteria):
         if match is None:
             msg = ("The `match` argument needs to be specified for a related "
                    "samples t-test.")
@@ -944,11 +1097,13 @@ class ttest_rel(_Result):
             n_samples, samples = _resample_params(len(diff), samples)
             cdist = _ClusterDist(diff, n_samples, threshold, tail, 't',
                                  'Related Samples t-Test', tstart, tstop,
-                                 criteria, dist_dim, parc, dist_tstep)
+                                 criteria, dist_dim, parc, dist_tstep, dtype,
+                                 samples < 0)
             cdist.add_original(tmap)
             if cdist.do_permutation:
-                iterator = permute_sign_flip(n, samples)
-                run_permutation(opt.t_1samp_perm, cdist, iterator)
+                permutations = partial(permute_sign_flip_blocks, n, samples)
+                run_permutation(_t_1samp_perm_func(samples), cdist,
+                                permutations, True, checkpoint, shard)
 
         dims = ct.Y.dims[1:]
         t0, t1, t2 = stats.ttest_t((.05, .01, .001), df, tail)
@@ -1012,6 +1167,9 @@ class ttest_rel(_Result):
             args.append("tail=%i" % self.tail)
         return args
 
+    def _exhaustive(self, samples):
+        return _resample_params(self.n, samples)[1] < 0
+
 
 class _MultiEffectResult(_Result):
 
@@ -1215,6 +1373,20 @@ class anova(_MultiEffectResult):
         Minimum duration for clusters (in seconds).
     minsource : int
         Minimum number of sources per cluster.
+    checkpoint : None | str
+        Path of a file in which to periodically save the partial permutation
+        distribution. Samples contained in an existing file are not computed
+        again, so that an interrupted test can be resumed.
+    shard : None | tuple of int
+        ``(i, n)`` to only compute shard ``i`` out of ``n`` of the permutation
+        distribution, and save it to ``checkpoint`` (see
+        :func:`merge_shards`). Samples from other shards are NaN in the
+        result, which does not provide p-values.
+    dtype : None | np.float32 | np.float64
+        Precision of the data for computing permutations (default
+        ``PERM_DTYPE``, i.e. np.float64). Use np.float32 to halve the memory
+        needed for large datasets. Statistical maps and distributions are
+        always float64.
 
     Attributes
     ----------
@@ -1231,7 +1403,8 @@ class anova(_MultiEffectResult):
 
     def __init__(self, Y, X, sub=None, ds=None, samples=None, pmin=None,
                  fmin=None, tfce=False, tstart=None, tstop=None, match=None,
-                 dist_dim=(), parc=(), dist_tstep=None, **criteria):
+                 dist_dim=(), parc=(), dist_tstep=None,
+                 checkpoint=None, shard=None, dtype=None, **criteria):
         sub = assub(sub, ds)
         Y = asndvar(Y, sub, ds)
         X = asmodel(X, sub, ds)
@@ -1262,7 +1435,7 @@ class anova(_MultiEffectResult):
 
             cdists = [_ClusterDist(Y, samples, thresh, 1, 'F', e.name, tstart,
                                    tstop, criteria, dist_dim, parc,
-                                   dist_tstep)
+                                   dist_tstep, dtype)
                       for e, thresh in izip(effects, thresholds)]
 
             # Find clusters in the actual data
@@ -1272,8 +1445,10 @@ class anova(_MultiEffectResult):
                 do_permutation += cdist.do_permutation
 
             if do_permutation:
-                iterator = permute_order(len(Y), samples, unit=match)
-                run_permutation_me(lm, cdists, iterator)
+                permutations = partial(permute_order, len(Y), samples,
+                                       unit=match)
+                run_permutation_me(lm, cdists, permutations, checkpoint,
+                                   shard)
 
         # create ndvars
         dims = Y.dims[1:]
@@ -1339,7 +1514,8 @@ class anova(_MultiEffectResult):
             self._default_plot_obj = self.f
 
 
-def label_clusters(stat_map, threshold, tail, connectivity, criteria):
+def label_clusters(stat_map, threshold, tail, connectivity, criteria,
+                   n_threads=1):
     """Label clusters
 
     Parameters
@@ -1347,6 +1523,9 @@ def label_clusters(stat_map, threshold, tail, connectivity, criteria):
     stat_map : array
         Statistical parameter map (non-adjacent dimension on the first
         axis).
+    n_threads : int
+        Number of threads (with ``tail=0``, both tails are labelled in
+        parallel).
 
     Returns
     -------
@@ -1356,77 +1535,84 @@ def label_clusters(stat_map, threshold, tail, connectivity, criteria):
         Identifiers of the clusters that survive the minimum duration
         criterion.
     """
-    all_adjacent = connectivity is None
+    stat_map = np.ascontiguousarray(stat_map, np.float64)
     cmap = np.empty(stat_map.shape, np.uint32)
     bin_buff = np.empty(stat_map.shape, np.bool8)
-
-    if all_adjacent or stat_map.ndim <= 2:
-        flat_shape = None
-        cmap_flat = cmap
-    else:
-        flat_shape = (stat_map.shape[0], reduce(operator.mul, stat_map.shape[1:]))
-        cmap_flat = cmap.reshape(flat_shape)
-        assert cmap_flat.base is cmap
-
-    if tail == 0:
-        int_buff = np.empty(stat_map.shape, np.uint32)
-        if flat_shape is None:
-            int_buff_flat = int_buff
-        else:
-            int_buff_flat = int_buff.reshape(flat_shape)
-            assert int_buff_flat.base is int_buff
-    else:
-        int_buff = int_buff_flat = None
-
-    struct = _make_struct(stat_map.ndim, all_adjacent)
-
-    cids = _label_clusters(stat_map, threshold, tail, struct, all_adjacent,
-                           connectivity, criteria, cmap, cmap_flat, bin_buff,
-                           int_buff, int_buff_flat)
+    cids, _, _ = _label_clusters(stat_map, threshold, tail, connectivity,
+                                 criteria, cmap, bin_buff, n_threads)
     return cmap, cids
 
 
-def _label_clusters(stat_map, threshold, tail, struct, all_adjacent, conn,
-                    criteria, cmap, cmap_flat, bin_buff, int_buff,
-                    int_buff_flat):
+def _label_clusters(stat_map, threshold, tail, conn, criteria, cmap, bin_buff,
+                    n_threads=1, pool=None, buffers=None):
     """Find clusters on a statistical parameter map
 
     Parameters
     ----------
-    stat_map : array
+    stat_map : array of float64
         Statistical parameter map (non-adjacent dimension on the first
-        axis).
-    cmap : array of int
+        axis, C-contiguous).
+    cmap : array of uint32
         Buffer for the cluster id map (will be modified).
+    bin_buff : array of bool
+        Buffer for the thresholded map (will be modified).
+    n_threads : int
+        Number of threads (with ``tail=0``, both tails are labelled in
+        parallel).
+    pool : None | ThreadPool
+        Thread pool to use instead of starting threads.
+    buffers : None | tuple of array
+        ``(bin_buff, cmap)`` buffers for the second tail (allocated if None).
 
     Returns
     -------
     cluster_ids : np.ndarray of uint32
         Identifiers of the clusters that survive the minimum duration
         criterion.
+    cluster_sums : np.ndarray of float
+        Sum of ``stat_map`` in each of those clusters.
+    origins : np.ndarray of int
+        Flat index of the first element of each of those clusters.
     """
-    # compute clusters
+    cmap.fill(0)
+    if tail == 0 and n_threads > 1:
+        if buffers is None:
+            buffers = (np.empty(bin_buff.shape, np.bool8),
+                       np.empty(cmap.shape, np.uint32))
+        bin_map_above = np.greater(stat_map, threshold, bin_buff)
+        bin_map_below = np.less(stat_map, -threshold, buffers[0])
+        cmap_below = buffers[1]
+        cmap_below.fill(0)
+        above, below = _thread_map(
+            _label_clusters_binary,
+            ((bin_map_above, cmap, conn, criteria, stat_map),
+             (bin_map_below, cmap_below, conn, criteria, stat_map)), 2, pool)
+        n, cids, sums, origins = above
+        _, cids_l, sums_l, origins_l = below
+        cmap_below[bin_map_below] += n
+        cmap += cmap_below
+        return (np.concatenate((cids, cids_l + n)),
+                np.concatenate((sums, sums_l)),
+                np.concatenate((origins, origins_l)))
+
     if tail >= 0:
         bin_map_above = np.greater(stat_map, threshold, bin_buff)
-        cids = _label_clusters_binary(bin_map_above, cmap, cmap_flat, struct,
-                                      all_adjacent, conn, criteria)
+        n, cids, sums, origins = _label_clusters_binary(
+            bin_map_above, cmap, conn, criteria, stat_map)
 
     if tail <= 0:
         bin_map_below = np.less(stat_map, -threshold, bin_buff)
         if tail < 0:
-            cids = _label_clusters_binary(bin_map_below, cmap, cmap_flat,
-                                          struct, all_adjacent, conn, criteria)
+            _, cids, sums, origins = _label_clusters_binary(
+                bin_map_below, cmap, conn, criteria, stat_map)
         else:
-            cids_l = _label_clusters_binary(bin_map_below, int_buff,
-                                            int_buff_flat, struct,
-                                            all_adjacent, conn, criteria)
-            x = int(cmap.max())  # apparently np.uint64 + int makes a float
-            int_buff[bin_map_below] += x
-            cids_l += x
-            cmap += int_buff
+            _, cids_l, sums_l, origins_l = _label_clusters_binary(
+                bin_map_below, cmap, conn, criteria, stat_map, n)
             cids = np.concatenate((cids, cids_l))
+            sums = np.concatenate((sums, sums_l))
+            origins = np.concatenate((origins, origins_l))
 
-    return cids
+    return cids, sums, origins
 
 
 def label_clusters_binary(bin_map, connectivity, criteria):
@@ -1439,97 +1625,165 @@ def label_clusters_binary(bin_map, connectivity, criteria):
     cluster_ids : np.ndarray of uint32
         Sorted identifiers of the clusters that survive the selection criteria.
     """
-    all_adjacent = connectivity is None
-    cmap = np.empty(bin_map.shape, np.uint32)
-
-    if all_adjacent or bin_map.ndim <= 2:
-        cmap_flat = cmap
-    else:
-        flat_shape = (bin_map.shape[0], reduce(operator.mul, bin_map.shape[1:]))
-        cmap_flat = cmap.reshape(flat_shape)
-
-    struct = _make_struct(bin_map.ndim, all_adjacent)
-
-    cids = _label_clusters_binary(bin_map, cmap, cmap_flat, struct, all_adjacent,
-                                  connectivity, criteria)
+    bin_map = np.ascontiguousarray(bin_map, np.bool8)
+    cmap = np.zeros(bin_map.shape, np.uint32)
+    _, cids, _, _ = _label_clusters_binary(bin_map, cmap, connectivity,
+                                           criteria)
     return cmap, cids
 
 
-def _label_clusters_binary(bin_map, cmap, cmap_flat, struct, all_adjacent,
-                           conn, criteria):
+def _label_clusters_binary(bin_map, cmap, conn, criteria, values=None,
+                           offset=0):
     """Label clusters in a binary array
 
     Parameters
     ----------
     bin_map : np.ndarray
         Binary map of where the parameter map exceeds the threshold for a
-        cluster (non-adjacent dimension on the first axis).
-    cmap : np.ndarray
-        Array in which to label the clusters.
-    cmap_flat :
-        Flat copy of cmap (ndim=2, only used when all_adjacent==False)
-    struct : np.ndarray
-        Struct to use for scipy.ndimage.label
-    all_adjacent : bool
-        Whether all dimensions have line-graph connectivity.
-    flat_shape : tuple
-        Shape for making bin_map 2-dimensional.
-    conn : dict
+        cluster (non-adjacent dimension on the first axis, C-contiguous).
+    cmap : np.ndarray of uint32
+        Array in which to label the clusters (C-contiguous). Only elements
+        that are True in ``bin_map`` are modified.
+    conn : None | Adjacency | array of int (n_edges, 2)
         Connectivity (if first dimension is not a line graph).
     criteria : None | list
         Cluster size criteria, list of (axes, v) tuples. Collapse over axes
         and apply v minimum length).
+    values : None | np.ndarray of float64
+        Map to sum within each cluster (C-contiguous; default is to count
+        the elements of each cluster).
+    offset : int
+        Offset for the cluster labels.
 
     Returns
     -------
+    n_clusters : int
+        Number of labelled clusters, including those that do not survive the
+        selection criteria.
     cluster_ids : np.ndarray of uint32
         Sorted identifiers of the clusters that survive the selection criteria.
+    cluster_sums : np.ndarray of float
+        Sum of ``values`` (or number of elements) in each of those clusters.
+    origins : np.ndarray of int
+        Flat index of the first element of each of those clusters.
     """
-    # find clusters
-    n = ndimage.label(bin_map, struct, cmap)
-    # n is 1 even when no cluster is found
-    if n == 1:
-        if cmap.max() == 0:
-            return np.array((), np.uint32)
-        else:
-            cids = np.array((1,), np.uint32)
-    elif all_adjacent:
-        cids = np.arange(1, n + 1, 1, np.uint32)
+    if criteria:
+        criteria_axes = [set(xrange(bin_map.ndim)).difference(axes).pop()
+                         for axes, _ in criteria]
     else:
-        cids = merge_labels(cmap_flat, n, conn)
+        criteria_axes = ()
+    if values is not None:
+        values = values.ravel()
+    if isinstance(conn, Adjacency):
+        conn = conn.edges
+
+    n, sums, extents, origins = opt.label_clusters(
+        bin_map.view(np.uint8).ravel(), bin_map.shape, conn, cmap.ravel(),
+        offset, values, criteria_axes)
+    cids = np.arange(offset + 1, offset + n + 1, dtype=np.uint32)
 
     # apply minimum cluster size criteria
     if criteria:
-        for axes, v in criteria:
-            cids = np.setdiff1d(cids,
-                                [i for i in cids if np.count_nonzero(np.equal(cmap, i).any(axes)) < v],
-                                True)
+        keep = np.ones(n, np.bool8)
+        for (_, v), extent in izip(criteria, extents):
+            keep &= extent >= v
+        return n, cids[keep], sums[keep], origins[keep]
 
-    return cids
+    return n, cids, sums, origins
 
 
-def tfce(stat_map, tail, connectivity):
-    all_adjacent = connectivity is None
+def tfce(stat_map, tail, connectivity, backend=None, n_threads=1):
     tfce_map = np.empty(stat_map.shape)
-    bin_buff = np.empty(stat_map.shape, np.bool8)
-    int_buff = np.empty(stat_map.shape, np.uint32)
+    if backend is None:
+        backend = TFCE_BACKEND
+
+    if backend == 'incremental':
+        neighbors = _neighbors(connectivity, stat_map.shape[0])
+        _tfce_incremental(stat_map, tail, neighbors, tfce_map,
+                          n_threads=n_threads)
+    elif backend == 'label':
+        bin_buff = np.empty(stat_map.shape, np.bool8)
+        int_buff = np.empty(stat_map.shape, np.uint32)
+        _tfce(stat_map, tail, connectivity, tfce_map, bin_buff, int_buff,
+              n_threads=n_threads)
+    else:
+        raise ValueError("backend=%s" % repr(backend))
+    return tfce_map
 
-    if all_adjacent or stat_map.ndim <= 2:
-        int_buff_flat = int_buff
+
+def _neighbors(conn, n_vert):
+    """Neighbors of each vertex in compressed sparse row format
+
+    Parameters
+    ----------
+    conn : None | Adjacency | array of int (n_edges, 2)
+        Connectivity (if first dimension is not a line graph).
+    n_vert : int
+        Number of vertices.
+
+    Returns
+    -------
+    neighbors : None | tuple of array
+        ``(indptr, indices)``: the neighbors of vertex ``i`` are
+        ``indices[indptr[i]:indptr[i + 1]]`` (None if ``conn`` is None).
+    """
+    if conn is None:
+        return None
+    elif not isinstance(conn, Adjacency):
+        conn = Adjacency(conn, n_vert)
+    return conn.indptr, conn.indices
+
+
+def _tfce_incremental(stat_map, tail, neighbors, out, dh=0.1, e=0.5, h=2.0,
+                      n_threads=1, pool=None):
+    """Threshold-free cluster enhancement with incremental cluster merging
+
+    Equivalent to :func:`_tfce`, but instead of labelling clusters at each
+    height, elements are added to clusters in order of descending value.
+    With ``tail=0`` and ``n_threads > 1``, the two tails are processed in
+    parallel.
+    """
+    out.fill(0)
+    stat_flat = np.ascontiguousarray(stat_map, np.float64).ravel()
+    out_flat = out.ravel()
+    if neighbors is None:
+        indptr = indices = None
     else:
-        flat_shape = (stat_map.shape[0], reduce(operator.mul, stat_map.shape[1:]))
-        int_buff_flat = int_buff.reshape(flat_shape)
+        indptr, indices = neighbors
 
-    struct = _make_struct(stat_map.ndim, all_adjacent)
+    jobs = []
+    if tail >= 0:
+        hs = np.arange(dh, stat_flat.max(), dh)
+        if len(hs):
+            jobs.append((stat_flat, hs))
+    if tail <= 0:
+        hs = -np.arange(-dh, stat_flat.min(), -dh)
+        if len(hs):
+            jobs.append((-stat_flat, hs))
+    # the tails assign disjoint elements of out
+    _thread_map(partial(_tfce_increment, e=e, h=h, shape=stat_map.shape,
+                        indptr=indptr, indices=indices, out=out_flat),
+                jobs, n_threads, pool)
+    return out
 
-    _tfce(stat_map, tail, struct, all_adjacent, connectivity, tfce_map,
-          bin_buff, int_buff, int_buff_flat)
-    return tfce_map
 
+def _tfce_increment(values, hs, e, h, shape, indptr, indices, out):
+    # enhancement of positive values for ascending heights hs
+    index = np.flatnonzero(values >= hs[0])
+    order = index[np.argsort(-values[index], kind='mergesort')]
+    heights = hs[::-1].copy()
+    opt.tfce_increment(values, order, heights, heights ** h, e, shape, indptr,
+                       indices, out)
 
-def _tfce(stat_map, tail, struct, all_adjacent, conn, out, bin_buff, int_buff,
-          int_buff_flat, dh=0.1, e=0.5, h=2.0):
-    "Threshold-free cluster enhancement"
+
+def _tfce(stat_map, tail, conn, out, bin_buff, int_buff, dh=0.1, e=0.5,
+          h=2.0, n_threads=1, pool=None, buffers=None):
+    """Threshold-free cluster enhancement
+
+    With ``n_threads > 1``, different heights are processed in parallel,
+    each thread with its own ``(out, bin_buff, int_buff)`` buffers (taken
+    from ``buffers`` if provided, which needs ``n_threads - 1`` items).
+    """
     out.fill(0)
 
     # determine slices
@@ -1541,6 +1795,31 @@ def _tfce(stat_map, tail, struct, all_adjacent, conn, out, bin_buff, int_buff,
     else:
         hs = np.arange(dh, stat_map.max(), dh)
 
+    if n_threads > 1 and len(hs) > 1:
+        # process different heights in parallel with separate buffers
+        chunks = np.array_split(hs, min(n_threads, len(hs)))
+        if buffers is None:
+            buffers = _tfce_buffers(out.shape, len(chunks) - 1)
+        buffers = [(out, bin_buff, int_buff)] + buffers[:len(chunks) - 1]
+        for o, _, _ in buffers[1:]:
+            o.fill(0)
+        _thread_map(_tfce_heights,
+                    [(stat_map, hs_, conn, o, b, i, e, h) for hs_, (o, b, i)
+                     in izip(chunks, buffers)], n_threads, pool)
+        for o, _, _ in buffers[1:]:
+            out += o
+    else:
+        _tfce_heights(stat_map, hs, conn, out, bin_buff, int_buff, e, h)
+    return out
+
+
+def _tfce_buffers(shape, n):
+    "``n`` sets of ``(out, bin_buff, int_buff)`` buffers for :func:`_tfce`"
+    return [(np.empty(shape), np.empty(shape, np.bool8),
+             np.empty(shape, np.uint32)) for _ in xrange(n)]
+
+
+def _tfce_heights(stat_map, hs, conn, out, bin_buff, int_buff, e, h):
     # label clusters in slices at different heights
     # fill each cluster with total section value
     # each point's value is the vertical sum
@@ -1552,19 +1831,15 @@ def _tfce(stat_map, tail, struct, all_adjacent, conn, out, bin_buff, int_buff,
             np.less_equal(stat_map, h_, bin_buff)
             h_factor = (-h_) ** h
 
-        c_ids = _label_clusters_binary(bin_buff, int_buff, int_buff_flat, struct,
-                                       all_adjacent, conn, None)
-        for id_ in c_ids:
-            np.equal(int_buff, id_, bin_buff)
-            v = np.count_nonzero(bin_buff) ** e * h_factor
-            out[bin_buff] += v
-
-    return out
+        n, _, sizes, _ = _label_clusters_binary(bin_buff, int_buff, conn, None)
+        if n:
+            v = sizes ** e * h_factor
+            out[bin_buff] += v[int_buff[bin_buff] - 1]
 
 
 class StatMapProcessor(object):
 
-    def __init__(self, tail, max_axes, parc, tstep_reshape):
+    def __init__(self, tail, max_axes, parc, tstep_reshape, n_threads=1):
         """Reduce a statistical map to the relevant maximum statistic
 
         Parameters
@@ -1573,11 +1848,26 @@ class StatMapProcessor(object):
             Dimensions of the map (without case).
         dims : tuple
             Dimensions of the map (without case).
+        n_threads : int
+            Number of threads for processing a single map (the threads are
+            kept until :meth:`.close` is called).
         """
         self.tail = tail
         self.max_axes = max_axes
         self.parc = parc
         self.tstep_reshape = tstep_reshape
+        self.n_threads = n_threads
+        if n_threads > 1:
+            self._pool = ThreadPool(n_threads)
+        else:
+            self._pool = None
+
+    def close(self):
+        "Stop the threads"
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
 
     def max_stat(self, stat_map):
         stat_map = stat_map.reshape(self.tstep_reshape)
@@ -1597,22 +1887,26 @@ class StatMapProcessor(object):
 class TFCEProcessor(StatMapProcessor):
 
     def __init__(self, tail, max_axes, parc, tstep_reshape, shape, all_adjacent,
-                 connectivity):
-        StatMapProcessor.__init__(self, tail, max_axes, parc, tstep_reshape)
+                 connectivity, backend=None, n_threads=1):
+        StatMapProcessor.__init__(self, tail, max_axes, parc, tstep_reshape,
+                                  n_threads)
         self.shape = shape
         self.all_adjacent = all_adjacent
         self.connectivity = connectivity
-        self.struct = _make_struct(len(shape), all_adjacent)
+        if backend is None:
+            backend = TFCE_BACKEND
+        elif backend not in ('incremental', 'label'):
+            raise ValueError("backend=%s" % repr(backend))
+        self.backend = backend
 
         # Pre-allocate memory buffers used for cluster processing
-        self._bin_buff = np.empty(shape, np.bool8)
-        self._int_buff = np.empty(shape, np.uint32)
-        self._tfce_map = np.empty(shape)
-
-        if all_adjacent or len(shape) <= 2:
-            self._int_buff_flat = self._int_buff
+        if backend == 'incremental':
+            self._neighbors = _neighbors(connectivity, shape[0])
         else:
-            self._int_buff_flat = self._int_buff.reshape((shape[0], -1))
+            self._bin_buff = np.empty(shape, np.bool8)
+            self._int_buff = np.empty(shape, np.uint32)
+            self._thread_buffers = _tfce_buffers(shape, n_threads - 1)
+        self._tfce_map = np.empty(shape)
 
         if tstep_reshape is None:
             self._tfce_map_stacked = self._tfce_map
@@ -1620,67 +1914,58 @@ class TFCEProcessor(StatMapProcessor):
             self._tfce_map_stacked = self._tfce_map.reshape(tstep_reshape)
 
     def max_stat(self, stat_map):
-        _tfce(stat_map, self.tail, self.struct, self.all_adjacent,
-              self.connectivity, self._tfce_map, self._bin_buff, self._int_buff,
-              self._int_buff_flat)
+        if self.backend == 'incremental':
+            _tfce_incremental(stat_map, self.tail, self._neighbors,
+                              self._tfce_map, n_threads=self.n_threads,
+                              pool=self._pool)
+        else:
+            _tfce(stat_map, self.tail, self.connectivity, self._tfce_map,
+                  self._bin_buff, self._int_buff, n_threads=self.n_threads,
+                  pool=self._pool, buffers=self._thread_buffers)
         return self._tfce_map_stacked.max(self.max_axes)
 
 
 class ClusterProcessor(StatMapProcessor):
 
     def __init__(self, tail, max_axes, parc, tstep_reshape, shape, all_adjacent,
-                 connectivity, threshold, criteria):
-        StatMapProcessor.__init__(self, tail, max_axes, parc, tstep_reshape)
+                 connectivity, threshold, criteria, n_threads=1):
+        StatMapProcessor.__init__(self, tail, max_axes, parc, tstep_reshape,
+                                  n_threads)
         self.shape = shape
         self.all_adjacent = all_adjacent
         self.connectivity = connectivity
-        self.struct = _make_struct(len(shape), all_adjacent)
         self.threshold = threshold
         self.criteria = criteria
 
         # Pre-allocate memory buffers used for cluster processing
         self._bin_buff = np.empty(shape, np.bool8)
-        if parc is not None:
-            self.out = np.empty(len(parc))
-
         self._cmap = np.empty(shape, np.uint32)
-        if all_adjacent or len(shape) <= 2:
-            flat_shape = None
-            self._cmap_flat = self._cmap
+        if tail == 0 and n_threads > 1:
+            self._thread_buffers = (np.empty(shape, np.bool8),
+                                    np.empty(shape, np.uint32))
         else:
-            flat_shape = (shape[0], -1)
-            self._cmap_flat = self._cmap.reshape(flat_shape)
-
-        if tail == 0:
-            self._int_buff = np.empty(shape, np.uint32)
-            if flat_shape is None:
-                self._int_buff_flat = self._int_buff
-            else:
-                self._int_buff_flat = self._int_buff.reshape(flat_shape)
-        else:
-            self._int_buff = self._int_buff_flat = None
+            self._thread_buffers = None
+        if parc is not None:
+            self.out = np.empty(len(parc))
+            # connectivity is disconnected between parcels, so each cluster
+            # belongs to the parcel of its first element
+            self._parc_index = np.argmax(parc, 0)
+            self._slice_size = reduce(operator.mul, shape[1:], 1)
 
     def max_stat(self, stat_map, threshold=None):
         if threshold is None:
             threshold = self.threshold
-        cmap = self._cmap
-        cids = _label_clusters(stat_map, threshold, self.tail, self.struct,
-                               self.all_adjacent, self.connectivity,
-                               self.criteria, cmap, self._cmap_flat,
-                               self._bin_buff, self._int_buff,
-                               self._int_buff_flat)
+        _, clusters_v, origins = _label_clusters(
+            stat_map, threshold, self.tail, self.connectivity, self.criteria,
+            self._cmap, self._bin_buff, self.n_threads, self._pool,
+            self._thread_buffers)
+        np.abs(clusters_v, clusters_v)
         if self.parc is not None:
             v = self.out
-            for i, idx in enumerate(self.parc):
-                clusters_v = ndimage.sum(stat_map[idx], cmap[idx], cids)
-                if len(clusters_v):
-                    np.abs(clusters_v, clusters_v)
-                    v[i] = clusters_v.max()
-                else:
-                    v[i] = 0
-        elif len(cids):
-            clusters_v = ndimage.sum(stat_map, cmap, cids)
-            np.abs(clusters_v, clusters_v)
+            v.fill(0)
+            parc_i = self._parc_index[origins // self._slice_size]
+            np.maximum.at(v, parc_i, clusters_v)
+        elif len(clusters_v):
             v = clusters_v.max()
         else:
             v = 0
@@ -1688,22 +1973,46 @@ class ClusterProcessor(StatMapProcessor):
         return v
 
 
-def get_map_processor(kind, *args):
+def get_map_processor(kind, *args, **kwargs):
     if kind == 'tfce':
-        return TFCEProcessor(*args)
+        return TFCEProcessor(*args, **kwargs)
     elif kind == 'cluster':
-        return ClusterProcessor(*args)
+        return ClusterProcessor(*args, **kwargs)
     elif kind == 'raw':
-        return StatMapProcessor(*args)
+        return StatMapProcessor(*args, **kwargs)
     else:
         raise ValueError("kind=%s" % repr(kind))
 
 
-def _make_struct(ndim, all_adjacent):
-    struct = ndimage.generate_binary_structure(ndim, 1)
-    if not all_adjacent:
-        struct[::2] = False
-    return struct
+def _n_threads(n_threads=None):
+    "Number of threads for processing a single map (default N_THREADS)"
+    if n_threads is None:
+        n_threads = N_THREADS
+    if n_threads is None:
+        return cpu_count()
+    elif n_threads < 1:
+        raise ValueError("n_threads=%s" % repr(n_threads))
+    return n_threads
+
+
+def _thread_map(func, args, n_threads, pool=None):
+    """Call ``func(*a)`` for each ``a`` in ``args`` with up to n_threads threads
+
+    Only useful for functions that spend most time in kernels that release
+    the GIL (the labelling and TFCE kernels in :mod:`opt`). Uses ``pool`` if
+    provided, otherwise starts threads for this call.
+    """
+    n_threads = min(n_threads, len(args))
+    if n_threads <= 1:
+        return [func(*a) for a in args]
+    elif pool is not None:
+        return pool.map(lambda a: func(*a), args)
+    pool = ThreadPool(n_threads)
+    try:
+        return pool.map(lambda a: func(*a), args)
+    finally:
+        pool.close()
+        pool.join()
 
 
 class _ClusterDist:
@@ -1724,7 +2033,7 @@ class _ClusterDist:
     """
     def __init__(self, y, samples, threshold, tail=0, meas='?', name=None,
                  tstart=None, tstop=None, criteria={}, dist_dim=(), parc=(),
-                 dist_tstep=None):
+                 dist_tstep=None, dtype=None, exhaustive=False):
         """Accumulate information on a cluster statistic.
 
         Parameters
@@ -1769,8 +2078,19 @@ class _ClusterDist:
             Number of clustering workers (for threshold based clusters and
             TFCE). Negative numbers are added to the cpu-count, 0 to disable
             multiprocessing.
+        dtype : None | np.float32 | np.float64
+            Dtype of the data for computing permutations (default is
+            ``PERM_DTYPE``). Statistical maps are always computed with
+            float64 output.
+        exhaustive : bool
+            The samples enumerate all permutations instead of random ones
+            (e.g., exhaustive sign flips; default False).
         """
         assert y.has_case
+        dtype = np.dtype(PERM_DTYPE if dtype is None else dtype)
+        if dtype not in (np.float32, np.float64):
+            raise ValueError("dtype=%s: needs to be float32 or float64" %
+                             repr(dtype))
         if threshold is None:
             kind = 'raw'
         elif isinstance(threshold, str):
@@ -1843,10 +2163,7 @@ class _ClusterDist:
             # prepare connectivity
             nad_dim = stat_map_dims[0]
             disconnect_parc = (nad_dim.name in parc)
-            if disconnect_parc:
-                connectivity = nad_dim.connectivity(disconnect_parc=disconnect_parc)
-            else:
-                connectivity = nad_dim.connectivity()
+            connectivity = nad_dim._adjacency(disconnect_parc)
 
         # prepare cluster minimum size criteria
         if criteria:
@@ -1982,12 +2299,14 @@ class _ClusterDist:
                         shape, all_adjacent, connectivity, threshold, criteria_)
 
         self.kind = kind
+        self.dtype = dtype
         self.y_perm = y_perm
         self.dims = y_perm.dims
         self.shape = shape  # internal shape for maps
         self._flat_shape = flat_shape
         self._connectivity = connectivity
         self.samples = samples
+        self.exhaustive = exhaustive
         self.dist_shape = dist_shape
         self._dist_dims = dist_dims
         self._tstep_reshape = tstep_reshape
@@ -2002,11 +2321,14 @@ class _ClusterDist:
         self.dist_dim = dist_dim
         self.parc = parc
         self.dist_tstep = dist_tstep
+        self.shard = None  # (i, n) if only shard i of n was computed
+        self.sequence = None  # identifier of the permutation sequence
         self.meas = meas
         self.name = name
         self._criteria = criteria_
         self.criteria = criteria
         self.map_args = map_args
+        self.permutations = None
         self.has_original = False
         self.do_permutation = False
         self.dt_perm = None
@@ -2053,12 +2375,14 @@ class _ClusterDist:
 
         # process map
         if self.kind == 'tfce':
-            cmap = tfce(stat_map, self.tail, self._connectivity)
+            cmap = tfce(stat_map, self.tail, self._connectivity,
+                        n_threads=_n_threads())
             cids = None
             n_clusters = True
         elif self.kind == 'cluster':
             cmap, cids = label_clusters(stat_map, self.threshold, self.tail,
-                                        self._connectivity, self._criteria)
+                                        self._connectivity, self._criteria,
+                                        _n_threads())
             n_clusters = len(cids)
             # clean original cluster map
             idx = (np.in1d(cmap, cids, invert=True).reshape(self.shape))
@@ -2075,26 +2399,16 @@ class _ClusterDist:
         self.has_original = True
         self.dt_original = self._t0 - self._init_time
         self._original_param_map = stat_map
+        self._cluster_index = None
         if self.samples and n_clusters:
             self._create_dist()
             self.do_permutation = True
         else:
-            self.dist_array = None
             self.finalize()
 
     def _create_dist(self):
         "Create the distribution container"
-        if MULTIPROCESSING:
-            n = reduce(operator.mul, self.dist_shape)
-            dist_array = RawArray('d', n)
-            dist = np.frombuffer(dist_array, np.float64, n)
-            dist.shape = self.dist_shape
-        else:
-            dist_array = None
-            dist = np.zeros(self.dist_shape)
-
-        self.dist_array = dist_array
-        self.dist = dist
+        self.dist = np.zeros(self.dist_shape)
 
     def _aggregate_dist(self, **sub):
         """Aggregate permutation distribution to one value per permutation
@@ -2122,6 +2436,53 @@ class _ClusterDist:
 
         return dist
 
+    def _sorted_dist(self, **sub):
+        """Aggregated permutation distribution, sorted (cached)
+
+        Parameters
+        ----------
+        [dimname] : index
+            Limit the data for the distribution.
+        """
+        key = tuple(sorted(sub.iteritems()))
+        try:
+            return self._sorted_dists[key]
+        except TypeError:  # unhashable index
+            return np.sort(self._aggregate_dist(**sub))
+        except KeyError:
+            dist = np.sort(self._aggregate_dist(**sub))
+            self._sorted_dists[key] = dist
+            return dist
+
+    def _n_larger(self, values, **sub):
+        """Number of permutations with a larger statistic than ``values``
+
+        Parameters
+        ----------
+        values : array
+            Values to compare (any shape).
+        [dimname] : index
+            Limit the data for the distribution.
+        """
+        if self.shard is not None:
+            raise RuntimeError("The permutation distribution only contains "
+                               "shard %i of %i; combine all shards with "
+                               "merge_shards() to compute p-values" %
+                               self.shard)
+        dist = self._sorted_dist(**sub)
+        return len(dist) - np.searchsorted(dist, values, 'right')
+
+    def _checkpoint_header(self):
+        "Parameters that need to match for a checkpoint to be valid"
+        if self.dist is None:
+            dist_shape = None
+        else:
+            dist_shape = self.dist.shape[1:]
+        return (self.name, self.kind, self.threshold, self.tail,
+                tuple(sorted(self.criteria.iteritems())), self.tstart,
+                self.tstop, self.dist_dim, self.dist_tstep, self.shape,
+                dist_shape, self.exhaustive, self.dtype.name, self.sequence)
+
     def __repr__(self):
         items = []
         if self.has_original:
@@ -2145,13 +2506,15 @@ class _ClusterDist:
         attrs = ('name', 'meas', '_version', '_host', '_init_time',
                  # settings ...
                  'kind', 'threshold', 'tail', 'criteria', 'samples', 'tstart',
-                 'tstop', 'dist_dim', 'dist_tstep',
+                 'tstop', 'dist_dim', 'dist_tstep', 'exhaustive', 'dtype',
+                 'shard', 'sequence',
                  # data properties ...
                  'dims', 'shape', '_all_adjacent', '_nad_ax', '_flat_shape',
                  '_connectivity', '_criteria',
                  # results ...
                  'dt_original', 'dt_perm', 'n_clusters', '_dist_dims', 'dist',
-                 '_original_param_map', '_original_cluster_map', '_cids')
+                 'permutations', '_original_param_map',
+                 '_original_cluster_map', '_cids', '_cluster_index')
         state = {name: getattr(self, name) for name in attrs}
         return state
 
@@ -2160,6 +2523,9 @@ class _ClusterDist:
         if '_connectivity_src' in state:
             state['_connectivity'] = np.hstack((state.pop('_connectivity_src'),
                                                 state.pop('_connectivity_dst')))
+        if isinstance(state['_connectivity'], np.ndarray):
+            state['_connectivity'] = Adjacency(state['_connectivity'],
+                                               state['shape'][0])
         if 'N' in state:
             state['samples'] = state.pop('N')
         if '_version' not in state:
@@ -2168,6 +2534,18 @@ class _ClusterDist:
             state['_host'] = 'unknown'
         if '_init_time' not in state:
             state['_init_time'] = None
+        if 'permutations' not in state:
+            state['permutations'] = None
+        if '_cluster_index' not in state:
+            state['_cluster_index'] = None
+        if 'exhaustive' not in state:
+            state['exhaustive'] = False
+        if 'dtype' not in state:
+            state['dtype'] = np.dtype(np.float64)
+        if 'shard' not in state:
+            state['shard'] = None
+        if 'sequence' not in state:
+            state['sequence'] = None
 
         for k, v in state.iteritems():
             setattr(self, k, v)
@@ -2199,7 +2577,7 @@ class _ClusterDist:
             else:
                 info.append("%i clusters" % self.n_clusters)
 
-        if self.n_clusters and self.samples:
+        if self.n_clusters and self.probability_map is not None:
             info.append("p >= %.3f" % self.probability_map.min())
 
         return info
@@ -2229,24 +2607,27 @@ class _ClusterDist:
         else:
             tfce_map_ = None
 
+        # original parameter map
+        info = _cs.stat_info(self.meas, contours=param_contours)
+        if self._nad_ax:
+            param_map = param_map.swapaxes(0, self._nad_ax)
+        param_map_ = NDVar(param_map, dims[1:], info, self.name)
+
         # cluster map
         if self.kind == 'cluster':
             cluster_map = self._original_cluster_map
             x = cluster_map.swapaxes(0, self._nad_ax)
             cluster_map_ = NDVar(x, dims[1:], {}, self.name)
+            if self._cluster_index is None:
+                self._cluster_index = _ClusterIndex(x, self._cids, param_map)
         else:
             cluster_map_ = None
 
-        # original parameter map
-        info = _cs.stat_info(self.meas, contours=param_contours)
-        if self._nad_ax:
-            param_map = param_map.swapaxes(0, self._nad_ax)
-        param_map_ = NDVar(param_map, dims[1:], info, self.name)
-
         # store attributes
         self.tfce_map = tfce_map_
         self.parameter_map = param_map_
         self.cluster_map = cluster_map_
+        self._sorted_dists = {}
         self._finalized = True
 
     def _find_peaks(self, x, out=None):
@@ -2261,85 +2642,15 @@ class _ClusterDist:
         """
         if out is None:
             out = np.empty(x.shape, np.bool8)
-        out.fill(True)
-
-        # move through each axis in both directions and discard descending
-        # slope. Do most computationally intensive axis last.
-        for ax in xrange(x.ndim - 1, -1, -1):
-            if ax == 0 and not self._all_adjacent:
-                shape = (len(x), -1)
-                xsa = x.reshape(shape)
-                outsa = out.reshape(shape)
-                axlen = xsa.shape[1]
-
-                conn_src = self._connectivity[:, 0]
-                conn_dst = self._connectivity[:, 1]
-                for i in xrange(axlen):
-                    data = xsa[:, i]
-                    outslice = outsa[:, i]
-                    if not np.any(outslice):
-                        continue
-
-                    # find all points under a slope
-                    sign = np.sign(data[conn_src] - data[conn_dst])
-                    no = set(conn_src[sign < 0])
-                    no.update(conn_dst[sign > 0])
-
-                    # expand to equal points
-                    border = no
-                    while border:
-                        # forward
-                        idx = np.in1d(conn_src, border)
-                        conn_dst_sub = conn_dst[idx]
-                        eq = np.equal(data[conn_src[idx]], data[conn_dst_sub])
-                        new = set(conn_dst_sub[eq])
-                        # backward
-                        idx = np.in1d(conn_dst, border)
-                        conn_src_sub = conn_src[idx]
-                        eq = np.equal(data[conn_src_sub], data[conn_dst[idx]])
-                        new.update(conn_src_sub[eq])
-
-                        # update
-                        new.difference_update(no)
-                        no.update(new)
-                        border = new
-
-                    # mark vertices or whole isoline
-                    if no:
-                        outslice[list(no)] = False
-                    elif not np.all(outslice):
-                        outslice.fill(False)
-            else:
-                if x.ndim == 1:
-                    xsa = x[:, None]
-                    outsa = out[:, None]
-                else:
-                    xsa = x.swapaxes(0, ax)
-                    outsa = out.swapaxes(0, ax)
-                axlen = len(xsa)
-
-                kernel = np.empty(xsa.shape[1:], dtype=np.bool8)
-
-                diff = np.diff(xsa, 1, 0)
-
-                # forward
-                kernel.fill(True)
-                for i in xrange(axlen - 1):
-                    kernel[diff[i] > 0] = True
-                    kernel[diff[i] < 0] = False
-                    nodiff = diff[i] == 0
-                    kernel[nodiff] *= outsa[i + 1][nodiff]
-                    outsa[i + 1] *= kernel
-
-                # backward
-                kernel.fill(True)
-                for i in xrange(axlen - 2, -1, -1):
-                    kernel[diff[i] < 0] = True
-                    kernel[diff[i] > 0] = False
-                    nodiff = diff[i] == 0
-                    kernel[nodiff] *= outsa[i][nodiff]
-                    outsa[i] *= kernel
 
+        if self._all_adjacent:
+            indptr = indices = None
+        else:
+            indptr, indices = _neighbors(self._connectivity, x.shape[0])
+        values = np.ascontiguousarray(x, np.float64).ravel()
+        peaks = np.empty(values.shape, np.uint8)
+        opt.find_peaks(values, x.shape, indptr, indices, peaks)
+        out[...] = peaks.reshape(x.shape)
         return out
 
     def data_for_permutation(self, raw=True):
@@ -2348,22 +2659,30 @@ class _ClusterDist:
         Parameters
         ----------
         raw : bool
-            Return a RawArray and a shape tuple instead of a numpy array.
+            Return a :class:`_SharedArray` for worker processes instead of a
+            numpy array.
         """
-        # get data in the right shape
+        # get data in the right shape and dtype (only copies if necessary)
         x = self.y_perm.x
-        if self._nad_ax:
-            x = x.swapaxes(1, 1 + self._nad_ax)
+        if is_mapped(x) and (x.dtype != self.dtype or self._nad_ax or
+                             not x.flags.c_contiguous):
+            # stream cases into a file instead of loading all data
+            x = _map_case_chunks(lambda s: self._flat_data(x[s]), len(x), x)
+        else:
+            x = self._flat_data(x)
 
-        if not raw:
-            return x.reshape((len(x), -1))
+        if raw:
+            return _SharedArray(x)
+        return x
 
-        n = reduce(operator.mul, self.y_perm.shape)
-        ra = RawArray('d', n)
-        ra[:] = x.ravel()  # OPT: don't copy data
-        return ra, x.shape
+    def _flat_data(self, x):
+        "Data in the layout for permutation"
+        x = x.astype(self.dtype, copy=False)
+        if self._nad_ax:
+            x = x.swapaxes(1, 1 + self._nad_ax)
+        return x.reshape((len(x), -1))
 
-    def _cluster_properties(self, cluster_map, cids):
+    def _cluster_properties(self, cluster_map, cids, index=None):
         """Create a Dataset with cluster properties
 
         Parameters
@@ -2373,6 +2692,9 @@ class _ClusterDist:
         cids : array_like of int
             Numbers specifying the clusters (must occur in cluster_map) which
             should be analyzed.
+        index : None | _ClusterIndex
+            Index of the clusters in ``cluster_map`` with ``cids`` (created
+            if not provided).
 
         Returns
         -------
@@ -2380,29 +2702,15 @@ class _ClusterDist:
             Cluster properties. Which properties are included depends on the
             dimensions.
         """
-        ndim = cluster_map.ndim
-        n_clusters = len(cids)
-
-        # setup compression
-        compression = []
-        for ax, dim in enumerate(cluster_map.dims):
-            extents = np.empty((n_clusters, len(dim)), dtype=np.bool_)
-            axes = tuple(i for i in xrange(ndim) if i != ax)
-            compression.append((ax, dim, axes, extents))
-
-        # find extents for all clusters
-        c_mask = np.empty(cluster_map.shape, np.bool_)
-        for i, cid in enumerate(cids):
-            np.equal(cluster_map, cid, c_mask)
-            for ax, dim, axes, extents in compression:
-                np.any(c_mask, axes, extents[i])
+        if index is None:
+            index = _ClusterIndex(cluster_map.x, cids)
 
         # prepare Dataset
         ds = Dataset()
         ds['id'] = Var(cids)
 
-        for ax, dim, axes, extents in compression:
-            properties = dim._cluster_properties(extents)
+        for ax, dim in enumerate(cluster_map.dims):
+            properties = dim._cluster_properties(index.extents(ax))
             if properties is not None:
                 ds.update(properties)
 
@@ -2428,7 +2736,10 @@ class _ClusterDist:
         if cluster_id not in self._cids:
             raise ValueError("No cluster with id " + repr(cluster_id))
 
-        return self.parameter_map * (self.cluster_map == cluster_id)
+        i = np.flatnonzero(self._cluster_index.cids == cluster_id)
+        param_map = self.parameter_map
+        x = self._cluster_index.maps(param_map.x, i)[0]
+        return NDVar(x, param_map.dims, param_map.info.copy(), param_map.name)
 
     def clusters(self, pmin=None, maps=True, **sub):
         """Find significant clusters
@@ -2469,39 +2780,40 @@ class _ClusterDist:
             if sub:
                 cluster_map = self.cluster_map.sub(**sub)
                 cids = np.setdiff1d(cluster_map.x, [0])
+                index = _ClusterIndex(cluster_map.x, cids, param_map.x)
             else:
                 cluster_map = self.cluster_map
                 cids = np.array(self._cids)
+                index = self._cluster_index
 
             if len(cids):
                 # measure original clusters
-                cluster_v = ndimage.sum(param_map.x, cluster_map.x, cids)
+                cluster_v = index.v
 
                 # p-values
                 if self.samples:
                     # p-values: "the proportion of random partitions that
                     # resulted in a larger test statistic than the observed
                     # one" (179)
-                    dist = self._aggregate_dist(**sub)
-                    n_larger = np.sum(dist > np.abs(cluster_v[:, None]), 1)
+                    n_larger = self._n_larger(np.abs(cluster_v), **sub)
                     cluster_p = n_larger / self.samples
 
                     # select clusters
                     if pmin is not None:
                         idx = cluster_p <= pmin
                         cids = cids[idx]
+                        index = index.sub(np.flatnonzero(idx))
                         cluster_p = cluster_p[idx]
                         cluster_v = cluster_v[idx]
 
                     # p-value corrected across parc
                     if sub:
-                        dist = self._aggregate_dist()
-                        n_larger = np.sum(dist > np.abs(cluster_v[:, None]), 1)
+                        n_larger = self._n_larger(np.abs(cluster_v))
                         cluster_p_corr = n_larger / self.samples
             else:
                 cluster_v = cluster_p = cluster_p_corr = []
 
-            ds = self._cluster_properties(cluster_map, cids)
+            ds = self._cluster_properties(cluster_map, cids, index)
             ds['v'] = Var(cluster_v)
             if self.samples:
                 ds['p'] = Var(cluster_p)
@@ -2534,7 +2846,8 @@ class _ClusterDist:
 
             # Dataset with cluster info
             cluster_map = NDVar(c_map, p_map.dims, {}, "clusters")
-            ds = self._cluster_properties(cluster_map, cids)
+            index = _ClusterIndex(c_map, cids)
+            ds = self._cluster_properties(cluster_map, cids, index)
             ds.info['clusters'] = cluster_map
             min_pos = ndimage.minimum_position(p_map.x, c_map, cids)
             ds['p'] = Var([p_map.x[pos] for pos in min_pos])
@@ -2544,12 +2857,7 @@ class _ClusterDist:
 
         # expand clusters
         if maps:
-            shape = (ds.n_cases,) + param_map.shape
-            c_maps = np.empty(shape, dtype=param_map.x.dtype)
-            c_mask = np.empty(param_map.shape, dtype=np.bool_)
-            for i, cid in enumerate(cids):
-                np.equal(cluster_map.x, cid, c_mask)
-                np.multiply(param_map.x, c_mask, c_maps[i])
+            c_maps = index.maps(param_map.x)
 
             # package ndvar
             dims = ('case',) + param_map.dims
@@ -2578,26 +2886,25 @@ class _ClusterDist:
             raise RuntimeError("Not a threshold-free distribution")
 
         param_map = self._original_param_map
-        probability_map = self.probability_map.x
-        if self._nad_ax:
-            probability_map = probability_map.swapaxes(0, self._nad_ax)
+        probability_map = self.probability_map
+        if probability_map is not None:
+            probability_map = probability_map.x
+            if self._nad_ax:
+                probability_map = probability_map.swapaxes(0, self._nad_ax)
 
         peaks = self._find_peaks(self._original_cluster_map)
         peak_map, peak_ids = label_clusters_binary(peaks, self._connectivity,
                                                    None)
 
+        # first element of each peak
+        index = _ClusterIndex(peak_map, peak_ids)
+        first = index.index[index.indptr[:-1]]
+
         ds = Dataset()
         ds['id'] = Var(peak_ids)
-        v = ds.add_empty_var('v')
-        if self.samples:
-            p = ds.add_empty_var('p')
-
-        bin_buff = np.empty(peak_map.shape, np.bool8)
-        for i, id_ in enumerate(peak_ids):
-            idx = np.equal(peak_map, id_, bin_buff)
-            v[i] = param_map[idx][0]
-            if self.samples:
-                p[i] = probability_map[idx][0]
+        ds['v'] = Var(param_map.ravel()[first])
+        if probability_map is not None:
+            ds['p'] = Var(probability_map.ravel()[first])
 
         return ds
 
@@ -2618,29 +2925,14 @@ class _ClusterDist:
             raise RuntimeError("Can't compute probability without permutations")
 
         if self.kind == 'cluster':
-            cpmap = np.ones(self.shape)
+            index = self._cluster_index
+            cpmap = np.ones(index.shape)
             if self.n_clusters:
-                cids = self._cids
-                dist = self._aggregate_dist(**sub)
-                cluster_map = self._original_cluster_map
-                param_map = self._original_param_map
-
-                # measure clusters
-                cluster_v = ndimage.sum(param_map, cluster_map, cids)
-
                 # p-values: "the proportion of random partitions that resulted
                 # in a larger test statistic than the observed one" (179)
-                n_larger = np.sum(dist > np.abs(cluster_v[:, None]), 1)
+                n_larger = self._n_larger(np.abs(index.v), **sub)
                 cluster_p = n_larger / self.samples
-
-                c_mask = np.empty(self.shape, dtype=np.bool8)
-                for i, cid in enumerate(cids):
-                    np.equal(cluster_map, cid, c_mask)
-                    cpmap[c_mask] = cluster_p[i]
-            # revert to original shape
-            if self._nad_ax:
-                cpmap = cpmap.swapaxes(0, self._nad_ax)
-
+                cpmap.flat[index.index] = cluster_p[index.number]
             dims = self.dims[1:]
         else:
             if self.kind == 'tfce':
@@ -2653,15 +2945,10 @@ class _ClusterDist:
                 else:
                     stat_map = self.parameter_map
 
-            dist = self._aggregate_dist(**sub)
             if sub:
                 stat_map = stat_map.sub(**sub)
 
-            idx = np.empty(stat_map.shape, dtype=np.bool8)
-            cpmap = np.zeros(stat_map.shape)
-            for v in dist:
-                cpmap += np.greater(v, stat_map.x, idx)
-            cpmap /= self.samples
+            cpmap = self._n_larger(stat_map.x, **sub) / self.samples
             dims = stat_map.dims
 
         info = _cs.cluster_pmap_info()
@@ -2701,14 +2988,14 @@ class _ClusterDist:
 
     @LazyProperty
     def probability_map(self):
-        if self.samples:
+        if self.samples and self.shard is None:
             return self.compute_probability_map()
         else:
             return None
 
     @LazyProperty
     def _default_plot_obj(self):
-        if self.samples:
+        if self.probability_map is not None:
             return [[self.parameter_map, self.probability_map]]
         else:
             return [[self.parameter_map]]
@@ -2726,123 +3013,469 @@ class _ClusterDist:
         return l
 
 
-def distribution_worker(dist_array, dist_shape, in_queue):
-    "Worker that accumulates values and places them into the distribution"
-    n = reduce(operator.mul, dist_shape)
-    dist = np.frombuffer(dist_array, np.float64, n)
-    dist.shape = dist_shape
-    samples = dist_shape[0]
-    # logger
-    t0 = tn = current_time()
-    logger.info('starting permutation')
-    for i in xrange(samples):
-        dist[i] = in_queue.get()
-        # logger
-        t = current_time()
-        dt = t - tn
-        if i and dt > 10:
-            time_left = (samples - i) * (t - t0) / i
-            td = timedelta(seconds=round(time_left))
-            logger.info("max stat %i received, estimated time left: %s" % (i, td))
-            tn = t
-    time_taken = t - t0
-    td = timedelta(seconds=round(time_taken))
-    logger.info("%i permutations done in %s" % (samples, td))
-
-
-def permutation_worker(in_queue, out_queue, y, shape, test_func, map_args):
-    "Worker for 1 sample t-test"
-    n = reduce(operator.mul, shape)
-    y = np.frombuffer(y, np.float64, n).reshape((shape[0], -1))
-    stat_map = np.empty(shape[1:])
-    stat_map_flat = stat_map.ravel()
-    map_processor = get_map_processor(*map_args)
-    while True:
-        perm = in_queue.get()
-        if perm is None:
-            break
-        test_func(y, stat_map_flat, perm)
-        max_v = map_processor.max_stat(stat_map)
-        out_queue.put(max_v)
+class _ClusterIndex(object):
+    """Flat indices of the elements of each cluster in a cluster map
 
+    Parameters
+    ----------
+    cluster_map : array of int
+        Map in which clusters are marked by bearing the same number.
+    cids : array_like of int
+        Ids of the clusters to index (cluster ``i`` is ``cids[i]``).
+    param_map : None | array
+        Parameter map to store the sum of each cluster as ``v``.
 
-def run_permutation(test_func, dist, iterator):
-    if MULTIPROCESSING:
-        workers, out_queue = setup_workers(test_func, dist)
+    Notes
+    -----
+    The index is created with a single pass through ``cluster_map``.
+    Afterwards, the cost of operations on clusters is proportional to the
+    size of the clusters rather than to the size of the map.
+    """
+    def __init__(self, cluster_map, cids, param_map=None):
+        cids = np.asarray(cids, cluster_map.dtype)
+        labels = cluster_map.ravel()
+        index = np.flatnonzero(np.in1d(labels, cids))
+        # position in cids for each element
+        order = np.argsort(cids, kind='mergesort')
+        number = order[np.searchsorted(cids[order], labels[index])]
+        sort = np.argsort(number, kind='mergesort')
+        self.cids = cids
+        self.shape = cluster_map.shape
+        self.index = index[sort]
+        self.number = number[sort]
+        self.indptr = np.searchsorted(self.number, np.arange(len(cids) + 1))
+        if param_map is None:
+            self.v = None
+        else:
+            self.v = self.sum(param_map)
+
+    def __len__(self):
+        return len(self.cids)
+
+    def elements(self, i):
+        "Flat indices of the elements of cluster ``i``"
+        return self.index[self.indptr[i]:self.indptr[i + 1]]
+
+    def sub(self, clusters):
+        "Index for a subset of the clusters (positions in ``cids``)"
+        clusters = np.asarray(clusters, int)
+        lengths = self.indptr[clusters + 1] - self.indptr[clusters]
+        out = copy(self)
+        out.cids = self.cids[clusters]
+        if len(clusters):
+            out.index = np.concatenate([self.elements(i) for i in clusters])
+        else:
+            out.index = self.index[:0]
+        out.number = np.repeat(np.arange(len(clusters)), lengths)
+        out.indptr = np.concatenate(([0], np.cumsum(lengths)))
+        if self.v is not None:
+            out.v = self.v[clusters]
+        return out
 
-        for perm in iterator:
-            out_queue.put(perm)
+    def sum(self, x):
+        "Sum of ``x`` in each cluster"
+        values = x.ravel()[self.index]
+        return np.bincount(self.number, values, len(self.cids))
 
-        for _ in xrange(len(workers) - 1):
-            out_queue.put(None)
+    def extents(self, ax):
+        "Extent of each cluster on axis ``ax`` (n_clusters, n_ax) bool array"
+        coords = np.unravel_index(self.index, self.shape)[ax]
+        out = np.zeros((len(self.cids), self.shape[ax]), np.bool_)
+        out[self.number, coords] = True
+        return out
 
-        for w in workers:
-            w.join()
-            logger.debug("worker joined")
+    def maps(self, x, clusters=None):
+        """Maps with ``x`` inside each cluster and 0 elsewhere
+
+        Parameters
+        ----------
+        x : array
+            Map of values (same shape as the cluster map).
+        clusters : None | sequence of int
+            Clusters for which to create maps (default all).
+
+        Returns
+        -------
+        maps : array (n_clusters, ...)
+            One map per cluster.
+        """
+        if clusters is None:
+            clusters = xrange(len(self.cids))
+        values = x.ravel()
+        out = np.zeros((len(clusters), x.size), x.dtype)
+        for out_, i in izip(out, clusters):
+            index = self.elements(i)
+            out_[index] = values[index]
+        return out.reshape((len(out),) + self.shape)
+
+
+class _SharedArray(object):
+    """Array that is passed to worker processes without copying
+
+    Forked processes inherit the array from the parent process. When the
+    object is pickled for a process that is not forked, the data is placed
+    once in a memory mapped file which the receiving process opens (a
+    :class:`numpy.memmap` that is backed by a file is used directly).
+
+    Parameters
+    ----------
+    x : array
+        The data.
+    """
+    def __init__(self, x):
+        self.array = x
+        self._file = memmap_file(x)
+        self._own_file = False
+
+    def __getstate__(self):
+        if self._file is None:
+            fd, path = tempfile.mkstemp('.dat', 'eelbrain-', _SHARED_DIR)
+            os.close(fd)
+            mm = np.memmap(path, self.array.dtype, 'w+', 0, self.array.shape)
+            mm[:] = self.array
+            mm.flush()
+            del mm
+            self._file = (path, 0)
+            self._own_file = True
+        return {'file': self._file, 'dtype': self.array.dtype.str,
+                'shape': self.array.shape}
+
+    def __setstate__(self, state):
+        path, offset = state['file']
+        # copy-on-write mode because Cython memoryviews require writeable
+        # buffers; pages are only copied if they are written to
+        self.array = np.memmap(path, state['dtype'], 'c', offset,
+                               state['shape'])
+        self._file = state['file']
+        self._own_file = False
+
+    def close(self):
+        "Remove the memory mapped file if it was created for this object"
+        if self._own_file:
+            os.remove(self._file[0])
+            self._file = None
+            self._own_file = False
+
+
+class _Checkpoint(object):
+    """Partial permutation distributions stored in a file
+
+    Parameters
+    ----------
+    path : str
+        Location of the checkpoint file.
+    dists : sequence of _ClusterDist
+        Distributions that are computed together (with the original added).
+    load : bool
+        If ``path`` exists, copy the values it contains into ``dists``
+        (default True).
+    shard : None | tuple of int
+        ``(i, n)`` to only compute samples of shard ``i`` out of ``n``.
+
+    Notes
+    -----
+    Values for sample indexes marked in ``done`` are valid. Samples marked in
+    ``skip`` are not computed. Because the permutation iterators produce the
+    same sequence of permutations regardless of the total number of samples,
+    a checkpoint can be used to resume an interrupted test as well as to
+    extend a distribution with additional samples.
+    """
+    def __init__(self, path, dists, load=True, shard=None):
+        self.path = path
+        self.header = [d._checkpoint_header() for d in dists]
+        self.done = np.zeros(dists[0].samples, bool)
+        self.shard = shard
+        self._t_saved = current_time()
+        if load and os.path.exists(path):
+            self._load(dists)
+        self.skip = self.done.copy()
+        if shard is not None:
+            start, stop = _shard_range(len(self.done), *shard)
+            self.skip[:start] = True
+            self.skip[stop:] = True
+
+    def _load(self, dists):
+        state = _read_checkpoint(self.path)
+        if state['header'] != self.header:
+            raise ValueError("Checkpoint file %r was created for a different "
+                             "test" % self.path)
+        n = min(len(self.done), len(state['done']))
+        done = state['done'][:n]
+        for dist, values in izip(dists, state['dists']):
+            if dist.dist is not None:
+                dist.dist[:n][done] = values[:n][done]
+        self.done[:n] = done
+        logger.info("Loaded %i of %i samples from checkpoint",
+                    self.done.sum(), len(self.done))
+
+    def save(self, dists):
+        """Save the current state
+
+        Parameters
+        ----------
+        dists : sequence of array | None
+            The distribution arrays (or _ClusterDist objects).
+        """
+        dists = [getattr(d, 'dist', d) for d in dists]
+        state = {'header': self.header, 'done': self.done, 'dists': dists}
+        _write_checkpoint(self.path, state)
+        self._t_saved = current_time()
+
+    def save_if_due(self, dists):
+        "Save the current state if CHECKPOINT_INTERVAL has passed"
+        if current_time() - self._t_saved > CHECKPOINT_INTERVAL:
+            self.save(dists)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def finish(self, dists):
+        """Remove the checkpoint after all samples are done
+
+        For a shard, save the shard's samples instead, and set samples from
+        other shards that are still missing to NaN (the distributions then
+        refuse to compute p-values).
+        """
+        if self.shard is None:
+            self.remove()
+            return
+        # the distribution workers do not report back which samples they added
+        self.done |= ~self.skip
+        self.save(dists)
+        for dist in dists:
+            dist.shard = self.shard
+            if dist.dist is not None:
+                dist.dist[~self.done] = np.nan
+
+
+def _read_checkpoint(path):
+    with open(path, 'rb') as fid:
+        return cPickle.load(fid)
+
+
+def _write_checkpoint(path, state):
+    "Write a checkpoint file atomically (a partial file is never at ``path``)"
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as fid:
+        cPickle.dump(state, fid, cPickle.HIGHEST_PROTOCOL)
+    os.rename(tmp_path, path)
+
+
+def _shard_range(samples, i, n):
+    "Range of sample indexes that belong to shard ``i`` of ``n``"
+    if not 0 <= i < n:
+        raise ValueError("shard=%r: need 0 <= i < n" % ((i, n),))
+    return samples * i // n, samples * (i + 1) // n
+
+
+def merge_shards(paths, dst):
+    """Merge partial permutation distributions from shards of a test
+
+    Parameters
+    ----------
+    paths : sequence of str
+        Checkpoint files written by the shards (tests run with
+        ``shard=(i, n)`` and ``checkpoint=paths[i]``).
+    dst : str
+        Path for the merged checkpoint file. Running the test again without
+        ``shard`` and with ``checkpoint=dst`` assembles the result without
+        recomputing any of the samples done by the shards (samples of shards
+        that are missing are computed).
+
+    Notes
+    -----
+    Splitting a test into shards::
+
+        >>> for i in xrange(4):  # each in a separate job
+        ...     testnd.anova(y, x, samples=10000, shard=(i, 4),
+        ...                  checkpoint='shard-%i.pickled' % i)
+        >>> testnd.merge_shards(['shard-%i.pickled' % i for i in xrange(4)],
+        ...                     'merged.pickled')
+        >>> res = testnd.anova(y, x, samples=10000, checkpoint='merged.pickled')
+    """
+    header = done = dists = None
+    for path in paths:
+        state = _read_checkpoint(path)
+        if header is None:
+            header = state['header']
+            done = state['done']
+            dists = state['dists']
+            continue
+        elif state['header'] != header or len(state['done']) != len(done):
+            raise ValueError("Checkpoint file %r was created for a different "
+                             "test than %r" % (path, paths[0]))
+        idx = state['done']
+        for dist, values in izip(dists, state['dists']):
+            if dist is not None:
+                dist[idx] = values[idx]
+        done |= idx
+
+    if header is None:
+        raise ValueError("No checkpoint files")
+    state = {'header': header, 'done': done, 'dists': dists}
+    _write_checkpoint(dst, state)
+
+
+def run_permutation(test_func, dist, permutations, block=False,
+                    checkpoint=None, shard=None):
+    """Compute the permutation distribution
+
+    Parameters
+    ----------
+    test_func : callable
+        Function to compute statistical maps, called with ``(y, out, perm)``.
+    dist : _ClusterDist
+        Distribution to which to add the permutation statistics.
+    permutations : callable
+        Function that creates an iterator over the permutations. Every call
+        has to produce the same sequence, so that samples can be addressed by
+        index (e.g., ``partial(permute_order, n, samples)``).
+    block : bool
+        ``test_func`` operates on blocks of permutations: ``out`` is
+        (n_perm, n_tests) and ``perm`` is (n_perm, n_cases) (default False).
+    checkpoint : None | str
+        Path of a file for periodically saving the partial distribution.
+        Samples contained in an existing file are not computed again. The
+        file is removed once the distribution is complete.
+    shard : None | tuple of int
+        ``(i, n)`` to only compute shard ``i`` out of ``n`` (requires
+        ``checkpoint``, which is kept with the shard's samples).
+    """
+    if not block:
+        test_func = _PermutationLoop(test_func)
+
+    dist.sequence = _permutation_sequence(permutations)
+    checkpoint = _setup_checkpoint(checkpoint, shard, (dist,))
+    skip = None if checkpoint is None else checkpoint.skip
+    if RECORD_PERMUTATIONS:
+        _record_permutations(permutations, (dist,))
+
+    if MULTIPROCESSING:
+        job = _PermutationJob(dist.data_for_permutation(), dist.shape,
+                              test_func, dist.map_args, permutations)
+        _run_job(job, (dist,), skip, checkpoint)
     else:
         y = dist.data_for_permutation(False)
-        map_processor = get_map_processor(*dist.map_args)
-        stat_map = np.empty(dist.shape)
-        stat_map_flat = stat_map.ravel()
-        for i, perm in enumerate(iterator):
-            test_func(y, stat_map_flat, perm)
-            dist.dist[i] = map_processor.max_stat(stat_map)
+        permutations = PermutationStream(permutations)
+        map_processor = get_map_processor(*dist.map_args,
+                                          n_threads=_n_threads())
+        block_size = _perm_block_size(dist)
+        stat_maps = np.empty((block_size,) + dist.shape)
+        stat_maps_flat = stat_maps.reshape((block_size, -1))
+        try:
+            for start, stop in _index_blocks(dist.samples, block_size, skip):
+                n_perm = stop - start
+                perms = permutations.block(start, stop)
+                test_func(y, stat_maps_flat[:n_perm], perms)
+                for i, stat_map in izip(xrange(start, stop), stat_maps):
+                    dist.dist[i] = map_processor.max_stat(stat_map)
+                if checkpoint is not None:
+                    checkpoint.done[start:stop] = True
+                    checkpoint.save_if_due((dist,))
+        finally:
+            map_processor.close()
+
+    if checkpoint is not None:
+        checkpoint.finish((dist,))
     dist.finalize()
 
 
-def setup_workers(test_func, dist, n_workers=None):
-    "Initialize workers for permutation tests"
-    if n_workers is None:
-        n_workers = cpu_count()
-    elif n_workers < 0:
-        n_workers = max(1, cpu_count() + n_workers)
-    elif not isinstance(n_workers, int):
-        raise TypeError("n_workers must be int, got %s" % repr(n_workers))
+def _t_1samp_perm_func(samples):
+    """Block test function for sign flip permutations
 
-    logger.debug("Setting up %i worker processes..." % n_workers)
-    permutation_queue = SimpleQueue()
-    dist_queue = SimpleQueue()
+    Exhaustive sign flips (``samples < 0``) are enumerated in Gray code order
+    and can be computed incrementally.
+    """
+    if samples < 0:
+        return stats.T1SampGrayPerm()
+    else:
+        return stats.T1SampPerm()
 
-    # permutation workers
-    y, shape = dist.data_for_permutation()
-    args = (permutation_queue, dist_queue, y, shape, test_func, dist.map_args)
-    workers = []
-    for _ in xrange(n_workers):
-        w = Process(target=permutation_worker, args=args)
-        w.start()
-        workers.append(w)
 
-    # distribution worker
-    args = (dist.dist_array, dist.dist_shape, dist_queue)
-    w = Process(target=distribution_worker, args=args)
-    w.start()
-    workers.append(w)
+def _setup_checkpoint(path, shard, dists):
+    if path is None:
+        if shard is not None:
+            raise ValueError("shard=%r: running a shard requires the "
+                             "checkpoint parameter" % (shard,))
+        return None
+    return _Checkpoint(path, dists, shard=shard)
 
-    return workers, permutation_queue
 
+class _PermutationLoop(object):
+    "Apply a test function for single permutations to a block of permutations"
 
-def run_permutation_me(test, dists, iterator):
+    def __init__(self, test_func):
+        self.test_func = test_func
+
+    def __call__(self, y, out, perms):
+        for out_, perm in izip(out, perms):
+            self.test_func(y, out_, perm)
+        return out
+
+
+def _index_blocks(samples, block_size, skip=None):
+    """Ranges of sample indexes that are processed as one block
+
+    Sample indexes make the position of each permutation in the distribution
+    independent of the order in which workers finish. Samples marked in
+    ``skip`` are skipped.
+    """
+    if skip is None:
+        runs = ((0, samples),)
+    else:
+        index = np.flatnonzero(~skip)
+        breaks = np.flatnonzero(np.diff(index) != 1) + 1
+        runs = ((int(run[0]), int(run[-1]) + 1) for run in
+                np.split(index, breaks) if len(run))
+
+    for run_start, run_stop in runs:
+        for start in xrange(run_start, run_stop, block_size):
+            yield start, min(start + block_size, run_stop)
+
+
+def _record_permutations(permutations, dists):
+    "Store permutations in ``dist.permutations`` (RECORD_PERMUTATIONS)"
+    record = PermutationStream(permutations).block(0, dists[0].samples)
+    for dist in dists:
+        dist.permutations = record
+
+
+def _perm_block_size(dist, n_workers=1):
+    "Number of permutations to process in one block"
+    n_tests = reduce(operator.mul, dist.shape)
+    block_size = min(PERM_BLOCK_SIZE, PERM_BLOCK_MEMORY // (8 * n_tests),
+                     int(ceil(dist.samples / n_workers)))
+    return max(1, block_size)
+
+
+def run_permutation_me(test, dists, permutations, checkpoint=None,
+                       shard=None):
     dist = dists[0]
     if dist.kind == 'cluster':
         thresholds = tuple(d.threshold for d in dists)
     else:
         thresholds = None
 
-    if MULTIPROCESSING:
-        workers, out_queue = setup_workers_me(test, dists, thresholds)
-
-        for perm in iterator:
-            out_queue.put(perm)
-
-        for _ in xrange(len(workers) - 1):
-            out_queue.put(None)
+    sequence = _permutation_sequence(permutations)
+    for d in dists:
+        d.sequence = sequence
+    checkpoint = _setup_checkpoint(checkpoint, shard, dists)
+    skip = None if checkpoint is None else checkpoint.skip
+    if RECORD_PERMUTATIONS:
+        _record_permutations(permutations, dists)
 
-        for w in workers:
-            w.join()
-            logger.debug("worker joined")
+    if MULTIPROCESSING:
+        job = _MultiEffectPermutationJob(dist.data_for_permutation(),
+                                         dist.shape, test, dist.map_args,
+                                         permutations, thresholds)
+        _run_job(job, dists, skip, checkpoint)
     else:
         y = dist.data_for_permutation(False)
-        map_processor = get_map_processor(*dist.map_args)
+        permutations = PermutationStream(permutations)
+        map_processor = get_map_processor(*dist.map_args,
+                                          n_threads=_n_threads())
+        block_size = _perm_block_size(dist)
 
         stat_maps = test.preallocate((0,) + dist.shape)
         stat_maps_iter = [stat_maps[i] for i in xrange(len(stat_maps))]
@@ -2851,98 +3484,344 @@ def run_permutation_me(test, dists, iterator):
         else:
             stat_maps_iter = zip(stat_maps_iter, dists)
 
-        for i, perm in enumerate(iterator):
-            test.map(y, perm)
-            if thresholds:
-                for m, t, d in stat_maps_iter:
-                    if d.do_permutation:
-                        d.dist[i] = map_processor.max_stat(m, t)
-            else:
-                for m, d in stat_maps_iter:
-                    if d.do_permutation:
-                        d.dist[i] = map_processor.max_stat(m)
-
+        try:
+            for start, stop in _index_blocks(dist.samples, block_size, skip):
+                perms = permutations.block(start, stop)
+                for i, perm in izip(xrange(start, stop), perms):
+                    test.map(y, perm)
+                    if thresholds:
+                        for m, t, d in stat_maps_iter:
+                            if d.do_permutation:
+                                d.dist[i] = map_processor.max_stat(m, t)
+                    else:
+                        for m, d in stat_maps_iter:
+                            if d.do_permutation:
+                                d.dist[i] = map_processor.max_stat(m)
+                if checkpoint is not None:
+                    checkpoint.done[start:stop] = True
+                    checkpoint.save_if_due(dists)
+        finally:
+            map_processor.close()
+
+    if checkpoint is not None:
+        checkpoint.finish(dists)
     for d in dists:
         if d.do_permutation:
             d.finalize()
 
 
-def setup_workers_me(test_func, dists, thresholds, n_workers=None):
-    "Initialize workers for permutation tests"
-    if n_workers is None:
-        n_workers = cpu_count()
-    elif n_workers < 0:
-        n_workers = max(1, cpu_count() + n_workers)
-    elif not isinstance(n_workers, int):
-        raise TypeError("n_workers must be int, got %s" % repr(n_workers))
+class WorkerPool(object):
+    """Worker processes for permutation tests that are reused across tests
 
-    logger.debug("Setting up %i worker processes..." % n_workers)
-    permutation_queue = SimpleQueue()
-    dist_queue = SimpleQueue()
+    By default, each permutation test starts its own worker processes. While
+    a WorkerPool is active (as context manager), tests use its workers
+    instead, and only the data and settings for each test are sent to the
+    running workers.
 
-    # permutation workers
-    dist = dists[0]
-    y, shape = dist.data_for_permutation()
-    args = (permutation_queue, dist_queue, y, shape, test_func, dist.map_args,
-            thresholds)
-    workers = []
+    Parameters
+    ----------
+    n_workers : None | int
+        Number of worker processes. None to use the number of CPUs; negative
+        numbers are added to the number of CPUs.
+
+    Notes
+    -----
+    Data are sent to running workers through a memory mapped file (see
+    :class:`_SharedArray`). The test functions need to be picklable.
+
+    Examples
+    --------
+    Use the same worker processes for a series of tests::
+
+        >>> with testnd.WorkerPool(4):
+        ...     for tstart, tstop in windows:
+        ...         res = testnd.ttest_rel(y, x, samples=1000, tstart=tstart,
+        ...                                tstop=tstop, ds=ds)
+
+    """
+    def __init__(self, n_workers=None):
+        if n_workers is None:
+            n_workers = cpu_count()
+        elif not isinstance(n_workers, int):
+            raise TypeError("n_workers must be int, got %s" % repr(n_workers))
+        elif n_workers < 0:
+            n_workers = max(1, cpu_count() + n_workers)
+        elif n_workers == 0:
+            raise ValueError("n_workers=0")
+        self.n_workers = n_workers
+        self._workers = None
+        self._previous = None
+
+    def __enter__(self):
+        global _worker_pool
+        if self._workers is None:
+            self.start()
+        self._previous = _worker_pool
+        _worker_pool = self
+        return self
+
+    def __exit__(self, *args):
+        global _worker_pool
+        _worker_pool = self._previous
+        self._previous = None
+        self.close()
+
+    def __repr__(self):
+        if self._workers is None:
+            state = 'closed'
+        else:
+            state = 'running'
+        return "<WorkerPool: %i workers, %s>" % (self.n_workers, state)
+
+    def start(self, job=None):
+        """Start the worker processes
+
+        Parameters
+        ----------
+        job : None | _PermutationJob
+            First job for the workers (forked workers inherit it without
+            pickling).
+        """
+        if self._workers is not None:
+            raise RuntimeError("WorkerPool is already running")
+        logger.debug("Setting up %i worker processes..." % self.n_workers)
+        self._job_queues = [SimpleQueue() for _ in xrange(self.n_workers)]
+        self._task_queue = Queue()
+        self._result_queue = SimpleQueue()
+        self._workers = []
+        for job_queue in self._job_queues:
+            args = (job_queue, self._task_queue, self._result_queue, job)
+            w = Process(target=_pool_worker, args=args)
+            w.daemon = True
+            w.start()
+            self._workers.append(w)
+
+    def close(self):
+        "Stop the worker processes"
+        if self._workers is None:
+            return
+        for job_queue in self._job_queues:
+            job_queue.put(None)
+        for w in self._workers:
+            w.join()
+            logger.debug("worker joined")
+        self._workers = None
+
+    def terminate(self):
+        "Terminate the worker processes without waiting for them"
+        if self._workers is None:
+            return
+        for w in self._workers:
+            w.terminate()
+        self._workers = None
+
+    def run(self, job, dists, skip=None, checkpoint=None):
+        """Compute the permutations of a job and add them to the distributions
+
+        Parameters
+        ----------
+        job : _PermutationJob
+            The job.
+        dists : sequence of _ClusterDist
+            The distributions to which ``job`` contributes.
+        skip : None | array of bool
+            Samples that should not be computed.
+        checkpoint : None | _Checkpoint
+            Checkpoint that is updated with the results.
+        """
+        if self._workers is None:
+            self.start(job)
+        else:
+            for job_queue in self._job_queues:
+                job_queue.put(job)
+
+        dist = dists[0]
+        if skip is None:
+            samples = dist.samples
+        else:
+            samples = int(np.sum(~skip))
+        block_size = _perm_block_size(dist, self.n_workers)
+        tasks = _iter_tasks(job.permutations, dist.samples, block_size, skip,
+                            self.n_workers)
+        # keep a limited number of permutation blocks in the queue
+        for item in islice(tasks, 2 * self.n_workers):
+            self._task_queue.put(item)
+
+        dist_arrays = [d.dist for d in dists]
+        t0 = tn = current_time()
+        logger.info('starting permutation')
+        n_done = 0
+        n_finished = 0
+        while n_finished < self.n_workers:
+            item = self._result_queue.get()
+            if item is None:
+                n_finished += 1
+                continue
+            elif isinstance(item, basestring):
+                self.terminate()
+                raise RuntimeError("Error in permutation worker:\n%s" % item)
+            for task in islice(tasks, 1):
+                self._task_queue.put(task)
+            i, values = item
+            n = len(values[0])
+            for dist_array, v in izip(dist_arrays, values):
+                if dist_array is not None:
+                    dist_array[i:i + n] = v
+            n_done += n
+            if checkpoint is not None:
+                checkpoint.done[i:i + n] = True
+                checkpoint.save_if_due(dist_arrays)
+            # logger
+            t = current_time()
+            dt = t - tn
+            if dt > 10:
+                time_left = (samples - n_done) * (t - t0) / n_done
+                td = timedelta(seconds=round(time_left))
+                logger.info("max stat %i received, estimated time left: %s" % (n_done, td))
+                tn = t
+        time_taken = current_time() - t0
+        td = timedelta(seconds=round(time_taken))
+        logger.info("%i permutations done in %s" % (samples, td))
+
+
+# WorkerPool used by tests (set by WorkerPool.__enter__)
+_worker_pool = None
+
+
+def _iter_tasks(permutations, samples, block_size, skip, n_workers):
+    """Tasks for permutation workers
+
+    The permutation sequence is generated once, in the main process, and
+    each task contains its block of permutations ``(start, stop, perms)``.
+    The tasks are followed by one None for each worker, which each worker
+    takes to acknowledge the end of the job.
+    """
+    stream = PermutationStream(permutations)
+    for start, stop in _index_blocks(samples, block_size, skip):
+        yield start, stop, stream.block(start, stop)
     for _ in xrange(n_workers):
-        w = Process(target=permutation_worker_me, args=args)
-        w.start()
-        workers.append(w)
-
-    # distribution worker
-    args = ([d.dist_array for d in dists], dist.dist_shape, dist_queue)
-    w = Process(target=distribution_worker_me, args=args)
-    w.start()
-    workers.append(w)
-
-    return workers, permutation_queue
-
-
-def permutation_worker_me(in_queue, out_queue, y, shape, test, map_args,
-                          thresholds):
-    n = reduce(operator.mul, shape)
-    y = np.frombuffer(y, np.float64, n).reshape((shape[0], -1))
-    stat_maps = test.preallocate(shape)
-    iterator = [stat_maps[i] for i in xrange(len(stat_maps))]
-    if thresholds:
-        iterator = zip(iterator, thresholds)
-    map_processor = get_map_processor(*map_args)
+        yield None
+
+
+def _run_job(job, dists, skip, checkpoint):
+    "Run a permutation job in the active WorkerPool or in a temporary pool"
+    if _worker_pool is None:
+        pool = WorkerPool()
+        try:
+            pool.run(job, dists, skip, checkpoint)
+        finally:
+            pool.close()
+    else:
+        _worker_pool.run(job, dists, skip, checkpoint)
+    job.y.close()
+
+
+def _pool_worker(job_queue, task_queue, result_queue, job=None):
+    "Worker process of a WorkerPool"
+    map_args = map_processor = None
     while True:
-        perm = in_queue.get()
-        if perm is None:
+        if job is None:
+            job = job_queue.get()
+            if job is None:
+                break
+        try:
+            if map_args is None or not _args_equal(job.map_args, map_args):
+                if map_processor is not None:
+                    map_processor.close()
+                map_args = job.map_args
+                map_processor = get_map_processor(*map_args)
+            job.run(task_queue, result_queue, map_processor)
+        except Exception:
+            result_queue.put(traceback.format_exc())
             break
-        test.map(y, perm)
+        result_queue.put(None)
+        job = None
+
+
+def _args_equal(a, b):
+    "Compare nested map processor arguments"
+    if isinstance(a, np.ndarray) or isinstance(b, np.ndarray):
+        return (isinstance(a, np.ndarray) and isinstance(b, np.ndarray) and
+                a.shape == b.shape and np.array_equal(a, b))
+    elif isinstance(a, (tuple, list)):
+        return (type(a) is type(b) and len(a) == len(b) and
+                all(_args_equal(a_, b_) for a_, b_ in izip(a, b)))
+    else:
+        return a == b
 
-        if thresholds:
-            max_v = [map_processor.max_stat(m, t) for m, t in iterator]
-        else:
-            max_v = [map_processor.max_stat(m) for m in iterator]
-        out_queue.put(max_v)
-
-
-def distribution_worker_me(dist_arrays, dist_shape, in_queue):
-    "Worker that accumulates values and places them into the distribution"
-    n = reduce(operator.mul, dist_shape)
-    dists = [d if d is None else np.frombuffer(d, np.float64, n).reshape(dist_shape)
-             for d in dist_arrays]
-    samples = dist_shape[0]
-    # logger
-    t0 = tn = current_time()
-    logger.info('starting permutation')
-    for i in xrange(samples):
-        for dist, v in izip(dists, in_queue.get()):
-            if dist is not None:
-                dist[i] = v
-        # logger
-        t = current_time()
-        dt = t - tn
-        if i and dt > 10:
-            time_left = (samples - i) * (t - t0) / i
-            td = timedelta(seconds=round(time_left))
-            logger.info("max stat %i received, estimated time left: %s" % (i, td))
-            tn = t
-    time_taken = t - t0
-    td = timedelta(seconds=round(time_taken))
-    logger.info("%i permutations done in %s" % (samples, td))
+
+class _PermutationJob(object):
+    """Permutations for one distribution, computed in WorkerPool workers
+
+    Parameters
+    ----------
+    y : _SharedArray
+        Data, shape (n_cases, n_tests).
+    shape : tuple of int
+        Shape of the statistical maps.
+    test_func : callable
+        Block test function (see :func:`run_permutation`).
+    map_args : tuple
+        Arguments for :func:`get_map_processor`.
+    permutations : callable
+        Function creating the permutation iterator (permutations are
+        generated in the main process, see :func:`_iter_tasks`).
+    """
+    def __init__(self, y, shape, test_func, map_args, permutations):
+        self.y = y
+        self.shape = shape
+        self.test_func = test_func
+        self.map_args = map_args
+        self.permutations = permutations
+
+    def run(self, task_queue, result_queue, map_processor):
+        y = self.y.array
+        stat_maps = stat_maps_flat = None
+        while True:
+            item = task_queue.get()
+            if item is None:
+                break
+            start, stop, perms = item
+            n_perm = stop - start
+            if stat_maps is None or len(stat_maps) < n_perm:
+                stat_maps = np.empty((n_perm,) + self.shape)
+                stat_maps_flat = stat_maps.reshape((n_perm, -1))
+            self.test_func(y, stat_maps_flat[:n_perm], perms)
+            max_v = [map_processor.max_stat(m) for m in stat_maps[:n_perm]]
+            result_queue.put((start, (max_v,)))
+
+
+class _MultiEffectPermutationJob(_PermutationJob):
+    """Permutations for several distributions from the same test
+
+    ``test_func`` is an ANOVA object (with ``.preallocate()`` and ``.map()``
+    methods), ``thresholds`` are the cluster forming thresholds for the
+    different effects (or None).
+    """
+    def __init__(self, y, shape, test_func, map_args, permutations,
+                 thresholds):
+        _PermutationJob.__init__(self, y, shape, test_func, map_args,
+                                 permutations)
+        self.thresholds = thresholds
+
+    def run(self, task_queue, result_queue, map_processor):
+        y = self.y.array
+        test = self.test_func
+        stat_maps = test.preallocate((0,) + self.shape)
+        iterator = [stat_maps[i] for i in xrange(len(stat_maps))]
+        if self.thresholds:
+            iterator = zip(iterator, self.thresholds)
+        while True:
+            item = task_queue.get()
+            if item is None:
+                break
+            start, stop, perms = item
+            max_vs = []
+            for perm in perms:
+                test.map(y, perm)
+                if self.thresholds:
+                    max_v = [map_processor.max_stat(m, t) for m, t in iterator]
+                else:
+                    max_v = [map_processor.max_stat(m) for m in iterator]
+                max_vs.append(max_v)
+            result_queue.put((start, zip(*max_vs)))
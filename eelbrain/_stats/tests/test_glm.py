@@ -153,6 +153,39 @@ def test_anova_perm():
         assert_allclose(r2, r1, 1e-6, 1e-6)
 
 
+def test_anova_backends():
+    "Test GEMM ND-ANOVA against the reference kernels"
+    ds = datasets.get_uts(True)
+    y = ds['utsnd'].x.reshape((ds.n_cases, -1))
+
+    for cls, x in ((glm._BalancedFixedNDANOVA, 'A*B'),
+                   (glm._FullNDANOVA, 'A*B*rm')):
+        aov = cls(ds.eval(x), 'gemm')
+        aov_ref = cls(ds.eval(x), 'kernel')
+        assert_allclose(aov.map(y), aov_ref.map(y), 1e-6)
+        r = aov.preallocate(y.shape)
+        r_ref = aov_ref.preallocate(y.shape)
+        for perm in permute_order(ds.n_cases, 3):
+            aov.map(y, perm)
+            aov_ref.map(y, perm)
+            assert_allclose(r, r_ref, 1e-6)
+    assert_raises(ValueError, glm._FullNDANOVA, ds.eval('A*B*rm'), 'blas')
+
+    # unbalanced
+    ds = ds[1:]
+    y = y[1:]
+    for x in ('A*B', 'A+B'):
+        aov = glm._IncrementalNDANOVA(ds.eval(x), 'gemm')
+        aov_ref = glm._IncrementalNDANOVA(ds.eval(x), 'kernel')
+        assert_allclose(aov.map(y), aov_ref.map(y), 1e-6)
+        r = aov.preallocate(y.shape)
+        r_ref = aov_ref.preallocate(y.shape)
+        for perm in permute_order(ds.n_cases, 3):
+            aov.map(y, perm)
+            aov_ref.map(y, perm)
+            assert_allclose(r, r_ref, 1e-6)
+
+
 def test_anova_r_adler():
     """Test ANOVA accuracy by comparing with R (Adler dataset of car package)
 
@@ -1,10 +1,10 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
 import numpy as np
 import scipy.stats
-from numpy.testing import assert_allclose
+from numpy.testing import assert_allclose, assert_array_equal
 from eelbrain import datasets
 from eelbrain._stats import opt
-from eelbrain._stats.permutation import permute_sign_flip
+from eelbrain._stats.permutation import permute_sign_flip, permutation_blocks
 
 
 def test_t_1samp():
@@ -25,3 +25,29 @@ def test_t_1samp():
         opt.t_1samp_perm(y, t_perm, sign)
         opt.t_1samp(y * sign[:,None], t)
         assert_allclose(t_perm, t)
+
+    # block (identical to t_1samp_perm, so that ties are preserved)
+    for signs in permutation_blocks(permute_sign_flip(n_cases, 7), 3):
+        t_perm = np.empty((len(signs), len(t)))
+        opt.t_1samp_perm_block(y, t_perm, signs)
+        for sign, t_perm_ in zip(signs, t_perm):
+            opt.t_1samp_perm(y, t, sign)
+            assert_array_equal(t_perm_, t)
+    opt.t_1samp(y, t)
+    t_perm = np.empty((1, len(t)))
+    opt.t_1samp_perm_block(y, t_perm, -np.ones((1, n_cases), np.int8))
+    assert_array_equal(t_perm[0], -t)
+
+    # Gray code
+    y = y[:8]
+    opt.t_1samp(y, t)
+    for signs in permutation_blocks(permute_sign_flip(8, -1), 50):
+        t_perm = np.empty((len(signs), len(t)))
+        t_gray = np.empty_like(t_perm)
+        opt.t_1samp_perm_block(y, t_perm, signs)
+        opt.t_1samp_perm_gray(y, t_gray, signs)
+        assert_allclose(t_gray, t_perm)
+        # the permutation flipping all signs ties exactly
+        for sign, t_gray_ in zip(signs, t_gray):
+            if np.all(sign == -1):
+                assert_array_equal(t_gray_, -t)
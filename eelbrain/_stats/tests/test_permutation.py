@@ -1,11 +1,14 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
+from functools import partial
 import logging
 
 from nose.tools import eq_, ok_
 import numpy as np
+from numpy.testing import assert_array_equal
 
 from eelbrain import Factor, Var
-from eelbrain._stats.permutation import resample, permute_sign_flip
+from eelbrain._stats.permutation import (
+    resample, permute_sign_flip, permute_sign_flip_blocks, PermutationStream)
 
 
 def test_permutation():
@@ -43,3 +46,38 @@ def test_permutation_sign_flip():
     ok_(np.all(res.min(1) < 0), "Not all permutations have a sign flip")
     for i, row in enumerate(res):
         eq_(np.any(np.all(row == res[:i], 1)), False)
+    res_all = res
+
+    # samples are independent of the total number of samples
+    res = [sign.copy() for sign in permute_sign_flip(12, samples=100)]
+    res_ = [sign.copy() for sign in permute_sign_flip(12, samples=50)]
+    assert_array_equal(res[:50], res_)
+    eq_(len(set(tuple(sign) for sign in res)), 100)
+
+    # exhaustive enumeration in Gray code order
+    signs = np.concatenate(list(permute_sign_flip_blocks(6, -1)))
+    assert_array_equal(signs, res_all)
+    eq_(np.all(np.sum(signs[1:] != signs[:-1], 1) == 1), True)
+
+    # blocks yield the same sequence as single permutations
+    signs = np.concatenate(list(permute_sign_flip_blocks(12, 100)))
+    assert_array_equal(signs, res)
+
+    # large number of cases
+    signs = np.concatenate(list(permute_sign_flip_blocks(300, 2000)))
+    eq_(signs.shape, (2000, 300))
+    eq_(len(set(tuple(sign) for sign in signs)), 2000)
+
+    # all permutations drawn at random
+    signs = np.concatenate(list(permute_sign_flip_blocks(4, 15)))
+    eq_(len(set(tuple(sign) for sign in signs)), 15)
+    ok_(np.all(signs.min(1) < 0))
+
+
+def test_permutation_stream():
+    "Test PermutationStream"
+    perms = [sign.copy() for sign in permute_sign_flip(8, 50)]
+    stream = PermutationStream(partial(permute_sign_flip, 8, 50))
+    assert_array_equal(stream.block(10, 20), perms[10:20])
+    assert_array_equal(stream.block(30, 35), perms[30:35])
+    assert_array_equal(stream.block(0, 5), perms[0:5])
@@ -65,6 +65,15 @@ def test_corr():
             r_sp, _ = scipy.stats.pearsonr(y_perm[:, i], x)
             assert_almost_equal(corr[i], r_sp)
 
+    # block of permutations with standardized y
+    perms = np.array([perm.copy() for perm in permute_order(n_cases, 3)])
+    z_y = scipy.stats.zscore(y, ddof=1)
+    r_perm = np.empty((len(perms), y.shape[1]))
+    stats.CorrPerm(x)(z_y, r_perm, perms)
+    for perm, r_perm_ in zip(perms, r_perm):
+        stats.corr(y, x, corr, perm)
+        assert_allclose(r_perm_, corr)
+
 
 def test_lm():
     "Test linear model function against scipy lstsq"
@@ -158,3 +167,12 @@ def test_t_ind():
         y_perm[perm] = y
         t_sp, _ = scipy.stats.ttest_ind(y_perm[:n], y_perm[n:])
         assert_allclose(t, t_sp)
+
+    # block of permutations
+    perms = np.array([perm.copy() for perm in permute_order(n_cases, 3)])
+    y_flat = y.reshape((n_cases, -1))
+    t_perm = np.empty((len(perms), y_flat.shape[1]))
+    stats.TIndPerm(n, n)(y_flat, t_perm, perms)
+    for perm, t_perm_ in zip(perms, t_perm):
+        stats.t_ind(y, n, n, out=t, perm=perm)
+        assert_allclose(t_perm_, t.ravel())
@@ -3,19 +3,26 @@
 from itertools import izip, product
 import cPickle as pickle
 import logging
+import os
+import subprocess
+import sys
 
-from nose.tools import (eq_, assert_equal, assert_greater_equal, assert_less,
-                        assert_in, assert_not_in, assert_raises)
+from nose.tools import (eq_, ok_, assert_almost_equal, assert_equal,
+                        assert_greater_equal, assert_less, assert_in,
+                        assert_not_in, assert_raises)
 import numpy as np
-from numpy.testing import assert_array_equal
+from numpy.testing import (assert_allclose, assert_array_equal,
+                           assert_array_almost_equal)
 from scipy import ndimage
 
 import eelbrain
 from eelbrain import datasets, testnd, NDVar
 from eelbrain._data_obj import UTS, Ordered, Sensor, cwt_morlet
-from eelbrain._stats import testnd as _testnd
+from eelbrain._stats import opt, testnd as _testnd
+from eelbrain._stats.permutation import permute_sign_flip
 from eelbrain._stats.testnd import _ClusterDist, label_clusters
 from eelbrain._utils import logger
+from eelbrain._utils.testing import TempDir
 from eelbrain.tests.test_data import assert_dataobj_equal, assert_dataset_equal
 
 
@@ -120,6 +127,255 @@ def test_anova_incremental():
     testnd.anova('uts', 'A*B', ds=ds[3:], pmin=0.05, samples=10)
 
 
+def test_checkpoint():
+    "Test resuming and extending permutation tests through checkpoints"
+    ds = datasets.get_uts(True)
+    tempdir = TempDir()
+    path = os.path.join(tempdir, 'checkpoint.pickled')
+    args = ('uts', 'A%B', ('a1', 'b1'), ('a0', 'b0'), 'rm')
+    res = testnd.ttest_rel(*args, ds=ds, samples=100)
+
+    for mp in (0, 1):
+        eelbrain._stats.testnd.MULTIPROCESSING = mp
+        # extend a test with additional samples
+        res_50 = testnd.ttest_rel(*args, ds=ds, samples=50)
+        res_50._write_checkpoint(path)
+        _testnd.CHECKPOINT_INTERVAL = 0
+        res_ = testnd.ttest_rel(*args, ds=ds, samples=100, checkpoint=path)
+        _testnd.CHECKPOINT_INTERVAL = 300
+        assert_array_equal(res_._cdist.dist, res._cdist.dist)
+        ok_(not os.path.exists(path), "checkpoint not removed")
+
+        # resume an interrupted test (samples in the checkpoint are reused)
+        res._write_checkpoint(path)
+        with open(path, 'rb') as fid:
+            state = pickle.load(fid)
+        state['done'][1::2] = False
+        state['dists'][0] += 1
+        with open(path, 'wb') as fid:
+            pickle.dump(state, fid)
+        res_ = testnd.ttest_rel(*args, ds=ds, samples=100, checkpoint=path)
+        assert_array_equal(res_._cdist.dist, res._cdist.dist + state['done'])
+
+        # multiple effects
+        res_a = testnd.anova('utsnd', 'A*B*rm', ds=ds, samples=8)
+        testnd.anova('utsnd', 'A*B*rm', ds=ds, samples=4)._write_checkpoint(path)
+        res_ = testnd.anova('utsnd', 'A*B*rm', ds=ds, samples=8,
+                            checkpoint=path)
+        for cdist, cdist_ in izip(res_a._cdist, res_._cdist):
+            assert_array_equal(cdist_.dist, cdist.dist)
+    eelbrain._stats.testnd.MULTIPROCESSING = 1
+
+    # checkpoint from a different test
+    res._write_checkpoint(path)
+    assert_raises(ValueError, testnd.ttest_rel, *args, ds=ds, samples=100,
+                  pmin=0.1, checkpoint=path)
+    # random sign flips can not be extended to all sign flips
+    sds = ds.sub("rm.isin(('R00', 'R01', 'R02', 'R03', 'R04'))")
+    res = testnd.ttest_rel(*args, ds=sds, samples=20)
+    res = pickle.loads(pickle.dumps(res, pickle.HIGHEST_PROTOCOL))
+    res._write_checkpoint(path)
+    assert_raises(ValueError, testnd.ttest_rel, *args, ds=sds, samples=-1,
+                  checkpoint=path)
+    ok_(res._can_extend(25))
+    ok_(not res._can_extend(100))
+    ok_(not res._can_extend(25, np.float32))
+    # checkpoints need to record the permutation sequence
+    with open(path, 'rb') as fid:
+        state = pickle.load(fid)
+    state['header'] = [header[:-1] for header in state['header']]
+    with open(path, 'wb') as fid:
+        pickle.dump(state, fid)
+    assert_raises(ValueError, testnd.ttest_rel, *args, ds=sds, samples=25,
+                  checkpoint=path)
+    res._cdist.sequence = None
+    ok_(not res._can_extend(25))
+    assert_raises(RuntimeError, res._write_checkpoint, path)
+
+
+SHARD_SCRIPT = """
+import sys
+from eelbrain import datasets, testnd
+ds = datasets.get_uts(True)
+testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds, samples=50, pmin=0.1,
+                 shard=(int(sys.argv[1]), 3), checkpoint=sys.argv[2])
+"""
+
+
+def test_worker_pool():
+    "Test running several tests with the same WorkerPool"
+    ds = datasets.get_uts(True)
+    tests = (
+        lambda: testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds,
+                                 samples=20, tfce=True),
+        lambda: testnd.ttest_ind('utsnd', 'A', 'a1', 'a0', ds=ds, samples=20,
+                                 pmin=0.1, tstart=0.1),
+        lambda: testnd.corr('uts', 'Y', ds=ds, samples=20),
+        lambda: testnd.anova('utsnd', 'A*B', ds=ds, samples=8, pmin=0.1),
+        lambda: testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds,
+                                 samples=20, tfce=True),
+    )
+    targets = [test() for test in tests]
+    pool = _testnd.WorkerPool(2)
+    with pool:
+        ok_(_testnd._worker_pool is pool)
+        results = [test() for test in tests]
+    ok_(_testnd._worker_pool is None)
+    eq_(repr(pool), "<WorkerPool: 2 workers, closed>")
+    for res, tgt in izip(results, targets):
+        for (_, cdist), (_, cdist_tgt) in izip(res._iter_cdists(),
+                                               tgt._iter_cdists()):
+            assert_array_equal(cdist.dist, cdist_tgt.dist)
+
+
+def test_float32():
+    "Test permutations with float32 data"
+    ds = datasets.get_uts(True)
+    tests = (
+        lambda **kw: testnd.ttest_1samp('utsnd', ds=ds, samples=20, **kw),
+        lambda **kw: testnd.ttest_ind('utsnd', 'A', 'a1', 'a0', ds=ds,
+                                      samples=20, **kw),
+        lambda **kw: testnd.corr('uts', 'Y', ds=ds, samples=20, **kw),
+        lambda **kw: testnd.t_contrast_rel('uts', 'A', 'a1 > a0', 'rm', ds=ds,
+                                           samples=20, **kw),
+        lambda **kw: testnd.anova('utsnd', 'A*B', ds=ds, samples=8, **kw),
+        lambda **kw: testnd.anova('uts', 'A*B', ds=ds[1:], samples=8, **kw),
+    )
+    targets = [test() for test in tests]
+    try:
+        for mp in (0, 1):
+            _testnd.MULTIPROCESSING = mp
+            for test, tgt in izip(tests, targets):
+                res = test(dtype=np.float32)
+                for (_, cdist), (_, cdist_tgt) in izip(res._iter_cdists(),
+                                                       tgt._iter_cdists()):
+                    eq_(cdist.dtype, np.float32)
+                    eq_(cdist.dist.dtype, np.float64)
+                    assert_array_almost_equal(cdist.dist, cdist_tgt.dist, 4)
+            # cluster based test with the module default
+            _testnd.PERM_DTYPE = np.float32
+            res = testnd.ttest_rel('utsnd', 'A', 'a1', 'a0', 'rm', ds=ds,
+                                   samples=20, pmin=0.05)
+            _testnd.PERM_DTYPE = np.float64
+            eq_(res._cdist.dtype, np.float32)
+            ok_(res._cdist.dist.max() > 0)
+    finally:
+        _testnd.PERM_DTYPE = np.float64
+        _testnd.MULTIPROCESSING = 1
+    assert_raises(ValueError, _testnd._ClusterDist, ds['uts'], 10, None,
+                  dtype=np.int32)
+
+    # persistence
+    res_ = pickle.loads(pickle.dumps(res, pickle.HIGHEST_PROTOCOL))
+    eq_(res_._cdist.dtype, np.float32)
+    # checkpoints are specific to the dtype
+    tempdir = TempDir()
+    path = os.path.join(tempdir, 'checkpoint.pickled')
+    res = tests[0](dtype=np.float32)
+    res._write_checkpoint(path)
+    assert_raises(ValueError, tests[0], checkpoint=path)
+    res_ = tests[0](dtype=np.float32, checkpoint=path)
+    assert_array_equal(res_._cdist.dist, res._cdist.dist)
+
+
+def test_shared_array():
+    "Test _SharedArray used to pass data to worker processes"
+    x = np.random.normal(0, 1, (10, 20))
+    shared = _testnd._SharedArray(x)
+    ok_(shared.array is x)
+    shared_ = pickle.loads(pickle.dumps(shared, pickle.HIGHEST_PROTOCOL))
+    assert_array_equal(shared_.array, x)
+    path = shared._file[0]
+    ok_(os.path.exists(path))
+    shared_.close()
+    ok_(os.path.exists(path))
+    shared.close()
+    ok_(not os.path.exists(path))
+
+    # memory mapped data is not copied
+    tempdir = TempDir()
+    path = os.path.join(tempdir, 'x.dat')
+    mm = np.memmap(path, x.dtype, 'w+', 0, x.shape)
+    mm[:] = x
+    shared = _testnd._SharedArray(mm)
+    shared_ = pickle.loads(pickle.dumps(shared, pickle.HIGHEST_PROTOCOL))
+    eq_(shared_.array.filename, mm.filename)
+    assert_array_equal(shared_.array, x)
+    shared.close()
+    ok_(os.path.exists(path))
+
+    # views on part of the file
+    shared = _testnd._SharedArray(mm[5:])
+    eq_(shared._file, (mm.filename, 5 * x[0].nbytes))
+    shared_ = pickle.loads(pickle.dumps(shared, pickle.HIGHEST_PROTOCOL))
+    assert_array_equal(shared_.array, x[5:])
+
+
+def test_memmap():
+    "Test permutation tests on memory mapped NDVars"
+    ds = datasets.get_uts(True)
+    tempdir = TempDir()
+    y = ds['utsnd'].as_memmap(os.path.join(tempdir, 'utsnd.dat'))
+    ds_mm = ds.copy()
+    ds_mm['utsnd'] = y
+    kwargs = dict(samples=10, pmin=0.1, tstart=0.1)
+    res = testnd.ttest_rel('utsnd', 'A', 'a1', 'a0', 'rm', ds=ds, **kwargs)
+    res_mm = testnd.ttest_rel('utsnd', 'A', 'a1', 'a0', 'rm', ds=ds_mm,
+                              **kwargs)
+    assert_array_almost_equal(res_mm.t.x, res.t.x)
+    assert_array_almost_equal(res_mm._cdist.dist, res._cdist.dist)
+    res = testnd.ttest_1samp('utsnd', ds=ds, **kwargs)
+    res_mm = testnd.ttest_1samp('utsnd', ds=ds_mm, **kwargs)
+    assert_array_almost_equal(res_mm.t.x, res.t.x)
+    assert_array_almost_equal(res_mm._cdist.dist, res._cdist.dist)
+
+
+def test_shards():
+    "Test merging permutation shards"
+    ds = datasets.get_uts(True)
+    tempdir = TempDir()
+    paths = [os.path.join(tempdir, 'shard %i.pickled' % i) for i in xrange(3)]
+    dst = os.path.join(tempdir, 'merged.pickled')
+
+    # shards in separate processes
+    cwd = os.path.dirname(os.path.dirname(eelbrain.__file__))
+    processes = [subprocess.Popen([sys.executable, '-c', SHARD_SCRIPT, str(i),
+                                   path], cwd=cwd)
+                 for i, path in enumerate(paths)]
+    for process in processes:
+        eq_(process.wait(), 0)
+    testnd.merge_shards(paths, dst)
+    res = testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds, samples=50,
+                           pmin=0.1)
+    res_ = testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=ds, samples=50,
+                            pmin=0.1, checkpoint=dst)
+    assert_array_equal(res_._cdist.dist, res._cdist.dist)
+    assert_dataset_equal(res_.clusters, res.clusters)
+
+    # multiple effects, with a missing shard
+    res = testnd.anova('utsnd', 'A*B*rm', ds=ds, samples=8)
+    paths = [os.path.join(tempdir, 'anova %i.pickled' % i) for i in xrange(2)]
+    for i, path in enumerate(paths):
+        res_ = testnd.anova('utsnd', 'A*B*rm', ds=ds, samples=8, shard=(i, 3),
+                            checkpoint=path)
+        index = np.arange(8)
+        in_shard = (index >= i * 8 // 3) & (index < (i + 1) * 8 // 3)
+        assert_array_equal(np.isnan(res_._cdist[0].dist), ~in_shard)
+        # incomplete distributions do not provide p-values
+        eq_(res_.probability_maps, [None, None, None])
+        assert_raises(RuntimeError, res_.find_clusters)
+        res_ = pickle.loads(pickle.dumps(res_, pickle.HIGHEST_PROTOCOL))
+        assert_raises(RuntimeError, res_.compute_probability_map)
+    testnd.merge_shards(paths, dst)
+    res_ = testnd.anova('utsnd', 'A*B*rm', ds=ds, samples=8, checkpoint=dst)
+    for cdist, cdist_ in izip(res._cdist, res_._cdist):
+        assert_array_equal(cdist_.dist, cdist.dist)
+
+    # shards need a checkpoint
+    assert_raises(ValueError, testnd.ttest_rel, 'uts', 'A', 'a1', 'a0', 'rm',
+                  ds=ds, samples=50, shard=(0, 2))
+
+
 def test_clusterdist():
     "Test _ClusterDist class"
     shape = (10, 6, 6, 4)
@@ -185,6 +441,23 @@ def test_clusterdist():
     assert_greater_equal(res.clusters['duration'].min(), 0.02)
     eq_(res.clusters['n_sensors'].min(), 2)
 
+    # cluster index
+    res = testnd.ttest_rel('utsnd', 'A', match='rm', ds=ds, samples=10,
+                           pmin=0.05)
+    cdist = res._cdist
+    cluster_map = cdist.cluster_map.x
+    param_map = cdist.parameter_map.x
+    assert_array_almost_equal(cdist._cluster_index.v,
+                              ndimage.sum(param_map, cluster_map, cdist._cids))
+    for cid, cluster in izip(res.clusters['id'], res.clusters['cluster']):
+        assert_array_equal(cluster.x, param_map * (cluster_map == cid))
+        assert_array_equal(res.cluster(cid).x, cluster.x)
+    pmap = res.compute_probability_map()
+    for cid, p in izip(res.clusters['id'], res.clusters['p']):
+        assert_array_equal(pmap.x[cluster_map == cid], p)
+    res_ = pickle.loads(pickle.dumps(res, pickle.HIGHEST_PROTOCOL))
+    assert_dataset_equal(res_.clusters, res.clusters)
+
     # TFCE
     logger.info("TEST:  TFCE")
     sensor = Sensor(locs, ['0', '1', '2', '3'])
@@ -257,6 +530,118 @@ def test_clusterdist():
         assert_equal(cdist.dist.shape, (5, 4, 2, 10))
 
 
+def _find_peaks_reference(x, connectivity):
+    "Previous Python implementation of _ClusterDist._find_peaks()"
+    out = np.empty(x.shape, np.bool8)
+    out.fill(True)
+    for ax in xrange(x.ndim - 1, -1, -1):
+        if ax == 0:
+            shape = (len(x), -1)
+            xsa = x.reshape(shape)
+            outsa = out.reshape(shape)
+            axlen = xsa.shape[1]
+
+            conn_src = connectivity[:, 0]
+            conn_dst = connectivity[:, 1]
+            for i in xrange(axlen):
+                data = xsa[:, i]
+                outslice = outsa[:, i]
+                if not np.any(outslice):
+                    continue
+
+                # find all points under a slope
+                sign = np.sign(data[conn_src] - data[conn_dst])
+                no = set(conn_src[sign < 0])
+                no.update(conn_dst[sign > 0])
+
+                # expand to equal points
+                border = no
+                while border:
+                    # forward
+                    idx = np.in1d(conn_src, border)
+                    conn_dst_sub = conn_dst[idx]
+                    eq = np.equal(data[conn_src[idx]], data[conn_dst_sub])
+                    new = set(conn_dst_sub[eq])
+                    # backward
+                    idx = np.in1d(conn_dst, border)
+                    conn_src_sub = conn_src[idx]
+                    eq = np.equal(data[conn_src_sub], data[conn_dst[idx]])
+                    new.update(conn_src_sub[eq])
+
+                    # update
+                    new.difference_update(no)
+                    no.update(new)
+                    border = new
+
+                # mark vertices or whole isoline
+                if no:
+                    outslice[list(no)] = False
+                elif not np.all(outslice):
+                    outslice.fill(False)
+        else:
+            xsa = x.swapaxes(0, ax)
+            outsa = out.swapaxes(0, ax)
+            axlen = len(xsa)
+
+            kernel = np.empty(xsa.shape[1:], dtype=np.bool8)
+
+            diff = np.diff(xsa, 1, 0)
+
+            # forward
+            kernel.fill(True)
+            for i in xrange(axlen - 1):
+                kernel[diff[i] > 0] = True
+                kernel[diff[i] < 0] = False
+                nodiff = diff[i] == 0
+                kernel[nodiff] *= outsa[i + 1][nodiff]
+                outsa[i + 1] *= kernel
+
+            # backward
+            kernel.fill(True)
+            for i in xrange(axlen - 2, -1, -1):
+                kernel[diff[i] < 0] = True
+                kernel[diff[i] > 0] = False
+                nodiff = diff[i] == 0
+                kernel[nodiff] *= outsa[i][nodiff]
+                outsa[i] *= kernel
+
+    return out
+
+
+def test_find_peaks():
+    "Test _ClusterDist._find_peaks() with sensor connectivity"
+    locs = [[0, 0, 0],
+            [1, 0, 0],
+            [1, 1, 0],
+            [0, 1, 0]]
+    sensor = Sensor(locs, ['0', '1', '2', '3'])
+    sensor.set_connectivity(connect_dist=1.1)
+    y = NDVar(np.random.normal(0, 1, (10, 4, 6)),
+              ('case', sensor, UTS(0, 0.01, 6)))
+    cdist = _ClusterDist(y, 0, None)
+    connectivity = cdist._connectivity.edges
+
+    # plateaus spanning neighboring sensors and time points
+    x = np.zeros((4, 6))
+    x[0, 1] = x[1, 1] = 3
+    x[2, 2:4] = 3
+    x[3, 2] = 1
+    x[0, 5] = x[3, 5] = 2
+    x[1, 5] = 1
+    tgt = np.zeros((4, 6), bool)
+    tgt[[0, 1, 2, 2, 0, 3], [1, 1, 2, 3, 5, 5]] = True
+    peaks = cdist._find_peaks(x)
+    assert_array_equal(peaks, tgt)
+    assert_array_equal(peaks, _find_peaks_reference(x, connectivity))
+
+    # random maps
+    rng = np.random.RandomState(0)
+    for _ in xrange(20):
+        x = rng.normal(0, 1, (4, 6))
+        assert_array_equal(cdist._find_peaks(x),
+                           _find_peaks_reference(x, connectivity))
+
+
 def test_corr():
     "Test testnd.corr()"
     ds = datasets.get_uts(True)
@@ -338,6 +723,89 @@ def test_labeling():
     assert_array_equal(cmap > 0, np.abs(pmap) > 2)
 
 
+def test_cluster_sums():
+    "Test cluster sums and extents against scipy.sparse.csgraph"
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    shape = (6, 40)
+    conn = np.array([(0, 1), (0, 3), (1, 2), (2, 3), (3, 5), (4, 5)],
+                    np.uint32)
+    idx = np.arange(np.prod(shape)).reshape(shape)
+    src = np.concatenate((idx[:, :-1].ravel(), idx[conn[:, 0]].ravel()))
+    dst = np.concatenate((idx[:, 1:].ravel(), idx[conn[:, 1]].ravel()))
+    cmap = np.empty(shape, np.uint32)
+    bin_buff = np.empty(shape, np.bool8)
+    rs = np.random.RandomState(0)
+    for _ in xrange(10):
+        x = rs.normal(0, 1.5, shape)
+        bin_map = x > 1
+        # reference
+        edge = bin_map.ravel()[src] & bin_map.ravel()[dst]
+        graph = coo_matrix((np.ones(edge.sum()), (src[edge], dst[edge])),
+                           (x.size, x.size))
+        _, labels = connected_components(graph, False)
+        labels = labels[bin_map.ravel()]
+        ref_ids = np.unique(labels)
+        ref_sums = np.array([x[bin_map][labels == i].sum() for i in ref_ids])
+        loc = idx[bin_map]
+        ref_time = np.array([np.unique(loc[labels == i] % shape[1]).size
+                             for i in ref_ids])
+        ref_vert = np.array([np.unique(loc[labels == i] // shape[1]).size
+                             for i in ref_ids])
+        # without criteria
+        cids, sums, origins = _testnd._label_clusters(
+            x, 1, 1, conn, None, cmap, bin_buff)
+        assert_array_equal(cids, np.arange(1, len(ref_ids) + 1))
+        assert_array_almost_equal(np.sort(sums), np.sort(ref_sums))
+        assert_array_equal(cmap.ravel()[origins], cids)
+        # with criteria
+        criteria = [((0,), 3), ((1,), 2)]
+        cids, sums, origins = _testnd._label_clusters(
+            x, 1, 1, conn, criteria, cmap, bin_buff)
+        keep = (ref_time >= 3) & (ref_vert >= 2)
+        assert_array_almost_equal(np.sort(sums), np.sort(ref_sums[keep]))
+
+
+def test_tfce():
+    "Test TFCE backends and multi-threaded map processing"
+    conn = np.array([(0, 1), (0, 3), (1, 2), (2, 3), (3, 5), (4, 5)],
+                    np.uint32)
+    rs = np.random.RandomState(0)
+    for shape, connectivity in (((6, 30, 4), conn), ((6, 30), None)):
+        for tail in (-1, 0, 1):
+            x = rs.normal(0, 3, shape)
+            tfce_map = _testnd.tfce(x, tail, connectivity, 'incremental')
+            assert_array_almost_equal(
+                tfce_map, _testnd.tfce(x, tail, connectivity, 'label'))
+            # multiple threads
+            for backend in ('incremental', 'label'):
+                assert_array_almost_equal(
+                    tfce_map, _testnd.tfce(x, tail, connectivity, backend, 3))
+            cmap, cids = label_clusters(x, 2, tail, connectivity, None)
+            cmap_t, cids_t = label_clusters(x, 2, tail, connectivity, None, 2)
+            assert_array_equal(cmap_t, cmap)
+            assert_array_equal(cids_t, cids)
+            # map processors keep threads and buffers for several maps
+            args = (tail, tuple(range(len(shape))), None, shape, shape,
+                    connectivity is None, connectivity)
+            processors = (
+                (_testnd.TFCEProcessor(*args, backend='label'),
+                 _testnd.TFCEProcessor(*args, backend='label', n_threads=3)),
+                (_testnd.TFCEProcessor(*args),
+                 _testnd.TFCEProcessor(*args, n_threads=3)),
+                (_testnd.ClusterProcessor(*args + (2, None)),
+                 _testnd.ClusterProcessor(*args + (2, None), n_threads=2)))
+            for processor, processor_t in processors:
+                for _ in xrange(2):
+                    x = rs.normal(0, 3, shape)
+                    assert_almost_equal(processor_t.max_stat(x.copy()),
+                                        processor.max_stat(x.copy()))
+                processor_t.close()
+                ok_(processor_t._pool is None)
+    assert_raises(ValueError, _testnd.tfce, x, 0, None, 'other')
+
+
 def test_ttest_1samp():
     "Test testnd.ttest_1samp()"
     ds = datasets.get_uts(True)
@@ -458,7 +926,19 @@ def test_ttest_rel():
     res4 = testnd.ttest_rel('uts', 'A%B', ('a1', 'b1'), ('a0', 'b0'), 'rm',
                             ds=ds, samples=100)
     assert_dataset_equal(res4.find_clusters(maps=True), res.clusters)
+    assert_array_equal(res4._cdist.dist, res._cdist.dist)
     eelbrain._stats.testnd.MULTIPROCESSING = 1
+    # permutation record
+    eelbrain._stats.testnd.RECORD_PERMUTATIONS = True
+    res5 = testnd.ttest_rel('uts', 'A%B', ('a1', 'b1'), ('a0', 'b0'), 'rm',
+                            ds=ds, samples=100)
+    eelbrain._stats.testnd.RECORD_PERMUTATIONS = False
+    assert_array_equal(res5._cdist.dist, res._cdist.dist)
+    signs = [sign.copy() for sign in permute_sign_flip(res.n, 100)]
+    assert_array_equal(res5._cdist.permutations, signs)
+    string = pickle.dumps(res5, pickle.HIGHEST_PROTOCOL)
+    res5_ = pickle.loads(string)
+    assert_array_equal(res5_._cdist.permutations, res5._cdist.permutations)
     sds = ds.sub("B=='b0'")
     # thresholded, UTS
     eelbrain._stats.testnd.MULTIPROCESSING = 0
@@ -487,6 +967,46 @@ def test_ttest_rel():
     res1 = testnd.ttest_rel('uts', 'A', 'a1', 'a0', 'rm', ds=sds, tfce=True,
                             samples=10)
     assert_dataobj_equal(res1.compute_probability_map(), tgt)
+    # p-values from the sorted distribution
+    dist = res0._cdist.dist
+    tfce_map = res0._cdist.tfce_map.x
+    p = np.mean(dist[:, np.newaxis] > tfce_map, 0)
+    assert_array_equal(tgt.x, p)
+
+
+def _t_1samp_perm_reference(y, out, signs):
+    "Sign flip t-maps computed one permutation at a time"
+    for out_, sign in izip(out, signs):
+        opt.t_1samp_perm(y, out_, sign)
+    return out
+
+
+def test_ttest_exhaustive():
+    "Test that exhaustive sign flips reproduce single permutations exactly"
+    ds = datasets.get_uts(True)
+    sds = ds.sub("B == 'b0'")
+    sds = sds.sub("rm.isin(%r)" % (sds['rm'].cells[:10],))
+    args = ('uts', 'A', 'a1', 'a0', 'rm')
+    res = testnd.ttest_rel(*args, ds=sds, samples=-1, tfce=True)
+    res_c = testnd.ttest_rel(*args, ds=sds, samples=-1, pmin=0.1)
+    eq_(len(res._cdist.dist), 2 ** 10 - 1)
+    # flipping all signs ties exactly with the original
+    tfce_max = np.abs(res._cdist.tfce_map.x).max()
+    ok_(np.any(res._cdist.dist == tfce_max))
+
+    t_1samp_perm_func = _testnd._t_1samp_perm_func
+    _testnd._t_1samp_perm_func = lambda samples: _t_1samp_perm_reference
+    eelbrain._stats.testnd.MULTIPROCESSING = 0
+    try:
+        tgt = testnd.ttest_rel(*args, ds=sds, samples=-1, tfce=True)
+        tgt_c = testnd.ttest_rel(*args, ds=sds, samples=-1, pmin=0.1)
+    finally:
+        _testnd._t_1samp_perm_func = t_1samp_perm_func
+        eelbrain._stats.testnd.MULTIPROCESSING = 1
+    assert_allclose(res._cdist.dist, tgt._cdist.dist, 1e-13)
+    assert_dataobj_equal(res.p, tgt.p)
+    assert_allclose(res_c._cdist.dist, tgt_c._cdist.dist, 1e-13)
+    assert_array_equal(res_c.clusters['p'], tgt_c.clusters['p'])
 
 
 def test_cwt():
@@ -1,5 +1,7 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
 
+import mmap
+
 import numpy as np
 
 
@@ -33,3 +35,31 @@ def slice_to_arange(s, length):
         stop = s.stop
 
     return np.arange(start, stop, s.step)
+
+
+def is_mapped(x):
+    "Whether ``x`` is (a view on) data in a memory mapped file"
+    if not isinstance(x, np.memmap) or getattr(x, '_mmap', None) is None:
+        return False
+    return np.may_share_memory(x, np.frombuffer(x._mmap, np.uint8))
+
+
+def memmap_file(x):
+    """Location of memory mapped data in its file
+
+    Parameters
+    ----------
+    x : array
+        Data.
+
+    Returns
+    -------
+    location : None | tuple
+        ``(filename, offset)`` if ``x`` is C-contiguous data in a memory mapped
+        file (including views on parts of the file), otherwise None.
+    """
+    if not x.flags.c_contiguous or not is_mapped(x):
+        return None
+    mm_start = np.frombuffer(x._mmap, np.uint8).ctypes.data
+    file_start = x.offset - x.offset % mmap.ALLOCATIONGRANULARITY
+    return x.filename, file_start + x.ctypes.data - mm_start
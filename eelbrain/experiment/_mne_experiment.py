@@ -140,6 +140,8 @@ temp = {# MEG
         'data_parc': 'unmasked',
         'test-file': os.path.join('{test-dir}', '{analysis} {group}',
                                   '{epoch} {test} {test_options} {data_parc}.pickled'),
+        'test-checkpoint-file': os.path.join('{test-dir}', '{analysis} {group}',
+                                             '{epoch} {test} {test_options} {data_parc} checkpoint.pickled'),
 
         # MRIs
         'common_brain': 'fsaverage',
@@ -1986,7 +1988,14 @@ class MneExperiment(FileTree):
             Return the data along with the test result (see below).
         make : bool
             If the target file does not exist, create it (could take a long
-            time depending on the test; if False, raise an IOError).
+            time depending on the test; if False, raise an IOError). If the
+            cached test was performed with fewer samples, only the additional
+            samples are computed (unless the additional samples would come
+            from a different permutation sequence, e.g. when switching from
+            random to exhaustive permutations, in which case the test is
+            recomputed). While the test is running, the partial
+            distribution is periodically saved, so that an interrupted test
+            resumes where it stopped.
         redo : bool
             If the target file already exists, delete and recreate it (only
             applies for tests that are cached).
@@ -2053,6 +2062,7 @@ class MneExperiment(FileTree):
 
         dst = self.get('test-file', mkdir=True, data_parc=data_parc,
                        parc=parc_)
+        checkpoint = self.get('test-checkpoint-file')
 
         # try to load cached test
         if not redo and os.path.exists(dst):
@@ -2060,6 +2070,11 @@ class MneExperiment(FileTree):
             if res.samples >= samples or res.samples == -1:
                 load_data = return_data
             elif make:
+                # only compute the additional samples
+                if res.samples > 0 and res._can_extend(samples):
+                    res._write_checkpoint(checkpoint)
+                elif os.path.exists(checkpoint):
+                    os.remove(checkpoint)
                 res = None
                 load_data = True
             else:
@@ -2069,6 +2084,8 @@ class MneExperiment(FileTree):
                        "number of samples." % (res.samples, samples))
                 raise IOError(msg)
         elif redo or make:
+            if redo and os.path.exists(checkpoint):
+                os.remove(checkpoint)
             res = None
             load_data = True
         else:
@@ -2102,7 +2119,7 @@ class MneExperiment(FileTree):
         # perform the test if it was not cached
         if res is None:
             res = self._make_test(ds[y_name], ds, test, samples, pmin, tstart,
-                                  tstop, None, parc_dim)
+                                  tstop, None, parc_dim, checkpoint)
             # cache
             save.pickle(res, dst)
 
@@ -3532,7 +3549,7 @@ class MneExperiment(FileTree):
                                        add_dist=True)
 
     def _make_test(self, y, ds, test, samples, pmin, tstart, tstop, dist_dim,
-                   parc_dim):
+                   parc_dim, checkpoint=None):
         """just compute the test result
 
         Parameters
@@ -3547,7 +3564,8 @@ class MneExperiment(FileTree):
         """
         # find cluster criteria
         kwargs = {'samples': samples, 'tstart': tstart, 'tstop': tstop,
-                  'dist_dim': dist_dim, 'parc': parc_dim}
+                  'dist_dim': dist_dim, 'parc': parc_dim,
+                  'checkpoint': checkpoint}
         if pmin == 'tfce':
             kwargs['tfce'] = True
         elif pmin is not None:
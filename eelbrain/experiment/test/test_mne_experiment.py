@@ -1,11 +1,12 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
 import os
 
-from nose.tools import eq_, assert_raises
+from nose.tools import eq_, ok_, assert_raises
 import numpy as np
-from numpy.testing import assert_equal
+from numpy.testing import assert_equal, assert_array_equal
 
-from eelbrain import Dataset, Factor, Var, MneExperiment
+from eelbrain import (Dataset, Factor, Var, MneExperiment, datasets, load,
+                      save, testnd)
 from ..._utils.testing import assert_dataobj_equal, TempDir
 
 
@@ -130,3 +131,56 @@ def test_file_handling():
     e = FileExperimentDefaults(tempdir)
     eq_(e.get('group'), 'gsub')
     eq_(e.get('subject'), SUBJECTS[1])
+
+
+class CachedTestExperiment(MneExperiment):
+
+    path_version = 1
+
+    tests = {'a': {'kind': 'ttest_rel', 'model': 'A', 'c1': 'a1', 'c0': 'a0'}}
+
+
+def test_load_test_samples():
+    "Test loading cached tests with additional samples"
+    tempdir = TempDir()
+    for subject in SUBJECTS:
+        os.makedirs(os.path.join(tempdir, 'meg', subject))
+    e = CachedTestExperiment(tempdir)
+
+    ds = datasets.get_uts(True)
+    ds = ds.sub("B == 'b0'")
+    ds = ds.sub("rm.isin(%r)" % (ds['rm'].cells[:6],))
+    ds['meg'] = ds['uts']
+    ds['subject'] = ds['rm']
+    e.load_evoked = lambda *args, **kwargs: ds.copy()
+    args = ('a', None, None, None)
+    kwargs = {'data': 'sns', 'make': True}
+    checkpoint = e.get('test-checkpoint-file')
+
+    # extend random permutations
+    e.load_test(*args, samples=10, **kwargs)
+    res = e.load_test(*args, samples=20, **kwargs)
+    tgt = testnd.ttest_rel('meg', 'A', 'a1', 'a0', 'subject', ds=ds,
+                           samples=20)
+    assert_array_equal(res._cdist.dist, tgt._cdist.dist)
+    ok_(not os.path.exists(checkpoint))
+
+    # random permutations can not be extended to all permutations
+    res = e.load_test(*args, samples=100, **kwargs)
+    tgt = testnd.ttest_rel('meg', 'A', 'a1', 'a0', 'subject', ds=ds,
+                           samples=-1)
+    eq_(res.samples, -1)
+    assert_array_equal(res._cdist.dist, tgt._cdist.dist)
+    ok_(not os.path.exists(checkpoint))
+
+    # results from an earlier version of the permutation sequence
+    e.load_test(*args, samples=10, redo=True, **kwargs)
+    dst = e.get('test-file')
+    res = load.unpickle(dst)
+    res._cdist.sequence = None
+    save.pickle(res, dst)
+    res = e.load_test(*args, samples=20, **kwargs)
+    tgt = testnd.ttest_rel('meg', 'A', 'a1', 'a0', 'subject', ds=ds,
+                           samples=20)
+    assert_array_equal(res._cdist.dist, tgt._cdist.dist)
+    ok_(not os.path.exists(checkpoint))
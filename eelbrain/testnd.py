@@ -41,6 +41,22 @@ cluster enhancement [2]_.
     evaluate. It might be a good idea to estimate the time they will take using
     a very small value for ``samples`` first.
 
+The permutations for a test can be split into shards that are computed in
+separate jobs (``shard`` and ``checkpoint`` parameters), and then combined:
+
+.. autosummary::
+   :toctree: generated
+
+   merge_shards
+
+To avoid starting new worker processes for every test, a series of tests can
+be run with the same worker processes:
+
+.. autosummary::
+   :toctree: generated
+
+   WorkerPool
+
 
 .. [1] Maris, E., & Oostenveld, R. (2007). Nonparametric
     statistical testing of EEG- and MEG-data. Journal of Neuroscience Methods,
@@ -55,4 +71,4 @@ cluster enhancement [2]_.
 __test__ = False
 
 from ._stats.testnd import (t_contrast_rel, corr, ttest_1samp, ttest_ind,
-                            ttest_rel, anova)
+                            ttest_rel, anova, merge_shards, WorkerPool)
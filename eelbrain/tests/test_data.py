@@ -1,4 +1,5 @@
 # Author: Christian Brodbeck <christianbrodbeck@nyu.edu>
+from collections import OrderedDict
 from itertools import izip, product
 import os
 import cPickle as pickle
@@ -15,7 +16,8 @@ from numpy.testing import (assert_equal, assert_array_equal,
 
 from eelbrain import (datasets, load, Var, Factor, NDVar, Dataset, Celltable,
                       align, align1, combine)
-from eelbrain._data_obj import asvar, Categorial, SourceSpace, UTS
+from eelbrain import _data_obj
+from eelbrain._data_obj import asvar, Adjacency, Categorial, SourceSpace, UTS
 from eelbrain._stats.stats import rms
 from eelbrain._utils.testing import (assert_dataobj_equal, assert_dataset_equal,
                                      assert_source_space_equal)
@@ -61,6 +63,23 @@ def test_aggregate():
     idx1_12 = np.logical_and(idx1, idx1.cumsum() <= 12)
     eq_(dsa['Y', 0], ds['Y', idx1_12].mean())
 
+    # segment reductions against cell-wise reductions
+    ds = datasets.get_uts()
+    ds = ds[np.random.RandomState(0).permutation(ds.n_cases)]
+    x = ds.eval('A % B')
+    cells = x.cells
+    for func in (np.mean, np.sum, np.median):
+        target = [func(ds['uts'].x[x == cell], 0) for cell in cells]
+        assert_array_almost_equal(ds['uts'].aggregate(x, func).x, target)
+        target = [func(ds['Y'].x[x == cell]) for cell in cells]
+        assert_array_almost_equal(ds['Y'].aggregate(x, func).x, target)
+    ds = ds.sub("A == 'a0'")
+    dsa = ds.aggregate('A % B', drop_bad=True)
+    assert_array_equal(dsa['n'], [15, 15])
+    assert_array_equal(dsa['B'], ['b0', 'b1'])
+    assert_array_almost_equal(dsa['Y'], [ds['Y', ds['B'] == b].mean() for b
+                                         in ('b0', 'b1')])
+
 
 def test_align():
     "Testing align() and align1() functions"
@@ -188,6 +207,13 @@ def test_combine():
 
     assert_raises(TypeError, combine, (ds2['A'], ds2['Y']))
 
+    # Factors with different labels
+    f1 = Factor('abca', labels={'a': 'x1', 'b': 'x2', 'c': 'x10'})
+    f2 = Factor('dba')
+    f = combine((f1, f2))
+    eq_(f.cells, ('a', 'b', 'd', 'x1', 'x2', 'x10'))
+    assert_array_equal(f, f1.as_labels() + f2.as_labels())
+
     # combine NDVar with unequel dimensions
     ds = datasets.get_uts(utsnd=True)
     y = ds['utsnd']
@@ -384,6 +410,40 @@ def test_factor():
     f = Factor(['a' * l for l in lens])
     assert_array_equal(f.label_length(), lens)
 
+    # construction from arrays
+    for x in (np.array([3, 1, 2, 1, 3]), np.array([0.5, -1, 0.5, 2, np.nan]),
+              np.array(['b', 'a', 'c', 'a']), np.array([u'b', u'\xe4', u'b']),
+              np.array([True, False, True])):
+        f = Factor(x)
+        target = Factor(x.tolist() if x.dtype.kind in 'SU' else list(x))
+        assert_array_equal(f.x, target.x)
+        eq_(f.cells, target.cells)
+    labels = {1: 'one', 2: 'two', 3: 'one'}
+    f = Factor(np.array([3, 1, 2, 1, 3]), labels=labels)
+    assert_array_equal(f.x, [0, 0, 1, 0, 0])
+    eq_(f.cells, ('one', 'two'))
+    f = Factor(np.array(['x10', 'x2', 'x1']))
+    eq_(f.cells, ('x1', 'x2', 'x10'))
+    labels = OrderedDict(((3, 'c'), (2, 'b'), (1, 'a')))
+    f = Factor(np.array([1, 2, 3, 1]), labels=labels)
+    eq_(f.cells, ('c', 'b', 'a'))
+
+    # cached index map
+    f = Factor('abcabcabc')
+    index_map = f.index_map()
+    eq_(index_map.keys(), ['a', 'b', 'c'])
+    assert_array_equal(index_map['b'], [1, 4, 7])
+    assert_array_equal(f == 'b', [False, True, False] * 3)
+    assert_array_equal(f.index('x'), [])
+    eq_(f.index_opt('c'), slice(2, None, 3))
+    f[4] = 'c'
+    assert_array_equal(f.index('b'), [1, 7])
+    assert_array_equal(f == 'c', [False, False, True, False, True] +
+                                 [True, False, False, True])
+    f.relabel({'c': 'a'})
+    eq_(f.index_map().keys(), ['a', 'b'])
+    assert_array_equal(f.index('a'), [0, 2, 3, 4, 5, 6, 8])
+
 
 def test_factor_relabel():
     "Test Factor.relabel() method"
@@ -412,6 +472,8 @@ def test_interaction():
     # eq for element
     for a, b in product(A.cells, B.cells):
         assert_array_equal(i == (a, b), np.logical_and(A == a, B == b))
+        assert_array_equal(i.index((a, b)),
+                           np.flatnonzero(np.logical_and(A == a, B == b)))
 
 
 def test_isin():
@@ -486,6 +548,15 @@ def test_ndvar():
     assert_equal(x.sub(sensor=['4']), x.x[:, [4]])
     assert_equal(x.sub(case=1, sensor='4'), x.x[1, 4])
 
+    # views
+    ok_(np.may_share_memory(x.sub(time=(0.1, 0.2)).x, x.x))
+    ok_(np.may_share_memory(x.sub(sensor=['1', '2', '3']).x, x.x))
+    ok_(np.may_share_memory(x.sub(case=np.arange(0, 60, 2)).x, x.x))
+    ok_(not np.may_share_memory(x.sub(sensor=['3', '2']).x, x.x))
+    x_sub = x.sub(time=(0.1, 0.2), copy=True)
+    ok_(not np.may_share_memory(x_sub.x, x.x))
+    assert_equal(x_sub, x.sub(time=(0.1, 0.2)))
+
     # setup indices
     s_case = slice(10, 13)
     s_sensor = slice(2, 4)
@@ -544,6 +615,19 @@ def test_ndvar():
     bl = x_bl.summary('case', 'sensor', time=(None, 0))
     ok_(abs(bl) < 1e-10, "Baseline correction")
 
+    # summary over a region in a single reduction
+    i_time = x.time._slice(0.1, 0.2)
+    assert_array_almost_equal(x.summary('sensor', time=(0.1, 0.2)).x,
+                              x.x[..., i_time].mean(2).mean(1))
+    assert_array_almost_equal(x.summary('sensor', time=(0.1, 0.2),
+                                        func=np.var).x,
+                              x.x[..., i_time].var(2).var(1))
+    assert_array_almost_equal(x.summary(sensor=['1', '3'], time=0.1).x,
+                              x.x[:, [1, 3], x.time.dimindex(0.1)].mean(1))
+    # only scalar regions:  collapse cases
+    assert_almost_equal(x.summary(sensor='1', time=0.1),
+                        x.x[:, 1, x.time.dimindex(0.1)].mean())
+
     # NDVar as index
     sens_mean = x.mean(('case', 'time'))
     idx = sens_mean > 0
@@ -578,6 +662,65 @@ def test_ndvar_binning():
     eq_(binned_ndvar.shape, (5, 7))
 
 
+def test_ndvar_memmap():
+    "Test NDVar with memory mapped data"
+    ds = datasets.get_uts(utsnd=True)
+    x = ds['utsnd']
+    tempdir = tempfile.mkdtemp()
+    result_dir = tempfile.mkdtemp()
+    chunk_size = _data_obj.preferences['memmap_chunk_size']
+    _data_obj.preferences['memmap_chunk_size'] = x.x[0].nbytes * 7
+    _data_obj.preferences['memmap_temp_dir'] = result_dir
+    try:
+        xm = x.as_memmap(os.path.join(tempdir, 'utsnd.dat'))
+        ok_(isinstance(xm.x, np.memmap))
+        assert_dataobj_equal(xm, x)
+
+        # pickling stores the file location
+        xm_sub = xm[10:20]
+        pickled = pickle.dumps(xm_sub, pickle.HIGHEST_PROTOCOL)
+        ok_(len(pickled) < xm_sub.x.nbytes)
+        xm_ = pickle.loads(pickled)
+        eq_(xm_.x.filename, xm.x.filename)
+        assert_dataobj_equal(xm_, x[10:20])
+
+        # operations in chunks of cases
+        assert_dataobj_equal(xm.sub(sensor=['3', '1']),
+                             x.sub(sensor=['3', '1']))
+        idx = ds.eval("A == 'a1'")
+        assert_dataobj_equal(xm[idx], x[idx])
+        assert_array_almost_equal(xm.summary('time', sensor=['1', '2']).x,
+                                  x.summary('time', sensor=['1', '2']).x)
+        assert_array_almost_equal(xm.summary().x, x.summary().x)
+        assert_array_almost_equal(xm.aggregate(ds['A']).x,
+                                  x.aggregate(ds['A']).x)
+        assert_array_almost_equal((xm - xm.summary()).x, (x - x.summary()).x)
+        assert_array_almost_equal((xm * ds['Y']).x, (x * ds['Y']).x)
+        assert_array_almost_equal((xm > 0).x, (x > 0).x)
+        ok_(isinstance((xm + 1).x, np.memmap))
+
+        # temporary results are pickled with their data
+        x2 = pickle.loads(pickle.dumps(xm * 2, pickle.HIGHEST_PROTOCOL))
+        ok_(not isinstance(x2.x, np.memmap))
+        assert_array_almost_equal(x2.x, x.x * 2)
+
+        # temporary files are removed with the data
+        x2 = xm + 1
+        path = x2.x.filename
+        eq_(os.path.dirname(path), result_dir)
+        x2_sub = x2[:3]
+        del x2
+        ok_(os.path.exists(path))
+        del x2_sub
+        ok_(not os.path.exists(path))
+        eq_(os.listdir(result_dir), [])
+    finally:
+        _data_obj.preferences['memmap_chunk_size'] = chunk_size
+        _data_obj.preferences['memmap_temp_dir'] = None
+        shutil.rmtree(tempdir, ignore_errors=True)
+        shutil.rmtree(result_dir, ignore_errors=True)
+
+
 def test_ndvar_graph_dim():
     "Test NDVar dimensions with conectvity graph"
     ds = datasets.get_uts(utsnd=True)
@@ -590,6 +733,23 @@ def test_ndvar_graph_dim():
     conn = argsort[sub_mono.sensor.connectivity().ravel()].reshape((-1, 2))
     assert_equal(sub_nonmono.sensor.connectivity(), conn)
 
+    # adjacency
+    sensor = x.sensor
+    adjacency = sensor._adjacency()
+    ok_(sensor._adjacency() is adjacency)
+    conn = sensor.connectivity()
+    for i in xrange(len(sensor)):
+        neighbors = set(conn[conn[:, 0] == i, 1])
+        neighbors.update(conn[conn[:, 1] == i, 0])
+        eq_(set(adjacency.neighbors(i)), neighbors)
+        eq_(adjacency.degree[i], len(neighbors))
+    eq_(sub_nonmono.sensor._adjacency(),
+        Adjacency(sub_nonmono.sensor.connectivity(), 3))
+    labels = np.arange(len(sensor)) % 2
+    disconnected = adjacency.disconnect(labels)
+    edges = disconnected.edges
+    assert_array_equal(labels[edges[:, 0]], labels[edges[:, 1]])
+
 
 def test_ndvar_summary_methods():
     "Test NDVar methods for summarizing data over axes"
@@ -0,0 +1,35 @@
+# Compare Factor construction from sequences (loop) and arrays (vectorized)
+from timeit import repeat
+
+import numpy as np
+from eelbrain import Factor, combine
+
+N_CASES = 10**6
+N_CELLS = 200
+
+rng = np.random.RandomState(0)
+codes = rng.randint(0, N_CELLS, N_CASES)
+inputs = {'int': codes,
+          'float': codes / 10.,
+          'str': np.array(['w%i' % i for i in xrange(N_CELLS)])[codes]}
+
+
+def timed(func):
+    return min(repeat(func, number=1, repeat=3))
+
+
+print "n_cases=%i; n_cells=%i" % (N_CASES, N_CELLS)
+for kind in ('int', 'float', 'str'):
+    x = inputs[kind]
+    x_list = x.tolist()
+    t_loop = timed(lambda: Factor(x_list))
+    t_array = timed(lambda: Factor(x))
+    assert np.all(Factor(x_list).x == Factor(x).x)
+    print "%-6s loop: %6.3f s;  array: %6.3f s" % (kind, t_loop, t_array)
+
+# combine Factors with different labels
+f1 = Factor(inputs['str'][:N_CASES // 2])
+f2 = Factor(inputs['str'][N_CASES // 2:], labels={'w0': 'w_new'})
+t_labels = timed(lambda: Factor(f1.as_labels() + f2.as_labels()))
+t_merge = timed(lambda: combine((f1, f2)))
+print "combine labels: %6.3f s;  merge: %6.3f s" % (t_labels, t_merge)
@@ -0,0 +1,33 @@
+# Compare the two backends of _IncrementalNDANOVA on unbalanced data
+from timeit import repeat
+
+import numpy as np
+from eelbrain import datasets
+from eelbrain._stats import glm
+from eelbrain._stats.permutation import permute_order
+
+N_TESTS = 10000
+N_PERM = 10
+
+ds = datasets.get_uts(True)[1:]  # drop one case to unbalance the design
+y = np.random.RandomState(0).normal(0, 1, (ds.n_cases, N_TESTS))
+perms = list(permute_order(ds.n_cases, N_PERM))
+
+
+def run(aov):
+    for perm in perms:
+        aov.map(y, perm)
+
+
+print "n_cases=%i; n_tests=%i; %i permutations" % (ds.n_cases, N_TESTS, N_PERM)
+for x in ('A*B', 'A*B*Y'):
+    model = ds.eval(x)
+    results = {}
+    for backend in ('kernel', 'gemm'):
+        aov = glm._IncrementalNDANOVA(model, backend)
+        results[backend] = aov.preallocate(y.shape)
+        t = min(repeat(lambda: run(aov), number=1, repeat=3))
+        print "%-6s %-7s %i models: %.1f ms / permutation" % (
+            x, backend, len(aov._models), 1000 * t / N_PERM)
+    print "max difference: %g" % np.abs(results['gemm'] -
+                                        results['kernel']).max()